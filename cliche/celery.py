@@ -112,18 +112,23 @@ References
 ----------
 
 """
+import logging
 import os
 import pathlib
+import time
 
+from billiard.process import current_process
 from celery import Celery, current_app, current_task
 from celery.loaders.base import BaseLoader
-from celery.signals import celeryd_init, task_failure, task_postrun
+from celery.signals import (celeryd_init, task_failure, task_postrun,
+                            task_prerun, worker_process_init)
 from raven import Client
 from raven.conf import setup_logging
 from raven.handlers.logging import SentryHandler
 from sqlalchemy.engine import Engine, create_engine
 
 from .config import ConfigDict, read_config
+from .metrics import REGISTRY, TASK_SECONDS, serve, summarize
 from .orm import Session, import_all_modules
 
 __all__ = (
@@ -196,6 +201,68 @@ def close_session(task_id, task, *args, **kwargs):
         session.close()
 
 
+def serve_metrics():
+    """Serve metrics of the current process if ``METRICS_PORT`` is
+    configured and they're not served yet.  See also :mod:`cliche.metrics`.
+
+    """
+    config = current_app.conf
+    port = config.get('METRICS_PORT')
+    if port is None or config.get('METRICS_SERVER') is not None:
+        return
+    # every pool process serves on its own port
+    port += getattr(current_process(), 'index', None) or 0
+    try:
+        config['METRICS_SERVER'] = serve(
+            port, config.get('METRICS_ADDRESS', '127.0.0.1')
+        )
+    except OSError:
+        logging.getLogger(__name__ + '.serve_metrics').exception(
+            'Failed to serve metrics on the port %d.', port
+        )
+        config['METRICS_SERVER'] = False
+
+
+@worker_process_init.connect
+def reset_metrics(**kwargs):
+    """Drop metrics inherited from the parent process, so that each
+    forked worker reports only its own.
+
+    """
+    REGISTRY.clear()
+    current_app.conf['METRICS_SERVER'] = None
+    current_app.conf['METRICS_SUMMARY'] = None
+
+
+@task_prerun.connect
+def start_task_metrics(task_id, task, *args, **kwargs):
+    serve_metrics()
+    task.request.metrics_started_at = time.monotonic()
+
+
+@task_postrun.connect
+def finish_task_metrics(task_id, task, *args, state=None, **kwargs):
+    """Measure the task, and log a summary of metrics every
+    ``METRICS_LOG_INTERVAL`` (60) seconds.
+
+    """
+    started_at = getattr(task.request, 'metrics_started_at', None)
+    if started_at is not None:
+        TASK_SECONDS.observe(time.monotonic() - started_at,
+                             task=task.name, state=state or 'UNKNOWN')
+    config = current_app.conf
+    interval = config.get('METRICS_LOG_INTERVAL', 60)
+    previous = config.get('METRICS_SUMMARY')
+    if not interval:
+        return
+    elif previous is None:
+        config['METRICS_SUMMARY'] = summarize()[1]
+    elif time.monotonic() - previous[0] >= interval:
+        summary, config['METRICS_SUMMARY'] = summarize(previous)
+        if summary:
+            logging.getLogger(__name__ + '.metrics').info('%s', summary)
+
+
 def get_raven_client() -> Client:
     """Get a raven client.
 
@@ -228,6 +295,6 @@ def setup_raven_logging(conf=None, **kwargs):
 
 @task_failure.connect
 def report_task_failure(task_id, exception, args, kwargs,
-                        traceback, einfo, sender):
+                        traceback, einfo, sender, **kw):
     client = get_raven_client()
     client.captureException(einfo.exc_info)
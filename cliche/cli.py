@@ -22,6 +22,10 @@ from .config import read_config
 from .name import Name
 from .orm import Base, downgrade_database, upgrade_database
 from .services.align import alignment
+from .services.tvtropes.aiocrawler import Crawler as TvtropesCrawler
+from .services.tvtropes.archive import Archive as TvtropesArchive
+from .services.tvtropes.crawler import reparse_archive
+from .services.wikipedia.dump import import_dump as import_dbpedia_dump
 from .sqltypes import HashableLocale
 from .web.app import (app as flask_app,
                       setup_sentry as flask_setup_sentry)
@@ -148,6 +152,55 @@ def sync(service):  # FIXME available service listing
         sync.delay()
 
 
+@cli.command('crawl-tvtropes')
+@argument('urls', nargs=-1)
+@option('--concurrency', '-n', type=int, default=100,
+        help='The maximum number of requests in flight.  [default: 100]')
+@option('--rate', '-r', type=float,
+        help='The maximum number of requests per second per host unless '
+             'RATE_LIMITS configures the host.  [default: 1]')
+@config
+def crawl_tvtropes(urls, concurrency, rate):
+    """Crawl TVTropes in this process using asyncio, from URLS if given."""
+    with flask_app.app_context():
+        # the crawler uses the session in its own database thread, where
+        # the application context isn't available
+        crawler = TvtropesCrawler(session._get_current_object(),
+                                  concurrency=concurrency, rate=rate)
+        crawled = crawler.run(urls or None)
+    echo('{} pages were crawled.'.format(crawled))
+
+
+@cli.command('reparse-tvtropes')
+@option('--archive', '-a', type=Path(exists=True, file_okay=False),
+        help='The archive directory.  [default: TVTROPES_ARCHIVE_PATH]')
+@config
+def reparse_tvtropes(archive):
+    """Rebuild TVTropes relations from archived pages, offline."""
+    archive = archive or celery_app.conf.get('TVTROPES_ARCHIVE_PATH')
+    if not archive:
+        echo('The --archive option or TVTROPES_ARCHIVE_PATH configuration '
+             'is required.', file=sys.stderr)
+        raise SystemExit(1)
+    with flask_app.app_context():
+        parsed = reparse_archive(session, TvtropesArchive(archive))
+    echo('{} pages were parsed.'.format(parsed))
+
+
+@cli.command('import-dbpedia')
+@argument('dumps', nargs=-1, required=True,
+          type=Path(exists=True, dir_okay=False))
+@option('--batch-size', '-b', type=int,
+        help='The number of rows per statement.  [default: 1000]')
+@config
+def import_dbpedia(dumps, batch_size):
+    """Import DBpedia N-Triples DUMPS (.nt, .nt.bz2, .nt.gz)."""
+    with flask_app.app_context():
+        types, properties = import_dbpedia_dump(session, dumps, batch_size)
+    echo('{} types and {} properties were imported.'
+         .format(types, properties))
+
+
 @cli.command()
 @config
 def align():
@@ -0,0 +1,416 @@
+""":mod:`cliche.metrics` --- Crawler throughput metrics
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Crawlers count requests, downloaded bytes, crawled pages and retries, and
+measure latencies of requests, parsing and database writes, using
+:class:`Counter` and :class:`Histogram` metrics of the current process::
+
+    with HTTP_SECONDS.time(service='tvtropes'):
+        response = session.get(url)
+    HTTP_BYTES.inc(len(response.content), service='tvtropes')
+
+Metrics are exported in the Prometheus_ text format by :func:`serve()`,
+and summarized by :func:`summarize()`.  Celery workers do both
+automatically (see :mod:`cliche.celery`) if they're configured:
+
+``METRICS_PORT``
+   The port to serve metrics on, e.g. ``9100``.  Every worker process
+   serves its own metrics on the port plus its process index, i.e.
+   ``http://127.0.0.1:9100/metrics``, ``http://127.0.0.1:9101/metrics``,
+   and so on.  Metrics are not served if it's not configured.
+
+``METRICS_ADDRESS``
+   The address to serve metrics on.  Default is ``'127.0.0.1'``.
+
+``METRICS_LOG_INTERVAL``
+   How often a summary of metrics is logged in seconds.  Default is 60.
+   A summary is never logged if it's 0.
+
+Prometheus computes rates e.g. pages per second from counters.
+
+.. _Prometheus: https://prometheus.io/
+
+"""
+import contextlib
+import http.server
+import math
+import socketserver
+import threading
+import time
+
+__all__ = ('DB_WRITE_SECONDS', 'HTTP_BYTES', 'HTTP_REQUESTS', 'HTTP_SECONDS',
+           'OPERATION_SECONDS', 'PAGES', 'PARSE_SECONDS', 'REGISTRY',
+           'RETRIES', 'ROWS', 'TASK_SECONDS', 'Counter', 'Histogram',
+           'Metric', 'Registry', 'serve', 'summarize')
+
+#: (:class:`tuple`) Upper bounds of buckets of latency histograms in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0, 120.0, math.inf)
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, value.replace('\\', r'\\')
+                                    .replace('\n', r'\n')
+                                    .replace('"', r'\"'))
+        for name, value in labels
+    ) + '}'
+
+
+class Metric(object):
+    """The base class of metrics.  Values are kept per combination of
+    label values, and are safe to update from several threads.
+
+    :param name: the metric name
+    :type name: :class:`str`
+    :param documentation: the description of the metric
+    :type documentation: :class:`str`
+    :param labelnames: names of labels
+    :type labelnames: :class:`collections.abc.Sequence`
+
+    """
+
+    #: (:class:`str`) The Prometheus metric type.
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get_key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{} takes labels {!r}, not {!r}'.format(
+                self.name, self.labelnames, tuple(labels)
+            ))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def clear(self):
+        """Drop every value of the metric."""
+        with self.lock:
+            self.values.clear()
+
+    def samples(self):
+        """Get samples of the metric.
+
+        :returns: triples of a sample name, pairs of label names and
+                  values, and the value
+        :rtype: :class:`list`
+
+        """
+        raise NotImplementedError('override samples() method')
+
+    def total(self):
+        """Get the total of the metric over every label value, for
+        summaries.
+
+        """
+        raise NotImplementedError('override total() method')
+
+    def render(self):
+        """Render the metric in the Prometheus text format.
+
+        :rtype: :class:`str`
+
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        lines.extend(
+            name + format_labels(labels) + ' ' + format_value(value)
+            for name, labels, value in self.samples()
+        )
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    """The metric which only increases, e.g. the number of requests."""
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Increase the value of the ``labels`` by ``amount``."""
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        """Get the value of the ``labels``."""
+        return self.values.get(self.get_key(labels), 0)
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return [(self.name, list(zip(self.labelnames, key)), value)
+                for key, value in values]
+
+    def total(self):
+        with self.lock:
+            return sum(self.values.values())
+
+
+class Histogram(Metric):
+    """The metric which counts observed values e.g. latencies in buckets.
+
+    :param buckets: upper bounds of buckets.  :const:`DEFAULT_BUCKETS` by
+                    default
+    :type buckets: :class:`collections.abc.Sequence`
+
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        buckets = sorted(buckets)
+        if buckets[-1] != math.inf:
+            buckets.append(math.inf)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """Observe the ``value`` of the ``labels``."""
+        key = self.get_key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, (None, 0.0))
+            if counts is None:
+                counts = [0] * len(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = counts, total + value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe seconds the block takes.  It can also decorate
+        functions::
+
+            @DB_WRITE_SECONDS.time(operation='save_relations')
+            def save_relations(session, links):
+                ...
+
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def get(self, **labels):
+        """Get the number and the sum of observed values of the ``labels``.
+
+        :rtype: :class:`tuple`
+
+        """
+        counts, total = self.values.get(self.get_key(labels), ((), 0.0))
+        return sum(counts), total
+
+    def samples(self):
+        with self.lock:
+            values = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self.values.items())
+        samples = []
+        for key, (counts, total) in values:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + '_bucket',
+                                labels + [('le', format_value(bound))],
+                                cumulative))
+            samples.append((self.name + '_sum', labels, total))
+            samples.append((self.name + '_count', labels, cumulative))
+        return samples
+
+    def total(self):
+        with self.lock:
+            values = list(self.values.values())
+        return (sum(sum(counts) for counts, _ in values),
+                sum(total for _, total in values))
+
+
+class Registry(object):
+    """The set of metrics to export together."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        """Add the ``metric`` to the registry, and return it."""
+        self.metrics.append(metric)
+        return metric
+
+    def clear(self):
+        """Drop every value of metrics, e.g. values inherited from
+        the parent process.
+
+        """
+        for metric in self.metrics:
+            metric.clear()
+
+    def render(self):
+        """Render every metric in the Prometheus text format.
+
+        :rtype: :class:`str`
+
+        """
+        return ''.join(metric.render() for metric in self.metrics)
+
+
+#: (:class:`Registry`) The registry of metrics of crawlers.
+REGISTRY = Registry()
+
+#: (:class:`Counter`) HTTP requests sent by crawlers, by the service and
+#: the status code (or ``'error'`` if no response).
+HTTP_REQUESTS = REGISTRY.register(Counter(
+    'cliche_http_requests_total', 'HTTP requests sent by crawlers.',
+    ['service', 'status']
+))
+
+#: (:class:`Counter`) Bytes of HTTP responses, by the service.
+HTTP_BYTES = REGISTRY.register(Counter(
+    'cliche_http_response_bytes_total', 'Bytes of HTTP responses.',
+    ['service']
+))
+
+#: (:class:`Histogram`) Latencies of HTTP requests, by the service.
+HTTP_SECONDS = REGISTRY.register(Histogram(
+    'cliche_http_request_duration_seconds', 'Latencies of HTTP requests.',
+    ['service']
+))
+
+#: (:class:`Counter`) Retried requests, by the service.
+RETRIES = REGISTRY.register(Counter(
+    'cliche_retries_total', 'Retried requests.', ['service']
+))
+
+#: (:class:`Counter`) Crawled pages, by the service.
+PAGES = REGISTRY.register(Counter(
+    'cliche_crawled_pages_total', 'Crawled pages.', ['service']
+))
+
+#: (:class:`Counter`) Fetched result rows, by the service.
+ROWS = REGISTRY.register(Counter(
+    'cliche_fetched_rows_total', 'Fetched result rows.', ['service']
+))
+
+#: (:class:`Histogram`) Seconds to parse pages, by the service.
+PARSE_SECONDS = REGISTRY.register(Histogram(
+    'cliche_parse_duration_seconds', 'Seconds to parse pages.', ['service']
+))
+
+#: (:class:`Histogram`) Seconds of database writes, by the operation.
+DB_WRITE_SECONDS = REGISTRY.register(Histogram(
+    'cliche_db_write_duration_seconds', 'Seconds of database writes.',
+    ['operation']
+))
+
+#: (:class:`Histogram`) Seconds of crawler operations including retries,
+#: by the operation.
+OPERATION_SECONDS = REGISTRY.register(Histogram(
+    'cliche_operation_duration_seconds',
+    'Seconds of crawler operations including retries.',
+    ['operation']
+))
+
+#: (:class:`Histogram`) Seconds of Celery tasks, by the task name and
+#: the state it ended in.
+TASK_SECONDS = REGISTRY.register(Histogram(
+    'cliche_task_duration_seconds', 'Seconds of Celery tasks.',
+    ['task', 'state']
+))
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    registry = REGISTRY
+
+    def do_GET(self):
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; '
+                                         'charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+
+    daemon_threads = True
+
+
+def serve(port, address='127.0.0.1', registry=REGISTRY):
+    """Serve metrics of the ``registry`` in the Prometheus text format
+    from a daemon thread.
+
+    :param port: the port to listen
+    :type port: :class:`int`
+    :param address: the address to listen
+    :type address: :class:`str`
+    :param registry: the registry to export
+    :type registry: :class:`Registry`
+    :returns: the running server.  call its
+              :meth:`~socketserver.BaseServer.shutdown()` method to stop
+    :rtype: :class:`http.server.HTTPServer`
+    :raise OSError: if the port can't be listened
+
+    """
+    handler = type('MetricsHandler', (MetricsHandler,),
+                   {'registry': registry})
+    server = MetricsServer((address, port), handler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='metrics-exporter', daemon=True)
+    thread.start()
+    return server
+
+
+def summarize(previous=None, registry=REGISTRY):
+    """Summarize metrics of the ``registry`` in a line, e.g. to log it
+    periodically.  Counters are summed over labels, and histograms are
+    summarized into the number and the mean of observed values.
+
+    :param previous: the state returned by the previous call, to show
+                     rates of counters since then
+    :param registry: the registry to summarize
+    :type registry: :class:`Registry`
+    :returns: the summary, and the state to pass to the next call
+    :rtype: :class:`tuple`
+
+    """
+    current_time = time.monotonic()
+    totals = {metric.name: metric.total() for metric in registry.metrics}
+    if previous is None:
+        previous_time, previous_totals = current_time, {}
+    else:
+        previous_time, previous_totals = previous
+    elapsed = current_time - previous_time
+    parts = []
+    for metric in registry.metrics:
+        total = totals[metric.name]
+        if isinstance(metric, Histogram):
+            count, seconds = total
+            if count:
+                parts.append('{} {} (mean {:.3f}s)'.format(
+                    metric.name, count, seconds / count
+                ))
+        elif total:
+            part = '{} {:g}'.format(metric.name, total)
+            if elapsed > 0:
+                rate = (total - previous_totals.get(metric.name, 0)) / elapsed
+                part += ' ({:.2f}/s)'.format(rate)
+            parts.append(part)
+    return ', '.join(parts), (current_time, totals)
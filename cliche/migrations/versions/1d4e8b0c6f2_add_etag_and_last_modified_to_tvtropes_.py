@@ -0,0 +1,26 @@
+"""add etag and last_modified to tvtropes_entities
+
+Revision ID: 1d4e8b0c6f2
+Revises: 2b7f3d9e0a4
+Create Date: 2026-10-18 11:02:47.730254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1d4e8b0c6f2'
+down_revision = '2b7f3d9e0a4'
+
+
+def upgrade():
+    op.add_column('tvtropes_entities',
+                  sa.Column('etag', sa.String(), nullable=True))
+    op.add_column('tvtropes_entities',
+                  sa.Column('last_modified', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('tvtropes_entities', 'last_modified')
+    op.drop_column('tvtropes_entities', 'etag')
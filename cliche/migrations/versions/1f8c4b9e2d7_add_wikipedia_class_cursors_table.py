@@ -0,0 +1,27 @@
+"""add wikipedia_class_cursors table
+
+Revision ID: 1f8c4b9e2d7
+Revises: 6e3a0c7d1b4
+Create Date: 2026-10-18 16:40:13.902716
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1f8c4b9e2d7'
+down_revision = '6e3a0c7d1b4'
+
+
+def upgrade():
+    op.create_table(
+        'wikipedia_class_cursors',
+        sa.Column('classes', sa.String(), nullable=False),
+        sa.Column('revision', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('classes')
+    )
+
+
+def downgrade():
+    op.drop_table('wikipedia_class_cursors')
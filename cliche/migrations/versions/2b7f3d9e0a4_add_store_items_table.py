@@ -0,0 +1,35 @@
+"""add store_items table
+
+Revision ID: 2b7f3d9e0a4
+Revises: 4f96f94d94
+Create Date: 2026-10-18 10:12:31.402117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2b7f3d9e0a4'
+down_revision = '4f96f94d94'
+
+
+def upgrade():
+    op.create_table(
+        'store_items',
+        sa.Column('bucket', sa.String(), nullable=False),
+        sa.Column('key', sa.String(), nullable=False),
+        sa.Column('value', sa.UnicodeText(), nullable=True),
+        sa.Column('expires_at', sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint('bucket', 'key')
+    )
+    op.create_index(op.f('ix_store_items_expires_at'),
+                    'store_items',
+                    ['expires_at'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_store_items_expires_at'),
+                  table_name='store_items')
+    op.drop_table('store_items')
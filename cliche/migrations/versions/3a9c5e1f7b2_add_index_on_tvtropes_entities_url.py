@@ -0,0 +1,24 @@
+"""add index on tvtropes_entities.url
+
+Revision ID: 3a9c5e1f7b2
+Revises: 1d4e8b0c6f2
+Create Date: 2026-10-18 13:20:05.118342
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3a9c5e1f7b2'
+down_revision = '1d4e8b0c6f2'
+
+
+def upgrade():
+    # not unique: a page whose title changed can leave an old entity
+    # with the same url behind.
+    op.create_index('ix_tvtropes_entities_url', 'tvtropes_entities', ['url'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_tvtropes_entities_url', 'tvtropes_entities')
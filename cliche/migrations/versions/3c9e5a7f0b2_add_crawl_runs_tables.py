@@ -0,0 +1,49 @@
+"""add crawl_runs and crawl_run_items tables
+
+Revision ID: 3c9e5a7f0b2
+Revises: 1f8c4b9e2d7
+Create Date: 2026-10-18 18:05:47.310582
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9e5a7f0b2'
+down_revision = '1f8c4b9e2d7'
+
+
+def upgrade():
+    op.create_table(
+        'crawl_runs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('service', sa.String(), nullable=False),
+        sa.Column('started_at', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('finished_at', sa.DateTime(timezone=True), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_crawl_runs_service'),
+                    'crawl_runs',
+                    ['service'],
+                    unique=False)
+    op.create_table(
+        'crawl_run_items',
+        sa.Column('run_id', sa.Integer(), nullable=False),
+        sa.Column('partition', sa.String(), nullable=False),
+        sa.Column('page', sa.Integer(), nullable=True),
+        sa.Column('status', sa.String(), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('started_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('finished_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('error', sa.UnicodeText(), nullable=True),
+        sa.ForeignKeyConstraint(['run_id'], ['crawl_runs.id']),
+        sa.PrimaryKeyConstraint('run_id', 'partition')
+    )
+
+
+def downgrade():
+    op.drop_table('crawl_run_items')
+    op.drop_index(op.f('ix_crawl_runs_service'), table_name='crawl_runs')
+    op.drop_table('crawl_runs')
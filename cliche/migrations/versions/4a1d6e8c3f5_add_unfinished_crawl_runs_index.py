@@ -0,0 +1,27 @@
+"""add unique index of unfinished crawl_runs
+
+Revision ID: 4a1d6e8c3f5
+Revises: 3c9e5a7f0b2
+Create Date: 2026-10-18 21:12:03.528817
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4a1d6e8c3f5'
+down_revision = '3c9e5a7f0b2'
+
+
+def upgrade():
+    op.create_index('ix_crawl_runs_unfinished',
+                    'crawl_runs',
+                    ['service'],
+                    unique=True,
+                    postgresql_where=sa.text('finished_at IS NULL'),
+                    sqlite_where=sa.text('finished_at IS NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_crawl_runs_unfinished', table_name='crawl_runs')
@@ -0,0 +1,28 @@
+"""add rate_limit_buckets table
+
+Revision ID: 4c1e8a2d9f3
+Revises: 3a9c5e1f7b2
+Create Date: 2026-10-18 14:05:42.906311
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c1e8a2d9f3'
+down_revision = '3a9c5e1f7b2'
+
+
+def upgrade():
+    op.create_table(
+        'rate_limit_buckets',
+        sa.Column('host', sa.String(), nullable=False),
+        sa.Column('tokens', sa.Float(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint('host')
+    )
+
+
+def downgrade():
+    op.drop_table('rate_limit_buckets')
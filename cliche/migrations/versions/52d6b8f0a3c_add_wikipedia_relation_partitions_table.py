@@ -0,0 +1,29 @@
+"""add wikipedia_relation_partitions table
+
+Revision ID: 52d6b8f0a3c
+Revises: 4c1e8a2d9f3
+Create Date: 2026-10-18 15:31:09.254870
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '52d6b8f0a3c'
+down_revision = '4c1e8a2d9f3'
+
+
+def upgrade():
+    op.create_table(
+        'wikipedia_relation_partitions',
+        sa.Column('low', sa.Integer(), nullable=False),
+        sa.Column('high', sa.Integer(), nullable=False),
+        sa.Column('cursor', sa.Integer(), nullable=False),
+        sa.Column('completed_at', sa.DateTime(timezone=True), nullable=True),
+        sa.PrimaryKeyConstraint('low', 'high')
+    )
+
+
+def downgrade():
+    op.drop_table('wikipedia_relation_partitions')
@@ -0,0 +1,25 @@
+"""add open_until to rate_limit_buckets
+
+Revision ID: 6e3a0c7d1b4
+Revises: 52d6b8f0a3c
+Create Date: 2026-10-18 16:02:47.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e3a0c7d1b4'
+down_revision = '52d6b8f0a3c'
+
+
+def upgrade():
+    op.add_column(
+        'rate_limit_buckets',
+        sa.Column('open_until', sa.DateTime(timezone=True), nullable=True)
+    )
+
+
+def downgrade():
+    op.drop_column('rate_limit_buckets', 'open_until')
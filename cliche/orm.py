@@ -30,14 +30,18 @@ from alembic.command import downgrade, stamp
 from alembic.config import Config
 from alembic.environment import EnvironmentContext
 from alembic.script import ScriptDirectory
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.engine.base import Engine
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql.expression import literal_column
+from sqlalchemy.sql.expression import (and_, bindparam, literal_column, or_,
+                                       select)
 
 __all__ = ('Base', 'Session', 'downgrade_database', 'get_alembic_config',
            'get_database_revision', 'import_all_modules',
-           'initialize_database', 'upgrade_database')
+           'initialize_database', 'insert_ignore', 'upgrade_database',
+           'upsert')
 
 
 #: SQLAlchemy declarative base class.
@@ -94,6 +98,205 @@ def make_repr(self):
 Base.__repr__ = make_repr
 
 
+def supports_on_conflict(connection):
+    """Whether the database supports PostgreSQL's ``ON CONFLICT`` clause
+    (PostgreSQL 9.5 or higher).
+
+    """
+    dialect = connection.dialect
+    return dialect.name == 'postgresql' and \
+        (dialect.server_version_info or (0,)) >= (9, 5)
+
+
+def get_key_columns(table, key_columns=None):
+    if key_columns is None:
+        return list(table.primary_key)
+    return [table.c[column] if isinstance(column, str) else column
+            for column in key_columns]
+
+
+def unique_rows(table, rows, key_columns=None):
+    """Drop ``rows`` of the same key except the last one."""
+    key_names = [column.name
+                 for column in get_key_columns(table, key_columns)]
+    unique = {}
+    for row in rows:
+        unique[tuple(row[name] for name in key_names)] = row
+    return unique
+
+
+def select_existing_keys(connection, table, keys, key_columns=None):
+    """Select keys among ``keys`` which are already in ``table``."""
+    key_columns = get_key_columns(table, key_columns)
+    existing = set()
+    keys = list(keys)
+    chunk_size = 100
+    for offset in range(0, len(keys), chunk_size):
+        chunk = keys[offset:offset + chunk_size]
+        condition = or_(*(
+            and_(*(column == value for column, value in zip(key_columns, key)))
+            for key in chunk
+        ))
+        existing.update(
+            tuple(row) for row in
+            connection.execute(select(key_columns).where(condition))
+        )
+    return existing
+
+
+def insert_ignore(session, table, rows):
+    """Insert ``rows`` into the ``table`` at once, skipping rows which
+    conflict with existing rows' primary key.  ::
+
+        insert_ignore(session, Relation.__table__, [
+            {'origin_namespace': 'Main', 'origin_name': 'God Job',
+             'destination_namespace': 'Film', 'destination_name': 'Iron Man'},
+            ...
+        ])
+
+    It's translated to ``INSERT ... ON CONFLICT DO NOTHING`` on PostgreSQL
+    and ``INSERT OR IGNORE`` on SQLite.  Other databases select existing
+    keys first.  Anyway it takes a few round trips regardless of the number
+    of rows.
+
+    :param session: a database session
+    :type session: :class:`Session`
+    :param table: the table to insert into
+    :type table: :class:`sqlalchemy.schema.Table`
+    :param rows: dictionaries of column names to values.  every row must
+                 have the same columns, including primary key columns
+    :type rows: :class:`collections.abc.Iterable`
+
+    """
+    rows = unique_rows(table, rows)
+    if not rows:
+        return
+    with session.begin(subtransactions=True):
+        connection = session.connection()
+        if supports_on_conflict(connection):
+            statement = postgresql.insert(table).on_conflict_do_nothing()
+        elif connection.dialect.name == 'sqlite':
+            statement = table.insert().prefix_with('OR IGNORE')
+        else:
+            for key in select_existing_keys(connection, table, rows):
+                del rows[key]
+            if not rows:
+                return
+            statement = table.insert()
+        connection.execute(statement, list(rows.values()))
+
+
+def upsert(session, table, rows, key_columns=None, update_columns=None):
+    """Insert ``rows`` into the ``table`` at once, or update rows of the
+    same key if they already exist.  ::
+
+        upsert(session, Entity.__table__, [
+            {'namespace': 'Main', 'name': 'God Job', 'type': 'Trope',
+             'url': 'http://tvtropes.org/pmwiki/pmwiki.php/Main/GodJob'},
+            ...
+        ])
+
+    It's translated to ``INSERT ... ON CONFLICT DO UPDATE`` on PostgreSQL.
+    Other databases select existing keys first, and then update and insert
+    rows in bulk.  If another transaction inserts some of the keys
+    meanwhile, they are updated instead.  Anyway it takes a few round trips
+    regardless of the number of rows.
+
+    :param session: a database session
+    :type session: :class:`Session`
+    :param table: the table to upsert into
+    :type table: :class:`sqlalchemy.schema.Table`
+    :param rows: dictionaries of column names to values.  every row must
+                 have the same columns, including key columns
+    :type rows: :class:`collections.abc.Iterable`
+    :param key_columns: columns of the primary key or an unique constraint
+                        to look up existing rows.  the primary key by
+                        default
+    :type key_columns: :class:`collections.abc.Sequence`
+    :param update_columns: names of columns to update if the row already
+                           exists.  every non-key column of ``rows`` by
+                           default
+    :type update_columns: :class:`collections.abc.Iterable`
+
+    """
+    key_columns = get_key_columns(table, key_columns)
+    rows = unique_rows(table, rows, key_columns)
+    if not rows:
+        return
+    key_names = [column.name for column in key_columns]
+    if update_columns is None:
+        update_columns = [name for name in next(iter(rows.values()))
+                          if name not in key_names]
+    else:
+        update_columns = list(update_columns)
+    if not update_columns:
+        insert_ignore(session, table, rows.values())
+        return
+    with session.begin(subtransactions=True):
+        connection = session.connection()
+        if supports_on_conflict(connection):
+            statement = postgresql.insert(table)
+            statement = statement.on_conflict_do_update(
+                index_elements=key_columns,
+                set_={name: statement.excluded[name]
+                      for name in update_columns}
+            )
+            connection.execute(statement, list(rows.values()))
+            return
+        pending = rows
+        while pending:
+            existing = select_existing_keys(connection, table, pending,
+                                            key_columns)
+            update_rows(connection, table, [pending[key] for key in existing],
+                        key_columns, update_columns)
+            pending = {key: row for key, row in pending.items()
+                       if key not in existing}
+            if not pending:
+                return
+            if connection.dialect.name == 'sqlite':
+                # pysqlite can't roll back to a savepoint.  rows inserted by
+                # another transaction meanwhile are ignored, and updated
+                # instead
+                connection.execute(table.insert().prefix_with('OR IGNORE'),
+                                   list(pending.values()))
+                update_rows(connection, table, pending.values(),
+                            key_columns, update_columns)
+                return
+            try:
+                with session.begin_nested():
+                    connection.execute(table.insert(), list(pending.values()))
+            except IntegrityError:
+                # another transaction inserted some of the keys meanwhile;
+                # select them again to update them instead
+                continue
+            return
+
+
+def update_rows(connection, table, rows, key_columns, update_columns):
+    """Update ``update_columns`` of ``rows`` in bulk, looking them up by
+    ``key_columns``.
+
+    """
+    rows = list(rows)
+    if not rows:
+        return
+    key_names = [column.name for column in key_columns]
+    # bind parameter names must differ from column names
+    update = table.update().where(and_(*(
+        column == bindparam('key_' + column.name)
+        for column in key_columns
+    ))).values({
+        name: bindparam('value_' + name) for name in update_columns
+    })
+    connection.execute(update, [
+        dict(
+            {'key_' + name: row[name] for name in key_names},
+            **{'value_' + name: row[name] for name in update_columns}
+        )
+        for row in rows
+    ])
+
+
 def get_alembic_config(engine):
     """Creates a configuration for :mod:`alembic`.
     You can pass an :class:`~sqlalchemy.engine.base.Engine` object or
@@ -232,15 +435,23 @@ def import_all_modules(dry_run=False):  # FIXME
     import cliche.celery
     import cliche.cli
     import cliche.config
+    import cliche.metrics
     import cliche.name
     import cliche.orm
     import cliche.people
     import cliche.services
+    import cliche.services.ratelimit
+    import cliche.services.runs
+    import cliche.services.store
     import cliche.services.tvtropes
+    import cliche.services.tvtropes.aiocrawler
+    import cliche.services.tvtropes.archive
     import cliche.services.tvtropes.crawler
     import cliche.services.tvtropes.entities
     import cliche.services.wikipedia
     import cliche.services.wikipedia.crawler
+    import cliche.services.wikipedia.dump
+    import cliche.services.wikipedia.sparql
     import cliche.services.wikipedia.work
     import cliche.sqltypes
     import cliche.web
@@ -252,15 +463,23 @@ def import_all_modules(dry_run=False):  # FIXME
         'cliche.celery',
         'cliche.cli',
         'cliche.config',
+        'cliche.metrics',
         'cliche.name',
         'cliche.orm',
         'cliche.people',
         'cliche.services',
+        'cliche.services.ratelimit',
+        'cliche.services.runs',
+        'cliche.services.store',
         'cliche.services.tvtropes',
+        'cliche.services.tvtropes.aiocrawler',
+        'cliche.services.tvtropes.archive',
         'cliche.services.tvtropes.crawler',
         'cliche.services.tvtropes.entities',
         'cliche.services.wikipedia',
         'cliche.services.wikipedia.crawler',
+        'cliche.services.wikipedia.dump',
+        'cliche.services.wikipedia.sparql',
         'cliche.services.wikipedia.work',
         'cliche.sqltypes',
         'cliche.web',
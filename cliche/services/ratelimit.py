@@ -0,0 +1,382 @@
+""":mod:`cliche.services.ratelimit` --- Per-host politeness for crawlers
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Crawlers call :func:`throttle()` before every request, and it blocks until
+the host of the request can take one more request.  Each host has its own
+token bucket which is filled at a steady rate, so that crawlers run at
+the maximum sustainable rate instead of being bursty and then blocked.
+
+Rates are configured by ``RATE_LIMITS``, the mapping of host names to
+the number of requests per second, or to mappings of ``rate`` and
+``burst`` (the maximum number of requests at once, ``rate`` by default):
+
+.. code-block:: yaml
+
+   rate_limits:
+     tvtropes.org: 5
+     dbpedia.org:
+       rate: 2
+       burst: 10
+
+A host name also applies to its subdomains.  Hosts not configured are
+not limited at all.
+
+A host can also be paused entirely for a while, i.e. a circuit breaker,
+when it keeps failing (see :func:`trip()` and :func:`tripped_until()`).
+Hosts can be paused whether they're limited or not.
+
+Buckets and pauses are shared through a backend, chosen by
+``RATE_LIMIT_BACKEND``:
+
+``'local'`` (default)
+   :class:`LocalBackend` shares buckets among threads of the current
+   process only.  Rates are per worker process then.
+
+``'database'``
+   :class:`DatabaseBackend` keeps buckets in the :class:`RateLimitBucket`
+   table, so that every worker shares them.
+
+"""
+import datetime
+import threading
+import time
+import urllib.parse
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import Column
+from sqlalchemy.types import DateTime, Float, String
+
+from ..celery import app, get_session
+from ..orm import Base
+
+__all__ = ('Backend', 'DatabaseBackend', 'LocalBackend', 'RateLimitBucket',
+           'get_backend', 'get_rate_limit', 'refill', 'reserve', 'throttle',
+           'trip', 'tripped_until')
+
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def as_utc(time):
+    """Assume the naive ``time`` is in UTC, since some databases e.g.
+    SQLite don't keep time zones.
+
+    """
+    if time is not None and time.tzinfo is None:
+        return time.replace(tzinfo=datetime.timezone.utc)
+    return time
+
+
+def get_rate_limit(host):
+    """Get the rate limit of the ``host`` configured by ``RATE_LIMITS``.
+
+    :param host: the host name
+    :type host: :class:`str`
+    :returns: a pair of ``(rate, burst)``, or :const:`None` if the host
+              is not limited
+    :rtype: :class:`tuple`
+
+    """
+    limits = app.conf.get('RATE_LIMITS') or {}
+    labels = host.lower().split('.')
+    for i in range(len(labels)):
+        try:
+            limit = limits['.'.join(labels[i:])]
+        except KeyError:
+            continue
+        if isinstance(limit, dict):
+            rate = float(limit['rate'])
+            burst = float(limit.get('burst', rate))
+        else:
+            rate = burst = float(limit)
+        return rate, max(1.0, burst)
+
+
+def refill(tokens, updated_at, current_time, rate, burst):
+    """Take a token from a bucket, and compute the new state of the bucket.
+
+    Tokens can go below zero; it means requests are already waiting for
+    the bucket, and the new request has to wait until every earlier one
+    is done.  So waiting happens outside of the bucket lock.
+
+    :param tokens: the number of tokens in the bucket
+    :type tokens: :class:`float`
+    :param updated_at: the last time the bucket was updated in seconds
+    :type updated_at: :class:`float`
+    :param current_time: the current time in seconds
+    :type current_time: :class:`float`
+    :param rate: how many tokens are filled per second
+    :type rate: :class:`float`
+    :param burst: the maximum number of tokens
+    :type burst: :class:`float`
+    :returns: the new number of tokens, and how many seconds to wait before
+              sending the request
+    :rtype: :class:`tuple`
+
+    """
+    elapsed = max(0.0, current_time - updated_at)
+    tokens = min(burst, tokens + elapsed * rate) - 1
+    return tokens, max(0.0, -tokens / rate)
+
+
+class Backend(object):
+    """The interface of rate limit backends, which share token buckets."""
+
+    def reserve(self, host, rate, burst):
+        """Take a token from the bucket of the ``host``, and return how
+        many seconds the caller has to wait before sending the request.
+
+        :param host: the host name
+        :type host: :class:`str`
+        :param rate: how many tokens are filled per second
+        :type rate: :class:`float`
+        :param burst: the maximum number of tokens
+        :type burst: :class:`float`
+        :returns: seconds to wait
+        :rtype: :class:`float`
+
+        """
+        raise NotImplementedError('override reserve() method')
+
+    def trip(self, host, until):
+        """Pause the ``host`` until the given time.  An earlier pause than
+        the current one is ignored.
+
+        :param host: the host name
+        :type host: :class:`str`
+        :param until: the time to resume
+        :type until: :class:`datetime.datetime`
+
+        """
+        raise NotImplementedError('override trip() method')
+
+    def get_tripped(self, host):
+        """Get the time the ``host`` is paused until.
+
+        :param host: the host name
+        :type host: :class:`str`
+        :returns: the time, or :const:`None` if it was never paused.
+                  it can be in the past
+        :rtype: :class:`datetime.datetime`
+
+        """
+        raise NotImplementedError('override get_tripped() method')
+
+
+class LocalBackend(Backend):
+    """The backend which shares buckets among threads of the current
+    process.
+
+    """
+
+    #: (:class:`dict`) The mapping of host names to pairs of tokens and
+    #: the last updated time.
+    buckets = {}
+
+    #: (:class:`dict`) The mapping of host names to the time they are
+    #: paused until.
+    circuits = {}
+
+    #: (:class:`threading.Lock`) The lock of :attr:`buckets` and
+    #: :attr:`circuits`.
+    lock = threading.Lock()
+
+    def reserve(self, host, rate, burst):
+        with self.lock:
+            current_time = time.monotonic()
+            tokens, updated_at = self.buckets.get(host, (burst, current_time))
+            tokens, wait = refill(tokens, updated_at, current_time,
+                                  rate, burst)
+            self.buckets[host] = tokens, current_time
+        return wait
+
+    def trip(self, host, until):
+        with self.lock:
+            current = self.circuits.get(host)
+            if current is None or current < until:
+                self.circuits[host] = until
+
+    def get_tripped(self, host):
+        return self.circuits.get(host)
+
+
+class RateLimitBucket(Base):
+    """A token bucket of :class:`DatabaseBackend`."""
+
+    #: (:class:`str`) The host name.
+    host = Column(String, primary_key=True)
+
+    #: (:class:`float`) The number of tokens.  Negative if requests are
+    #: waiting.
+    tokens = Column(Float, nullable=False)
+
+    #: (:class:`datetime.datetime`) The last time tokens were taken.
+    updated_at = Column(DateTime(timezone=True), nullable=False)
+
+    #: (:class:`datetime.datetime`) The time the host is paused until.
+    #: See also :func:`trip()`.
+    open_until = Column(DateTime(timezone=True))
+
+    __tablename__ = 'rate_limit_buckets'
+    __repr_columns__ = host, tokens, updated_at
+
+
+class DatabaseBackend(Backend):
+    """The backend which keeps buckets in :class:`RateLimitBucket` table,
+    so that every worker shares them.  Buckets are locked using
+    ``SELECT ... FOR UPDATE`` while tokens are taken.
+
+    :param session: a database session.  the session of the current task
+                    by default
+    :type session: :class:`~cliche.orm.Session`
+
+    """
+
+    def __init__(self, session=None):
+        self.session = session
+
+    def reserve(self, host, rate, burst):
+        session = self.session or get_session()
+        try:
+            return self._reserve(session, host, rate, burst)
+        except IntegrityError:
+            # another worker created the bucket at the same time.
+            return self._reserve(session, host, rate, burst)
+
+    def _reserve(self, session, host, rate, burst):
+        with session.begin():
+            current_time = now()
+            bucket = session.query(RateLimitBucket) \
+                            .filter_by(host=host) \
+                            .with_for_update() \
+                            .first()
+            if bucket is None:
+                bucket = RateLimitBucket(host=host, tokens=burst,
+                                         updated_at=current_time)
+                session.add(bucket)
+            bucket.tokens, wait = refill(
+                bucket.tokens,
+                as_utc(bucket.updated_at).timestamp(),
+                current_time.timestamp(),
+                rate, burst
+            )
+            bucket.updated_at = current_time
+        return wait
+
+    def trip(self, host, until):
+        session = self.session or get_session()
+        try:
+            self._trip(session, host, until)
+        except IntegrityError:
+            self._trip(session, host, until)
+
+    def _trip(self, session, host, until):
+        with session.begin():
+            bucket = session.query(RateLimitBucket) \
+                            .filter_by(host=host) \
+                            .with_for_update() \
+                            .first()
+            if bucket is None:
+                bucket = RateLimitBucket(host=host, tokens=0.0,
+                                         updated_at=now())
+                session.add(bucket)
+            current = as_utc(bucket.open_until)
+            if current is None or current < until:
+                bucket.open_until = until
+
+    def get_tripped(self, host):
+        session = self.session or get_session()
+        until = session.query(RateLimitBucket.open_until) \
+                       .filter_by(host=host) \
+                       .scalar()
+        return as_utc(until)
+
+
+def get_backend(session=None):
+    """Get the backend configured by ``RATE_LIMIT_BACKEND``.
+
+    :param session: a database session for :class:`DatabaseBackend`.
+                    the session of the current task by default
+    :type session: :class:`~cliche.orm.Session`
+    :returns: a rate limit backend
+    :rtype: :class:`Backend`
+
+    """
+    backend = app.conf.get('RATE_LIMIT_BACKEND', 'local')
+    if backend == 'local':
+        return LocalBackend()
+    elif backend == 'database':
+        return DatabaseBackend(session)
+    raise ValueError('unknown RATE_LIMIT_BACKEND: ' + repr(backend))
+
+
+def reserve(url, default=None, backend=None):
+    """Take a token for a request to the host of the ``url``, and return
+    how many seconds the caller has to wait before sending it.  Unlike
+    :func:`throttle()` it doesn't block, e.g. for event loops.
+
+    :param url: the url to request
+    :type url: :class:`str`
+    :param default: a pair of ``(rate, burst)`` for the host not
+                    configured by ``RATE_LIMITS``.  not limited by default
+    :type default: :class:`tuple`
+    :param backend: the backend.  :func:`get_backend()` by default
+    :type backend: :class:`Backend`
+    :returns: seconds to wait
+    :rtype: :class:`float`
+
+    """
+    host = urllib.parse.urlparse(url).hostname
+    if not host:
+        return 0.0
+    limit = get_rate_limit(host) or default
+    if limit is None:
+        return 0.0
+    if backend is None:
+        backend = get_backend()
+    return backend.reserve(host, *limit)
+
+
+def throttle(url):
+    """Block until a request to the host of the ``url`` is allowed by
+    ``RATE_LIMITS``.
+
+    :param url: the url to request
+    :type url: :class:`str`
+    :returns: how many seconds it waited
+    :rtype: :class:`float`
+
+    """
+    wait = reserve(url)
+    if wait > 0:
+        time.sleep(wait)
+    return wait
+
+
+def trip(url, duration):
+    """Pause requests to the host of the ``url`` for the ``duration``,
+    e.g. when it keeps failing.  Every worker sharing the backend sees it
+    through :func:`tripped_until()`.
+
+    :param url: the url of the host
+    :type url: :class:`str`
+    :param duration: how long to pause
+    :type duration: :class:`datetime.timedelta`
+
+    """
+    get_backend().trip(urllib.parse.urlparse(url).hostname, now() + duration)
+
+
+def tripped_until(url):
+    """Get the time requests to the host of the ``url`` are paused until.
+
+    :param url: the url of the host
+    :type url: :class:`str`
+    :returns: the time, or :const:`None` if it's not paused
+    :rtype: :class:`datetime.datetime`
+
+    """
+    until = get_backend().get_tripped(urllib.parse.urlparse(url).hostname)
+    if until is not None and until > now():
+        return until
@@ -0,0 +1,342 @@
+""":mod:`cliche.services.runs` --- Crawl progress ledger
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Every :func:`~cliche.services.tvtropes.crawler.crawl()` and
+:func:`~cliche.services.wikipedia.crawler.crawl()` belongs to a run of its
+service (:class:`CrawlRun`), and tasks of the run record the status of
+each partition of work they take, e.g. a url or a range of revisions
+(:class:`CrawlRunItem`)::
+
+    run_id, resumed = begin_run(session, 'tvtropes')
+    add_items(session, run_id, urls)
+    ...
+    with track(session, run_id, url):
+        crawl(url)
+
+A run is finished when every partition of it is done, or failed
+``CRAWL_RUN_MAX_ATTEMPTS`` (3) times.  Until then :func:`begin_run()`
+resumes the run instead of starting a new one, and :func:`resume_items()`
+finds partitions which are left behind, e.g. by a worker crash or
+a redeploy, so that only unfinished work is done again.  Partitions
+should be added after their tasks are queued, so that a partition is
+never left without a task.
+
+"""
+import contextlib
+import datetime
+import traceback
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import Column, ForeignKey, Index
+from sqlalchemy.sql.expression import and_, case
+from sqlalchemy.types import DateTime, Integer, String, UnicodeText
+
+from ..celery import app
+from ..orm import Base, insert_ignore
+
+__all__ = ('DONE', 'FAILED', 'PENDING', 'RUNNING', 'CrawlRun', 'CrawlRunItem',
+           'add_items', 'begin_run', 'format_error', 'record', 'resume_items',
+           'track')
+
+#: (:class:`str`) The status of a partition which is not started yet.
+PENDING = 'pending'
+
+#: (:class:`str`) The status of a partition which is being crawled.
+RUNNING = 'running'
+
+#: (:class:`str`) The status of a partition which is completely crawled.
+DONE = 'done'
+
+#: (:class:`str`) The status of a partition whose last attempt failed.
+FAILED = 'failed'
+
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class CrawlRun(Base):
+    """A run of a crawler service."""
+
+    #: (:class:`int`) The run id.
+    id = Column(Integer, primary_key=True)
+
+    #: (:class:`str`) The service name e.g. ``'tvtropes'``.
+    service = Column(String, nullable=False, index=True)
+
+    #: (:class:`datetime.datetime`) The time the run started.
+    started_at = Column(DateTime(timezone=True), nullable=False)
+
+    #: (:class:`datetime.datetime`) The time the run was found to be
+    #: finished.  :const:`None` if it's not finished yet.
+    finished_at = Column(DateTime(timezone=True))
+
+    __tablename__ = 'crawl_runs'
+    __table_args__ = (
+        # only one run of a service can be unfinished at a time
+        Index('ix_crawl_runs_unfinished', service, unique=True,
+              postgresql_where=finished_at.is_(None),
+              sqlite_where=finished_at.is_(None)),
+    )
+    __repr_columns__ = id, service, started_at, finished_at
+
+
+class CrawlRunItem(Base):
+    """The status of a partition of a :class:`CrawlRun`."""
+
+    #: (:class:`int`) The id of the run.
+    run_id = Column(Integer, ForeignKey(CrawlRun.id), primary_key=True)
+
+    #: (:class:`str`) The partition of work e.g. a url.
+    partition = Column(String, primary_key=True)
+
+    #: (:class:`int`) The last page of the partition which was started,
+    #: e.g. the revision cursor.  :const:`None` if it's not paged.
+    page = Column(Integer)
+
+    #: (:class:`str`) One of :const:`PENDING`, :const:`RUNNING`,
+    #: :const:`DONE` and :const:`FAILED`.
+    status = Column(String, nullable=False)
+
+    #: (:class:`int`) The number of started attempts.
+    attempts = Column(Integer, nullable=False, default=0)
+
+    #: (:class:`datetime.datetime`) The time the last attempt started.
+    started_at = Column(DateTime(timezone=True))
+
+    #: (:class:`datetime.datetime`) The time the last attempt ended.
+    finished_at = Column(DateTime(timezone=True))
+
+    #: (:class:`datetime.datetime`) The last time the status changed.
+    updated_at = Column(DateTime(timezone=True), nullable=False)
+
+    #: (:class:`str`) The error of the last failed attempt.
+    error = Column(UnicodeText)
+
+    __tablename__ = 'crawl_run_items'
+    __repr_columns__ = run_id, partition, status, attempts
+
+
+def get_max_attempts():
+    return app.conf.get('CRAWL_RUN_MAX_ATTEMPTS', 3)
+
+
+def get_timeout():
+    return app.conf.get('CRAWL_RUN_TIMEOUT', datetime.timedelta(hours=6))
+
+
+def unfinished_items(session, run_id):
+    return session.query(CrawlRunItem).filter(
+        CrawlRunItem.run_id == run_id,
+        CrawlRunItem.status != DONE,
+        CrawlRunItem.attempts < get_max_attempts()
+    )
+
+
+def begin_run(session, service):
+    """Get the unfinished run of the ``service`` to resume, or start a new
+    run if the last run is finished.  When a new run starts, items of
+    earlier runs than the last one are purged.
+
+    A run without any items yet is resumed during ``CRAWL_RUN_TIMEOUT``
+    (6 hours) as well, because its items may be being added by another
+    :func:`begin_run()` caller.  The last run of the service is locked
+    while it's checked, and only one run of a service can be unfinished,
+    so overlapping callers never start two runs.
+
+    :param session: a database session
+    :type session: :class:`~cliche.orm.Session`
+    :param service: the service name e.g. ``'tvtropes'``
+    :type service: :class:`str`
+    :returns: the run id, and whether the run is resumed or not
+    :rtype: :class:`tuple`
+
+    """
+    try:
+        return _begin_run(session, service)
+    except IntegrityError:
+        # another caller has just started a run; resume it instead
+        return _begin_run(session, service)
+
+
+def _begin_run(session, service):
+    with session.begin():
+        run = session.query(CrawlRun) \
+                     .filter_by(service=service) \
+                     .order_by(CrawlRun.id.desc()) \
+                     .with_for_update() \
+                     .first()
+        if run is not None and run.finished_at is None:
+            if unfinished_items(session, run.id).first() is not None:
+                return run.id, True
+            items = session.query(CrawlRunItem).filter_by(run_id=run.id)
+            if items.first() is None and \
+               normalize_time(run.started_at) > now() - get_timeout():
+                return run.id, True
+            run.finished_at = now()
+            session.query(CrawlRunItem).filter(
+                CrawlRunItem.run_id.in_(
+                    session.query(CrawlRun.id).filter(
+                        CrawlRun.service == service,
+                        CrawlRun.id < run.id
+                    )
+                )
+            ).delete(synchronize_session=False)
+        run = CrawlRun(service=service, started_at=now())
+        session.add(run)
+        session.flush()
+        return run.id, False
+
+
+def normalize_time(time):
+    # SQLite gives naive datetimes back
+    if time.tzinfo is None:
+        return time.replace(tzinfo=datetime.timezone.utc)
+    return time
+
+
+def add_items(session, run_id, partitions):
+    """Add pending ``partitions`` to the run.  Partitions already in
+    the run are left as they are.
+
+    :param session: a database session
+    :type session: :class:`~cliche.orm.Session`
+    :param run_id: the run id.  nothing is recorded if it's :const:`None`
+    :type run_id: :class:`int`
+    :param partitions: partitions of work e.g. urls
+    :type partitions: :class:`collections.abc.Iterable`
+
+    """
+    if run_id is None:
+        return
+    current_time = now()
+    insert_ignore(session, CrawlRunItem.__table__, [
+        {'run_id': run_id, 'partition': partition, 'status': PENDING,
+         'attempts': 0, 'updated_at': current_time}
+        for partition in partitions
+    ])
+
+
+def record(session, run_id, partition, status, page=None, error=None):
+    """Record the ``status`` of the ``partition`` of the run.
+
+    Recording :const:`RUNNING` starts a new attempt unless the partition
+    is already running, so that a partition crawled page by page over
+    several calls keeps the start time of its first page.
+
+    :param session: a database session
+    :type session: :class:`~cliche.orm.Session`
+    :param run_id: the run id.  nothing is recorded if it's :const:`None`
+    :type run_id: :class:`int`
+    :param partition: the partition of work e.g. a url
+    :type partition: :class:`str`
+    :param status: one of :const:`PENDING`, :const:`RUNNING`,
+                   :const:`DONE` and :const:`FAILED`
+    :type status: :class:`str`
+    :param page: the page of the partition which is started
+    :type page: :class:`int`
+    :param error: the error message if it failed
+    :type error: :class:`str`
+
+    """
+    if run_id is None:
+        return
+    table = CrawlRunItem.__table__
+    current_time = now()
+    values = {'status': status, 'updated_at': current_time}
+    if page is not None:
+        values['page'] = page
+    if status == RUNNING:
+        running = table.c.status == RUNNING
+        values['attempts'] = case([(running, table.c.attempts)],
+                                  else_=table.c.attempts + 1)
+        values['started_at'] = case([(running, table.c.started_at)],
+                                    else_=current_time)
+        values['finished_at'] = values['error'] = None
+    elif status in (DONE, FAILED):
+        values['finished_at'] = current_time
+        values['error'] = error
+    with session.begin(subtransactions=True):
+        add_items(session, run_id, [partition])
+        session.execute(table.update().where(and_(
+            table.c.run_id == run_id,
+            table.c.partition == partition
+        )).values(values))
+
+
+@contextlib.contextmanager
+def track(session, run_id, partition, page=None):
+    """Record the ``partition`` of the run as running while the block is
+    running, and as done or failed after the block::
+
+        with track(session, run_id, url):
+            crawl(url)
+
+    The exception the block raised is recorded and raised again.
+
+    :param session: a database session
+    :type session: :class:`~cliche.orm.Session`
+    :param run_id: the run id.  nothing is recorded if it's :const:`None`
+    :type run_id: :class:`int`
+    :param partition: the partition of work e.g. a url
+    :type partition: :class:`str`
+    :param page: the page of the partition which is started
+    :type page: :class:`int`
+
+    """
+    record(session, run_id, partition, RUNNING, page)
+    try:
+        yield
+    except Exception as e:
+        record(session, run_id, partition, FAILED, error=format_error(e))
+        raise
+    record(session, run_id, partition, DONE)
+
+
+def format_error(error):
+    """Format the ``error`` exception to record."""
+    return ''.join(traceback.format_exception_only(type(error), error)) \
+             .strip()
+
+
+def resume_items(session, run_id, chunk_size=None):
+    """Find unfinished partitions of the run which were not updated during
+    ``CRAWL_RUN_TIMEOUT`` (6 hours), i.e. which are left behind by lost
+    tasks, and yield them in chunks.  It includes pending partitions whose
+    queued tasks were lost, e.g. by a broker purge or a worker crash with
+    prefetched tasks.  Yielded partitions become pending again, and their
+    timeout starts over, so that they are not resumed twice meanwhile.
+
+    :param session: a database session
+    :type session: :class:`~cliche.orm.Session`
+    :param run_id: the run id
+    :type run_id: :class:`int`
+    :param chunk_size: the maximum number of partitions per chunk.
+                       ``CRAWL_RUN_BATCH_SIZE`` (100) by default
+    :type chunk_size: :class:`int`
+    :returns: lists of partitions
+    :rtype: :class:`collections.abc.Iterator`
+
+    """
+    if chunk_size is None:
+        chunk_size = app.conf.get('CRAWL_RUN_BATCH_SIZE', 100)
+    query = unfinished_items(session, run_id) \
+        .filter(CrawlRunItem.updated_at <= now() - get_timeout()) \
+        .with_entities(CrawlRunItem.partition) \
+        .order_by(CrawlRunItem.partition)
+    last = None
+    while True:
+        chunk = query
+        if last is not None:
+            chunk = chunk.filter(CrawlRunItem.partition > last)
+        partitions = [partition for partition, in chunk.limit(chunk_size)]
+        if not partitions:
+            break
+        with session.begin():
+            session.query(CrawlRunItem).filter(
+                CrawlRunItem.run_id == run_id,
+                CrawlRunItem.partition.in_(partitions)
+            ).update({'status': PENDING, 'updated_at': now()},
+                     synchronize_session=False)
+        yield partitions
+        last = partitions[-1]
@@ -0,0 +1,365 @@
+""":mod:`cliche.services.store` --- Expiring stores shared by crawlers
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Crawler tasks often have to remember short-lived facts across tasks,
+e.g. which urls were already enqueued during the current crawl interval.
+They are kept in expiring key-value stores, and keys are grouped into
+buckets so that several features can share a backend::
+
+    frontier = get_store('tvtropes.frontier', session)
+    for url in frontier.add_many(urls, ttl=datetime.timedelta(days=7)):
+        crawl_link.delay(url)
+
+There are two backends, chosen by ``STORE_BACKEND`` configuration:
+
+``'database'`` (default)
+   :class:`DatabaseStore` keeps items in the :class:`StoreItem` table,
+   so that every worker shares them.
+
+``'memory'``
+   :class:`MemoryStore` keeps items in the current process only.  Useful
+   for a single worker and for testing.
+
+Values have to be serializable using :mod:`json`.
+
+"""
+import datetime
+import json
+
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import Column
+from sqlalchemy.sql.expression import and_, or_, select
+from sqlalchemy.types import DateTime, String, UnicodeText
+
+from ..celery import app
+from ..orm import Base, supports_on_conflict, upsert
+
+__all__ = ('DatabaseStore', 'MemoryStore', 'Store', 'StoreItem',
+           'get_store')
+
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def unique(keys):
+    """Remove duplicate ``keys``, keeping the first occurrences in order."""
+    seen = set()
+    unique_keys = []
+    for key in keys:
+        if key not in seen:
+            seen.add(key)
+            unique_keys.append(key)
+    return unique_keys
+
+
+class Store(object):
+    """The interface of expiring stores.  Every operation works on the
+    ``bucket`` only.
+
+    :param bucket: the name of the bucket
+    :type bucket: :class:`str`
+
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def get_many(self, keys):
+        """Get values of the unexpired ``keys``.
+
+        :param keys: keys to look up
+        :type keys: :class:`collections.abc.Iterable`
+        :returns: the mapping of found keys to their values.  Expired
+                  and missing keys are omitted
+        :rtype: :class:`dict`
+
+        """
+        raise NotImplementedError('override get_many() method')
+
+    def set_many(self, mapping, ttl):
+        """Set values of keys, and make them expire after ``ttl``.
+
+        :param mapping: the mapping of keys to values
+        :type mapping: :class:`collections.abc.Mapping`
+        :param ttl: how long the items live
+        :type ttl: :class:`datetime.timedelta`
+
+        """
+        raise NotImplementedError('override set_many() method')
+
+    def delete_many(self, keys):
+        """Delete ``keys``.  Missing keys are ignored.
+
+        :param keys: keys to delete
+        :type keys: :class:`collections.abc.Iterable`
+
+        """
+        raise NotImplementedError('override delete_many() method')
+
+    def purge(self):
+        """Delete expired items."""
+        raise NotImplementedError('override purge() method')
+
+    def evict(self, max_items):
+        """Delete expired items, and then items which expire earliest
+        until at most ``max_items`` items are left.  It's useful for
+        a cache.
+
+        :param max_items: the maximum number of items to keep
+        :type max_items: :class:`int`
+
+        """
+        raise NotImplementedError('override evict() method')
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def set(self, key, value, ttl):
+        self.set_many({key: value}, ttl)
+
+    def add_many(self, keys, ttl):
+        """Add ``keys`` which are missing or expired, and return them.
+        It's useful for a seen-set.
+
+        :param keys: keys to add
+        :type keys: :class:`collections.abc.Iterable`
+        :param ttl: how long the added keys live
+        :type ttl: :class:`datetime.timedelta`
+        :returns: the list of added keys in the given order
+        :rtype: :class:`list`
+
+        """
+        keys = unique(keys)
+        if not keys:
+            return []
+        existing = self.get_many(keys)
+        added = [key for key in keys if key not in existing]
+        self.set_many(dict.fromkeys(added), ttl)
+        return added
+
+
+class MemoryStore(Store):
+    """The store which keeps items in the current process.  Stores of
+    the same bucket share items.
+
+    """
+
+    #: (:class:`dict`) The mapping of bucket names to mappings of keys to
+    #: pairs of value and expiry time.
+    buckets = {}
+
+    def __init__(self, bucket):
+        super().__init__(bucket)
+        self.items = self.buckets.setdefault(bucket, {})
+
+    def get_many(self, keys):
+        current_time = now()
+        found = {}
+        for key in keys:
+            try:
+                value, expires_at = self.items[key]
+            except KeyError:
+                continue
+            if expires_at > current_time:
+                found[key] = value
+        return found
+
+    def set_many(self, mapping, ttl):
+        expires_at = now() + ttl
+        for key, value in mapping.items():
+            self.items[key] = value, expires_at
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.items.pop(key, None)
+
+    def purge(self):
+        current_time = now()
+        for key, (_, expires_at) in list(self.items.items()):
+            if expires_at <= current_time:
+                del self.items[key]
+
+    def evict(self, max_items):
+        self.purge()
+        excess = len(self.items) - max_items
+        if excess > 0:
+            keys = sorted(self.items, key=lambda key: self.items[key][1])
+            for key in keys[:excess]:
+                del self.items[key]
+
+
+class StoreItem(Base):
+    """An item of :class:`DatabaseStore`."""
+
+    #: (:class:`str`) The bucket name.
+    bucket = Column(String, primary_key=True)
+
+    #: (:class:`str`) The key.
+    key = Column(String, primary_key=True)
+
+    #: (:class:`str`) The JSON-encoded value.
+    value = Column(UnicodeText)
+
+    #: (:class:`datetime.datetime`) The time the item expires.
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+    __tablename__ = 'store_items'
+    __repr_columns__ = bucket, key, expires_at
+
+
+class DatabaseStore(Store):
+    """The store which keeps items in :class:`StoreItem` table, so that
+    every worker shares them.
+
+    :param bucket: the name of the bucket
+    :type bucket: :class:`str`
+    :param session: a database session
+    :type session: :class:`~cliche.orm.Session`
+
+    """
+
+    def __init__(self, bucket, session):
+        super().__init__(bucket)
+        self.session = session
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        query = self.session.query(StoreItem.key, StoreItem.value).filter(
+            StoreItem.bucket == self.bucket,
+            StoreItem.key.in_(keys),
+            StoreItem.expires_at > now()
+        )
+        return {key: value if value is None else json.loads(value)
+                for key, value in query}
+
+    def make_rows(self, mapping, expires_at):
+        return [
+            {
+                'bucket': self.bucket,
+                'key': key,
+                'value': value if value is None else json.dumps(value),
+                'expires_at': expires_at,
+            }
+            for key, value in mapping.items()
+        ]
+
+    def set_many(self, mapping, ttl):
+        if not mapping:
+            return
+        # the last writer wins if other workers set the same keys
+        with self.session.begin():
+            upsert(self.session, StoreItem.__table__,
+                   self.make_rows(mapping, now() + ttl))
+
+    def add_many(self, keys, ttl):
+        """Add ``keys`` which are missing or expired, and return them.
+        Each key is added atomically, so that if several workers add
+        the same key at the same time, only one of them gets it.
+
+        It's translated to ``INSERT ... ON CONFLICT DO UPDATE ... WHERE
+        ... RETURNING`` on PostgreSQL.  Other databases insert keys one by
+        one, ignoring conflicts.
+
+        """
+        keys = unique(keys)
+        if not keys:
+            return []
+        table = StoreItem.__table__
+        current_time = now()
+        rows = self.make_rows(dict.fromkeys(keys), current_time + ttl)
+        with self.session.begin():
+            connection = self.session.connection()
+            if supports_on_conflict(connection):
+                statement = postgresql.insert(table).values(rows)
+                statement = statement.on_conflict_do_update(
+                    index_elements=[table.c.bucket, table.c.key],
+                    set_={'value': statement.excluded.value,
+                          'expires_at': statement.excluded.expires_at},
+                    # only expired keys are taken over
+                    where=table.c.expires_at <= current_time
+                ).returning(table.c.key)
+                added = {key for key, in connection.execute(statement)}
+            else:
+                connection.execute(table.delete().where(and_(
+                    table.c.bucket == self.bucket,
+                    table.c.key.in_(keys),
+                    table.c.expires_at <= current_time
+                )))
+                added = set(self.insert_each(connection, rows))
+        return [key for key in keys if key in added]
+
+    def insert_each(self, connection, rows):
+        """Insert ``rows`` one by one ignoring conflicts, and yield keys
+        of inserted rows.
+
+        """
+        table = StoreItem.__table__
+        if connection.dialect.name == 'sqlite':
+            insert = table.insert().prefix_with('OR IGNORE')
+            for row in rows:
+                if connection.execute(insert, row).rowcount:
+                    yield row['key']
+            return
+        for row in rows:
+            try:
+                with self.session.begin_nested():
+                    connection.execute(table.insert(), row)
+            except IntegrityError:
+                continue
+            yield row['key']
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return
+        table = StoreItem.__table__
+        with self.session.begin():
+            self.session.execute(table.delete().where(and_(
+                table.c.bucket == self.bucket,
+                table.c.key.in_(keys)
+            )))
+
+    def purge(self):
+        table = StoreItem.__table__
+        with self.session.begin():
+            self.session.execute(table.delete().where(and_(
+                table.c.bucket == self.bucket,
+                table.c.expires_at <= now()
+            )))
+
+    def evict(self, max_items):
+        table = StoreItem.__table__
+        kept = select([table.c.key]) \
+            .where(table.c.bucket == self.bucket) \
+            .order_by(table.c.expires_at.desc()) \
+            .limit(max_items)
+        with self.session.begin():
+            self.session.execute(table.delete().where(and_(
+                table.c.bucket == self.bucket,
+                or_(table.c.expires_at <= now(), table.c.key.notin_(kept))
+            )))
+
+
+def get_store(bucket, session):
+    """Get a store of the ``bucket`` using the backend configured by
+    ``STORE_BACKEND``.
+
+    :param bucket: the name of the bucket
+    :type bucket: :class:`str`
+    :param session: a database session.  only used by
+                    :class:`DatabaseStore`
+    :type session: :class:`~cliche.orm.Session`
+    :returns: a store
+    :rtype: :class:`Store`
+
+    """
+    backend = app.conf.get('STORE_BACKEND', 'database')
+    if backend == 'memory':
+        return MemoryStore(bucket)
+    elif backend == 'database':
+        return DatabaseStore(bucket, session)
+    raise ValueError('unknown STORE_BACKEND: ' + repr(backend))
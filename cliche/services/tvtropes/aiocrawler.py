@@ -0,0 +1,324 @@
+""":mod:`cliche.services.tvtropes.aiocrawler` --- Asyncio-based crawl engine
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+An alternative to :func:`cliche.services.tvtropes.crawler.crawl_link` tasks.
+The Celery task per url allows only one in-flight request per worker
+process, while :class:`Crawler` keeps hundreds of requests in flight from
+a single process::
+
+    crawler = Crawler(session, concurrency=200, rate=20.0)
+    crawler.run(['http://tvtropes.org/pmwiki/pmwiki.php/Main/GodJob'])
+
+It parses and saves pages exactly the same way the tasks do, and shares
+the crawl frontier and the rate limits of hosts
+(see :mod:`cliche.services.ratelimit`) with them.  Requests are sent by
+a thread pool of blocking HTTP clients, and database work is done one
+at a time by a dedicated thread, so that the event loop never blocks on
+the database and the database session is never used by two threads at
+once.  Scheduling and parsing happen in the event loop thread.
+
+There's also :program:`cliche crawl-tvtropes` command.
+
+"""
+import asyncio
+import concurrent.futures
+import datetime
+import functools
+import logging
+
+from lxml.html import document_fromstring
+
+from ...celery import app
+from ..ratelimit import get_backend, reserve
+from ..store import get_store
+from .crawler import (CRAWL_INTERVAL, INDEX_INDEX, RELATED_SEARCH,
+                      SEEDING_FINISHED, SEEDING_STARTED, admit_links,
+                      archive_page, cache_redirections, extract_links,
+                      extract_namespace_urls, extract_page_urls,
+                      get_cached_redirections, get_conditional_headers,
+                      get_redirection_path, get_validators, is_wiki_page,
+                      iter_stale_urls, make_http_session, mark_crawled,
+                      measured_get, needs_seeding, parse_redirections,
+                      read_page, recently_crawled, release_links,
+                      save_page, save_relations)
+
+__all__ = 'DEFAULT_RATE', 'Crawler'
+
+#: (:class:`float`) The number of requests per second per host which
+#: :class:`Crawler` sends if neither ``RATE_LIMITS`` of the host nor
+#: ``TVTROPES_RATE_LIMIT`` is configured.
+DEFAULT_RATE = 1.0
+
+
+class Crawler(object):
+    """Crawl TVTropes pages concurrently in an event loop.
+
+    :param session: a database session.  it's used only in the database
+                    thread (see :meth:`run_in_database()`)
+    :type session: :class:`~cliche.orm.Session`
+    :param concurrency: the maximum number of requests in flight
+    :type concurrency: :class:`int`
+    :param rate: the maximum number of requests per second per host,
+                 unless ``RATE_LIMITS`` of the host is configured
+                 (see :mod:`cliche.services.ratelimit`).
+                 ``TVTROPES_RATE_LIMIT`` or :const:`DEFAULT_RATE`
+                 by default
+    :type rate: :class:`float`
+
+    """
+
+    def __init__(self, session, concurrency=100, rate=None):
+        if rate is None:
+            rate = app.conf.get('TVTROPES_RATE_LIMIT', DEFAULT_RATE)
+        self.session = session
+        self.concurrency = concurrency
+        self.rate = rate
+        self.backend = get_backend(session)
+        self.http = make_http_session(pool_size=concurrency)
+        self.logger = logging.getLogger(__name__ + '.Crawler')
+        self.crawled = 0
+
+    async def fetch(self, url, headers=None):
+        """Send a GET request in the thread pool.
+
+        :param url: the url to fetch
+        :type url: :class:`str`
+        :param headers: additional request headers
+        :type headers: :class:`collections.abc.Mapping`
+        :returns: the response
+        :rtype: :class:`requests.Response`
+
+        """
+        # buckets are shared with the other crawlers through the backend,
+        # so only waiting for them happens in the event loop
+        wait = await self.run_in_database(
+            reserve, url, (self.rate, max(1.0, self.rate)), self.backend
+        )
+        if wait > 0:
+            await asyncio.sleep(wait)
+        request = functools.partial(
+            measured_get, self.http, url,
+            headers=headers,
+            timeout=app.conf.get('TVTROPES_TIMEOUT', 30)
+        )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, request)
+
+    async def run_in_database(self, function, *args):
+        """Call the ``function`` with ``args`` in the database thread, so
+        that the event loop doesn't block on the database.
+
+        :param function: the function which uses the database
+        :type function: :class:`collections.abc.Callable`
+        :returns: the result of the ``function``
+
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.database_executor,
+                                          functools.partial(function, *args))
+
+    async def crawl_page(self, url):
+        """Crawl a page, and return urls of pages to crawl next.  The page
+        is skipped if it's already in the crawl frontier, and otherwise
+        admitted to the frontier (see
+        :func:`~cliche.services.tvtropes.crawler.admit_links()`) until it
+        fails to be crawled.  Urls to crawl next are admitted only when
+        they are crawled, so that urls left in the queue of an interrupted
+        run are not blocked.
+
+        :param url: the url to crawl
+        :type url: :class:`str`
+        :returns: urls to crawl next
+        :rtype: :class:`list`
+
+        """
+        current_time = datetime.datetime.now(datetime.timezone.utc)
+        if not is_wiki_page(url) or \
+           not await self.run_in_database(self.admit, url, current_time):
+            return []
+        try:
+            return await self.crawl_admitted_page(url, current_time)
+        except Exception:
+            # a transient failure would block the url until the frontier
+            # expires otherwise
+            await self.run_in_database(release_links, self.session, [url])
+            raise
+
+    def admit(self, url, current_time):
+        return not recently_crawled(current_time, url, self.session) and \
+            bool(admit_links(self.session, [url]))
+
+    async def crawl_admitted_page(self, url, current_time):
+        session = self.session
+        validators = await self.run_in_database(get_validators, session, url)
+        response = await self.fetch(url, get_conditional_headers(validators))
+        if response.status_code == 429 or response.status_code >= 500:
+            # it's not the page but a transient failure of the host
+            response.raise_for_status()
+        result, page, namespace, name, final_url = read_page(
+            url, response, validators
+        )
+        if not result or await self.run_in_database(
+                recently_crawled, current_time, final_url, session):
+            return []
+        if page is not None:
+            final_path = get_redirection_path(url, final_url)
+            if final_path is None:
+                aliases = []
+            else:
+                aliases = await self.run_in_database(
+                    get_cached_redirections, session, final_path
+                )
+                if aliases is None:
+                    related = await self.fetch(RELATED_SEARCH + final_path)
+                    aliases = parse_redirections(related.text)
+                    await self.run_in_database(
+                        cache_redirections, session, final_path, aliases
+                    )
+            links = extract_links(page)
+            await self.run_in_database(
+                self.save, url, final_url, response, namespace, name,
+                aliases, links
+            )
+            next_urls = list(links)
+        else:
+            next_urls = []
+        await self.run_in_database(mark_crawled, session, final_url,
+                                   current_time)
+        self.crawled += 1
+        self.logger.info('Crawling %s/%s @ %s completed at %s',
+                         namespace, name, final_url, current_time)
+        return next_urls
+
+    def save(self, url, final_url, response, namespace, name, aliases,
+             links):
+        archive_page(final_url, response)
+        save_page(self.session, url, final_url, namespace, name,
+                  response.headers, aliases)
+        save_relations(self.session, namespace, name, links)
+
+    def enqueue(self, url):
+        if url not in self.enqueued:
+            self.enqueued.add(url)
+            self.queue.put_nowait(url)
+
+    async def work(self):
+        while True:
+            url = await self.queue.get()
+            try:
+                for next_url in await self.crawl_page(url):
+                    self.enqueue(next_url)
+            except Exception:
+                self.logger.exception('Failed to crawl %s', url)
+            finally:
+                self.queue.task_done()
+
+    async def seed(self):
+        """Enqueue urls to start crawling from, like
+        :func:`~cliche.services.tvtropes.crawler.crawl()` does.  If
+        :func:`~cliche.services.tvtropes.crawler.needs_seeding()`, pages
+        listed on the index are enqueued namespace by namespace (see
+        :meth:`seed_pages()`).  Otherwise only stale pages are enqueued,
+        chunk by chunk.
+
+        """
+        session = self.session
+        if await self.run_in_database(needs_seeding, session):
+            await self.seed_pages()
+            return
+        current_time = datetime.datetime.now(datetime.timezone.utc)
+        chunks = iter_stale_urls(session, current_time)
+        while True:
+            urls = await self.run_in_database(next, chunks, None)
+            if urls is None:
+                break
+            for url in urls:
+                self.enqueue(url)
+
+    async def seed_pages(self):
+        """Enqueue every page listed on the index, as soon as each namespace
+        index is fetched.  It shares checkpoints with
+        :func:`~cliche.services.tvtropes.crawler.seed_pages()`, so seeding
+        interrupted midway resumes from the next namespace.  Unlike it,
+        urls are admitted to the crawl frontier when they are crawled
+        (see :meth:`crawl_page()`).
+
+        """
+        checkpoints = get_store('tvtropes.seeding', self.session)
+        await self.run_in_database(checkpoints.set, SEEDING_STARTED, True,
+                                   CRAWL_INTERVAL)
+        index = document_fromstring((await self.fetch(INDEX_INDEX)).text)
+        namespace_urls = [INDEX_INDEX]
+        namespace_urls.extend(extract_namespace_urls(index))
+        completed = await self.run_in_database(checkpoints.get_many,
+                                               namespace_urls)
+        for namespace_url in namespace_urls:
+            if namespace_url in completed:
+                continue
+            if namespace_url == INDEX_INDEX:
+                tree = index
+            else:
+                response = await self.fetch(namespace_url)
+                tree = document_fromstring(response.text)
+            for url in extract_page_urls(tree):
+                self.enqueue(url)
+            await self.run_in_database(checkpoints.set, namespace_url, True,
+                                       CRAWL_INTERVAL)
+            self.logger.info('Seeded %s.', namespace_url)
+        await self.run_in_database(checkpoints.set, SEEDING_FINISHED, True,
+                                   CRAWL_INTERVAL)
+
+    async def crawl(self, seeds=None):
+        """Crawl from ``seeds`` until there's no page to crawl.  Workers
+        start first, so that pages are crawled while seeding goes on.
+
+        :param seeds: urls to start crawling from.  :meth:`seed()`
+                      enqueues them by default
+        :type seeds: :class:`collections.abc.Iterable`
+
+        """
+        self.queue = asyncio.Queue()
+        self.enqueued = set()
+        workers = [asyncio.ensure_future(self.work())
+                   for _ in range(self.concurrency)]
+        try:
+            try:
+                if seeds is None:
+                    await self.seed()
+                else:
+                    for url in seeds:
+                        self.enqueue(url)
+            finally:
+                # pages enqueued before seeding failed are crawled anyway
+                await self.queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    def run(self, seeds=None):
+        """Run :meth:`crawl()` in a new event loop, and return the number of
+        crawled pages.
+
+        :param seeds: urls to start crawling from.  :meth:`seed()` enqueues
+                      them by default.  urls already in the crawl frontier
+                      are ignored
+        :type seeds: :class:`collections.abc.Iterable`
+        :returns: the number of crawled pages
+        :rtype: :class:`int`
+
+        """
+        loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.concurrency
+        )
+        self.database_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1
+        )
+        try:
+            loop.run_until_complete(self.crawl(seeds))
+        finally:
+            self.executor.shutdown()
+            self.database_executor.shutdown()
+            loop.close()
+        return self.crawled
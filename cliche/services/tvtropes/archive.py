@@ -0,0 +1,212 @@
+""":mod:`cliche.services.tvtropes.archive` --- Raw page archive
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+If ``TVTROPES_ARCHIVE_PATH`` is configured, crawlers store every fetched
+page into the archive directory, so that pages can be parsed again
+offline, e.g. after link extraction changed::
+
+    $ cliche reparse-tvtropes -c CONFIG_FILE
+
+The archive consists of append-only files written by each process, so
+that workers never lock each other:
+
+:file:`segment-{pid}.dat`
+   Pages compressed using :mod:`zlib`, concatenated.  Pages of the same
+   content are stored only once per segment, as they are addressed by
+   their SHA-1 digests.
+
+:file:`index-{pid}.tsv`
+   Lines of url, digest, offset and length of the compressed page in the
+   segment, and the POSIX time it was fetched, separated by tabs.
+
+Segments are memory-mapped for reads.
+
+"""
+import datetime
+import hashlib
+import mmap
+import os
+import pathlib
+import zlib
+
+from celery.signals import worker_process_init
+
+from ...celery import app
+
+__all__ = 'Archive', 'ArchivedPage', 'get_archive', 'reset_archive'
+
+
+class ArchivedPage(object):
+    """An index entry of :class:`Archive`."""
+
+    __slots__ = 'url', 'digest', 'segment', 'offset', 'length', 'fetched_at'
+
+    def __init__(self, url, digest, segment, offset, length, fetched_at):
+        #: (:class:`str`) The final url of the page.
+        self.url = url
+        #: (:class:`str`) The SHA-1 hex digest of the page.
+        self.digest = digest
+        #: (:class:`str`) The filename of the segment.
+        self.segment = segment
+        #: (:class:`int`) The offset of the compressed page in the segment.
+        self.offset = offset
+        #: (:class:`int`) The length of the compressed page.
+        self.length = length
+        #: (:class:`datetime.datetime`) The time the page was fetched.
+        self.fetched_at = fetched_at
+
+    def __repr__(self):
+        return '<{0.__class__.__name__} {0.url} {0.digest}>'.format(self)
+
+
+class Archive(object):
+    """The on-disk store of raw pages.
+
+    :param path: the directory of the archive.  it's created if it doesn't
+                 exist
+    :type path: :class:`str`, :class:`pathlib.Path`
+
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.pid = None
+        self.segment = self.index = None
+        self.digests = {}
+        self.maps = {}
+
+    def open_for_write(self):
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        # a forked process has to write its own files.
+        self.close()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.pid = pid
+        self.segment = (self.path / 'segment-{}.dat'.format(pid)).open('ab')
+        self.index = (self.path / 'index-{}.tsv'.format(pid)).open(
+            'a', encoding='utf-8'
+        )
+        self.digests = {}
+
+    def write(self, url, text, fetched_at=None):
+        """Store the ``text`` of the page of the ``url``.
+
+        :param url: the final url of the page
+        :type url: :class:`str`
+        :param text: the html of the page
+        :type text: :class:`str`
+        :param fetched_at: the time the page was fetched.  the current time
+                           by default
+        :type fetched_at: :class:`datetime.datetime`
+        :returns: the index entry
+        :rtype: :class:`ArchivedPage`
+
+        """
+        if fetched_at is None:
+            fetched_at = datetime.datetime.now(datetime.timezone.utc)
+        self.open_for_write()
+        content = text.encode('utf-8')
+        digest = hashlib.sha1(content).hexdigest()
+        try:
+            offset, length = self.digests[digest]
+        except KeyError:
+            compressed = zlib.compress(content)
+            offset = self.segment.seek(0, os.SEEK_END)
+            length = len(compressed)
+            self.segment.write(compressed)
+            self.segment.flush()
+            self.digests[digest] = offset, length
+        page = ArchivedPage(url, digest, os.path.basename(self.segment.name),
+                            offset, length, fetched_at)
+        self.index.write('\t'.join([
+            url, digest, str(offset), str(length),
+            '{:.6f}'.format(fetched_at.timestamp())
+        ]) + '\n')
+        self.index.flush()
+        return page
+
+    def read(self, page):
+        """Read the html of the archived ``page``.
+
+        :param page: the index entry
+        :type page: :class:`ArchivedPage`
+        :returns: the html of the page
+        :rtype: :class:`str`
+
+        """
+        end = page.offset + page.length
+        segment = self.maps.get(page.segment)
+        if segment is None or len(segment) < end:
+            # the segment has grown since it was mapped.
+            if segment is not None:
+                segment.close()
+            with (self.path / page.segment).open('rb') as f:
+                segment = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[page.segment] = segment
+        compressed = segment[page.offset:end]
+        return zlib.decompress(compressed).decode('utf-8')
+
+    def pages(self):
+        """List the latest archived page of each url.
+
+        :returns: index entries
+        :rtype: :class:`list`
+
+        """
+        latest = {}
+        for index in sorted(self.path.glob('index-*.tsv')):
+            segment = 'segment-{}.dat'.format(index.stem[len('index-'):])
+            with index.open(encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        url, digest, offset, length, fetched_at = \
+                            line.rstrip('\n').split('\t')
+                    except ValueError:
+                        # a line partially written by a killed process
+                        continue
+                    fetched_at = datetime.datetime.fromtimestamp(
+                        float(fetched_at), datetime.timezone.utc
+                    )
+                    page = ArchivedPage(url, digest, segment, int(offset),
+                                        int(length), fetched_at)
+                    if url not in latest or \
+                       latest[url].fetched_at <= fetched_at:
+                        latest[url] = page
+        return sorted(latest.values(), key=lambda page: page.url)
+
+    def close(self):
+        for f in self.segment, self.index:
+            if f is not None:
+                f.close()
+        self.segment = self.index = None
+        self.pid = None
+        for segment in self.maps.values():
+            segment.close()
+        self.maps = {}
+
+
+def get_archive():
+    """Get the archive of ``TVTROPES_ARCHIVE_PATH``.
+
+    :returns: the archive, or :const:`None` if it's not configured
+    :rtype: :class:`Archive`
+
+    """
+    path = app.conf.get('TVTROPES_ARCHIVE_PATH')
+    if not path:
+        return None
+    archive = app.conf.get('TVTROPES_ARCHIVE')
+    if archive is None or archive.path != pathlib.Path(path):
+        archive = Archive(path)
+        app.conf['TVTROPES_ARCHIVE'] = archive
+    return archive
+
+
+@worker_process_init.connect
+def reset_archive(**kwargs):
+    """Drop the archive inherited from the parent process, so that forked
+    workers never share file objects.
+
+    """
+    app.conf['TVTROPES_ARCHIVE'] = None
@@ -6,16 +6,30 @@
 """
 from __future__ import print_function
 
+import collections
 import datetime
+import time
 import urllib.parse
 
+from celery.signals import worker_process_init
 from celery.utils.log import get_task_logger
-from lxml.html import document_fromstring, parse
-import requests
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm.exc import FlushError, NoResultFound
+from lxml.etree import HTMLPullParser, XPath
+from lxml.html import document_fromstring
+from requests import RequestException, Session
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from sqlalchemy.sql.expression import and_, or_
+from sqlalchemy.sql.functions import func
 
 from ...celery import app, get_session
+from ...metrics import (DB_WRITE_SECONDS, HTTP_BYTES, HTTP_REQUESTS,
+                        HTTP_SECONDS, OPERATION_SECONDS, PAGES, PARSE_SECONDS,
+                        RETRIES)
+from ...orm import insert_ignore, upsert
+from ..ratelimit import throttle
+from ..runs import add_items, begin_run, resume_items, track
+from ..store import get_store
+from .archive import get_archive
 from .entities import Entity, Redirection, Relation
 
 
@@ -26,6 +40,150 @@ RELATED_SEARCH = urllib.parse.urljoin(BASE_URL, 'relatedsearch.php?term=')
 
 CRAWL_INTERVAL = datetime.timedelta(days=7)
 
+#: (:class:`tuple`) Buckets of :mod:`~cliche.services.store` the crawler
+#: uses.  Their expired items are purged by :func:`crawl()`.
+STORE_BUCKETS = ('tvtropes.frontier', 'tvtropes.redirections',
+                 'tvtropes.seeding')
+
+#: (:class:`str`) The key of the ``'tvtropes.seeding'`` store bucket set
+#: when :func:`seed_pages()` starts.  Namespace checkpoints are keyed by
+#: their urls, so it can't collide with them.
+SEEDING_STARTED = 'started'
+
+#: (:class:`str`) The key of the ``'tvtropes.seeding'`` store bucket set
+#: when :func:`seed_pages()` has seeded every namespace.
+SEEDING_FINISHED = 'finished'
+
+#: (:class:`lxml.etree.XPath`) Hrefs of wiki pages listed on an index page.
+PAGE_LINKS = XPath('//a[@class="twikilink"]/@href')
+
+#: (:class:`lxml.etree.XPath`) Hrefs of namespace index pages listed on
+#: :const:`INDEX_INDEX`.
+NAMESPACE_LINKS = XPath(
+    '//a[starts-with(@href, "index_report.php?groupname=")]/@href'
+)
+
+#: (:class:`lxml.etree.XPath`) Links to aliases listed on
+#: a :const:`RELATED_SEARCH` page.
+REDIRECTION_LINKS = XPath(
+    "//div[@id='wikimiddle']/div[re:test(text(),"
+    "'This article is the target of [0-9]+ redirect\\(s\\)\\.'"
+    ")]/ul/li/a",
+    namespaces={'re': "http://exslt.org/regular-expressions"}
+)
+
+#: (:class:`type`) The title and hrefs of links in the wikitext of a page,
+#: extracted by :func:`parse_page()`.
+Page = collections.namedtuple('Page', ['title', 'hrefs'])
+
+
+def get_http_session():
+    """Get the pooled HTTP session of the current worker process.  Its
+    connections are kept alive and reused across tasks, and it is configured
+    by the following Celery settings:
+
+    ``TVTROPES_POOL_SIZE``
+       The number of connections kept alive per host.  Default is 10.
+
+    ``TVTROPES_RETRY_LIMIT``
+       How many times a failed request is retried.  Default is 3.
+
+    ``TVTROPES_RETRY_BACKOFF``
+       The backoff factor in seconds between retries.  Default is 0.5.
+
+    :returns: a pooled HTTP session
+    :rtype: :class:`requests.Session`
+
+    """
+    config = app.conf
+    if config.get('TVTROPES_HTTP_SESSION') is None:
+        config['TVTROPES_HTTP_SESSION'] = make_http_session()
+    return config['TVTROPES_HTTP_SESSION']
+
+
+def make_http_session(pool_size=None):
+    """Create a new pooled HTTP session.  Prefer :func:`get_http_session()`
+    unless you need a separated pool e.g. for many threads.
+
+    :param pool_size: the number of connections kept alive per host.
+                      ``TVTROPES_POOL_SIZE`` by default
+    :type pool_size: :class:`int`
+    :returns: a pooled HTTP session
+    :rtype: :class:`requests.Session`
+
+    """
+    config = app.conf
+    if pool_size is None:
+        pool_size = config.get('TVTROPES_POOL_SIZE', 10)
+    retry = Retry(
+        total=config.get('TVTROPES_RETRY_LIMIT', 3),
+        backoff_factor=config.get('TVTROPES_RETRY_BACKOFF', 0.5),
+        status_forcelist=(500, 502, 503, 504)
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+@worker_process_init.connect
+def reset_http_session(**kwargs):
+    """Drop the HTTP session inherited from the parent process, so that
+    forked workers never share pooled sockets.
+
+    """
+    app.conf['TVTROPES_HTTP_SESSION'] = None
+
+
+def http_get(url, headers=None):
+    """Send a GET request through :func:`get_http_session()`.  It times out
+    after ``TVTROPES_TIMEOUT`` seconds (default is 30), and waits for
+    ``RATE_LIMITS`` of the host (see :mod:`cliche.services.ratelimit`).
+
+    :param url: the url to fetch
+    :type url: :class:`str`
+    :param headers: additional request headers
+    :type headers: :class:`collections.abc.Mapping`
+    :returns: the response
+    :rtype: :class:`requests.Response`
+
+    """
+    timeout = app.conf.get('TVTROPES_TIMEOUT', 30)
+    throttle(url)
+    return measured_get(get_http_session(), url, headers=headers,
+                        timeout=timeout)
+
+
+def measured_get(http, url, **kwargs):
+    """Send a GET request through the ``http`` session, and count it in
+    :mod:`cliche.metrics`, e.g. its latency, bytes and retries.
+
+    :param http: the HTTP session
+    :type http: :class:`requests.Session`
+    :param url: the url to fetch
+    :type url: :class:`str`
+    :returns: the response
+    :rtype: :class:`requests.Response`
+
+    """
+    started = time.monotonic()
+    try:
+        response = http.get(url, **kwargs)
+    except RequestException:
+        HTTP_REQUESTS.inc(service='tvtropes', status='error')
+        raise
+    HTTP_SECONDS.observe(time.monotonic() - started, service='tvtropes')
+    HTTP_REQUESTS.inc(service='tvtropes', status=response.status_code)
+    HTTP_BYTES.inc(len(response.content), service='tvtropes')
+    # retries are done by urllib3 under the hood
+    retries = getattr(response.raw, 'retries', None)
+    if retries is not None and retries.history:
+        RETRIES.inc(len(retries.history), service='tvtropes')
+    return response
+
 
 def determine_type(namespace):
     if namespace == 'Main':
@@ -36,198 +194,726 @@ def determine_type(namespace):
         return 'Work'
 
 
-def list_pages(namespace_url=None):
-    list_url = namespace_url or INDEX_INDEX
-    tree = parse(list_url)
+def parse_wiki_url(url):
+    """Parse the namespace and the name of a page out of its wiki url
+    without fetching it e.g. ``('Main', 'GodJob')`` from
+    ``http://tvtropes.org/pmwiki/pmwiki.php/Main/GodJob``.  Note that
+    the name is the slug used in the url, not the title of the page.
+
+    :param url: the url of a wiki page
+    :type url: :class:`str`
+    :returns: a pair of namespace and name, or :const:`None` if the url
+              doesn't refer a wiki page
+    :rtype: :class:`tuple`
+
+    """
+    path = urllib.parse.urlparse(url).path
+    try:
+        _, page = path.split('/pmwiki.php/', 1)
+        namespace, name = page.split('/')[:2]
+    except ValueError:
+        return None
+    if not namespace or not name:
+        return None
+    return urllib.parse.unquote(namespace), urllib.parse.unquote(name)
 
-    for a in tree.xpath('//a[@class="twikilink"]'):
-        url = a.attrib['href']
+
+def extract_page_urls(tree):
+    """Extract urls of wiki pages listed on an index page."""
+    for url in PAGE_LINKS(tree):
         if WIKI_PAGE in url:
-            yield url
+            yield str(url)
+
+
+def extract_namespace_urls(tree):
+    """Extract urls of namespace index pages listed on
+    :const:`INDEX_INDEX`.
+
+    """
+    for href in NAMESPACE_LINKS(tree):
+        if "index_report.php?groupname=Administrivia" in href:
+            continue
+        yield urllib.parse.urljoin(INDEX_INDEX, href)
+
 
+def list_pages(namespace_url=None):
+    list_url = namespace_url or INDEX_INDEX
+    tree = document_fromstring(http_get(list_url).text)
+    yield from extract_page_urls(tree)
     if not namespace_url:
-        namespaces = tree.xpath(
-            '//a[starts-with(@href, "index_report.php?groupname=")]'
-        )
+        for url in extract_namespace_urls(tree):
+            yield from list_pages(url)
 
-        for a in namespaces:
-            if "index_report.php?groupname=Administrivia" in a.attrib['href']:
-                continue
-            url = urllib.parse.urljoin(
-                INDEX_INDEX, a.attrib['href']
-            )
-            for value in list_pages(url):
-                yield value
 
+def seed_pages(session, enqueue, batch_size=None):
+    """Enqueue every page listed on the index, namespace by namespace.
+
+    Pages are enqueued in batches as soon as each namespace index is
+    parsed, instead of after the whole index is downloaded.  Completed
+    namespaces are checkpointed in the ``'tvtropes.seeding'`` store
+    bucket during the current :const:`CRAWL_INTERVAL`, so that seeding
+    interrupted midway resumes from the next namespace (see
+    :func:`is_seeding()`).  Urls already in the crawl frontier are
+    skipped (see :func:`admit_links()`).
+
+    :param session: a database session
+    :param enqueue: the function called with each batch of urls to crawl
+    :type enqueue: :class:`collections.abc.Callable`
+    :param batch_size: the maximum number of urls per batch.
+                       ``TVTROPES_SEED_BATCH_SIZE`` (100) by default
+    :type batch_size: :class:`int`
+    :returns: the number of enqueued urls
+    :rtype: :class:`int`
+
+    """
+    if batch_size is None:
+        batch_size = app.conf.get('TVTROPES_SEED_BATCH_SIZE', 100)
+    logger = get_task_logger(__name__ + '.seed_pages')
+    checkpoints = get_store('tvtropes.seeding', session)
+    checkpoints.set(SEEDING_STARTED, True, CRAWL_INTERVAL)
+    index = document_fromstring(http_get(INDEX_INDEX).text)
+    namespace_urls = [INDEX_INDEX]
+    namespace_urls.extend(extract_namespace_urls(index))
+    completed = checkpoints.get_many(namespace_urls)
+    enqueued = 0
+    for namespace_url in namespace_urls:
+        if namespace_url in completed:
+            logger.info('Skipping %s; already seeded.', namespace_url)
+            continue
+        if namespace_url == INDEX_INDEX:
+            tree = index
+        else:
+            tree = document_fromstring(http_get(namespace_url).text)
+        urls = list(extract_page_urls(tree))
+        for offset in range(0, len(urls), batch_size):
+            batch = admit_links(session, urls[offset:offset + batch_size])
+            if batch:
+                enqueue(batch)
+                enqueued += len(batch)
+        checkpoints.set(namespace_url, True, CRAWL_INTERVAL)
+        logger.info('Seeded %d pages of %s.', len(urls), namespace_url)
+    checkpoints.set(SEEDING_FINISHED, True, CRAWL_INTERVAL)
+    return enqueued
+
+
+def is_seeding(session):
+    """Whether :func:`seed_pages()` was started but not finished during
+    the current :const:`CRAWL_INTERVAL`, i.e. it was interrupted midway
+    and has to be continued from its checkpoints.
+
+    :param session: a database session
+    :returns: :const:`True` if seeding is incomplete
+    :rtype: :class:`bool`
+
+    """
+    checkpoints = get_store('tvtropes.seeding', session)
+    markers = checkpoints.get_many([SEEDING_STARTED, SEEDING_FINISHED])
+    return SEEDING_STARTED in markers and SEEDING_FINISHED not in markers
+
+
+def needs_seeding(session):
+    """Whether every page listed on the index has to be enqueued, i.e.
+    there's no entity yet or seeding is incomplete (see :func:`is_seeding()`).
+    Otherwise only stale pages are enqueued (see :func:`iter_stale_urls()`).
+
+    :param session: a database session
+    :rtype: :class:`bool`
+
+    """
+    return is_seeding(session) or session.query(Entity).count() < 1
+
+
+def enqueue_links(urls, run_id=None):
+    """Send :func:`crawl_link` tasks of ``urls`` through a single
+    producer connection.
+
+    :param urls: urls to crawl
+    :type urls: :class:`collections.abc.Iterable`
+    :param run_id: the :class:`~cliche.services.runs.CrawlRun` id which
+                   tasks belong to
+    :type run_id: :class:`int`
+
+    """
+    with app.producer_or_acquire() as producer:
+        for url in urls:
+            crawl_link.apply_async((url, run_id), producer=producer)
 
-def upsert_entity(session, namespace, name, type, url):
-    try:
-        with session.begin():
-            new_entity = Entity(
-                namespace=namespace,
-                name=name,
-                url=url,
-                type=type
-            )
-            session.add(new_entity)
-    except (FlushError, IntegrityError):
-        with session.begin():
-            entity = session.query(Entity) \
-                            .filter_by(namespace=namespace, name=name) \
-                            .one()
-            entity.url = url
-            entity.type = type
 
+def upsert_entities(session, entities):
+    """Insert or update many entities at once.
 
-def process_redirections(session, original_url, final_url, namespace, name):
+    :param session: a database session
+    :type session: :class:`~cliche.orm.Session`
+    :param entities: dictionaries of :class:`~.entities.Entity` column
+                     names to values.  ``namespace``, ``name``, ``type``,
+                     ``url``, ``etag`` and ``last_modified`` are required
+    :type entities: :class:`collections.abc.Iterable`
+
+    """
+    upsert(session, Entity.__table__, entities,
+           update_columns=['url', 'type', 'etag', 'last_modified'])
+
+
+def upsert_entity(session, namespace, name, type, url,
+                  etag=None, last_modified=None):
+    upsert_entities(session, [{
+        'namespace': namespace,
+        'name': name,
+        'type': type,
+        'url': url,
+        'etag': etag,
+        'last_modified': last_modified,
+    }])
+
+
+def get_redirection_path(original_url, final_url):
+    """Get the path to look up aliases with :const:`RELATED_SEARCH` if
+    ``original_url`` redirected to ``final_url``, or :const:`None`.
+
+    """
     # note that indirection is not considered:
     # only the original and final path are saved.
     *_, original_path = urllib.parse.urlparse(original_url).path.split('/', 3)
     *_, final_path = urllib.parse.urlparse(final_url).path.split('/', 3)
     if original_path != final_path:
-        rel = requests.get(RELATED_SEARCH + final_path)
-        reltree = document_fromstring(rel.text)
-        for link in reltree.xpath(
-            "//div[@id='wikimiddle']/div[re:test(text(),"
-            "'This article is the target of [0-9]+ redirect\(s\)\.'"
-            ")]/ul/li/a",
-            namespaces={'re': "http://exslt.org/regular-expressions"}
-        ):
-            alias_namespace = link.text[0:link.text.index('/')]
-            if alias_namespace == 'Administrivia':
-                continue
-            alias_name = link.text[link.text.index('/') + 1:]
-            try:
-                with session.begin():
-                    new_redirection = Redirection(
-                        alias_namespace=alias_namespace,
-                        alias_name=alias_name,
-                        original_namespace=namespace,
-                        original_name=name
-                    )
-                    session.add(new_redirection)
-            except (FlushError, IntegrityError):
-                with session.begin():
-                    redirection = session.query(Redirection) \
-                        .filter_by(
-                            alias_namespace=alias_namespace,
-                            alias_name=alias_name
-                        ) \
-                        .one()
-                    redirection.original_namespace = namespace
-                    redirection.original_name = name
+        return final_path
 
 
-def fetch_link(url, session, *, log_prefix=''):
-    '''Returns result, tree, namespace, name, final_url.'''
-    logger = get_task_logger(__name__ + '.fetch_link')
-    if not is_wiki_page(url):
-        return False, None, None, None, url
-    r = requests.get(url)
+def parse_redirections(text):
+    """Parse aliases out of a :const:`RELATED_SEARCH` page, as a list of
+    ``(namespace, name)`` pairs.
+
+    """
+    reltree = document_fromstring(text)
+    aliases = []
+    for link in REDIRECTION_LINKS(reltree):
+        alias_namespace = link.text[0:link.text.index('/')]
+        if alias_namespace == 'Administrivia':
+            continue
+        alias_name = link.text[link.text.index('/') + 1:]
+        aliases.append((alias_namespace, alias_name))
+    return aliases
+
+
+def save_redirections(session, aliases, namespace, name):
+    upsert(session, Redirection.__table__, [
+        {
+            'alias_namespace': alias_namespace,
+            'alias_name': alias_name,
+            'original_namespace': namespace,
+            'original_name': name,
+        }
+        for alias_namespace, alias_name in aliases
+    ])
+
+
+def get_cached_redirections(session, final_path):
+    """Get aliases of the page of ``final_path`` which were looked up
+    during the current :const:`CRAWL_INTERVAL`, or :const:`None`.
+
+    :param session: a database session
+    :param final_path: the path returned by :func:`get_redirection_path()`
+    :type final_path: :class:`str`
+    :returns: the list of ``(namespace, name)`` pairs, or :const:`None`
+              if it's not cached
+    :rtype: :class:`list`
+
+    """
+    cache = get_store('tvtropes.redirections', session)
+    aliases = cache.get(final_path)
+    if aliases is not None:
+        return [tuple(alias) for alias in aliases]
+
+
+def cache_redirections(session, final_path, aliases):
+    """Remember ``aliases`` of the page of ``final_path`` during the
+    current :const:`CRAWL_INTERVAL`, so that other tasks don't look them up
+    again.
+
+    """
+    cache = get_store('tvtropes.redirections', session)
+    cache.set(final_path, [list(alias) for alias in aliases], CRAWL_INTERVAL)
+
+
+@OPERATION_SECONDS.time(operation='tvtropes.lookup_redirections')
+def lookup_redirections(session, original_url, final_url):
+    """Look up aliases of the page that ``original_url`` redirected to,
+    and return them as a list of ``(namespace, name)`` pairs.
+    :const:`RELATED_SEARCH` is requested at most once per
+    :const:`CRAWL_INTERVAL` for the same page.
+
+    """
+    final_path = get_redirection_path(original_url, final_url)
+    if final_path is None:
+        return []
+    aliases = get_cached_redirections(session, final_path)
+    if aliases is None:
+        related = http_get(RELATED_SEARCH + final_path)
+        aliases = parse_redirections(related.text)
+        cache_redirections(session, final_path, aliases)
+    return aliases
+
+
+def resolve_relations(session, keys, namespace, name):
+    """Make relations which were recorded with the url paths of a page
+    (see :func:`parse_wiki_url()`) point to the canonical ``namespace`` and
+    ``name`` of the page, now that it's crawled.
+
+    :param session: a database session
+    :param keys: url paths of the page as ``(namespace, name)`` pairs
+    :type keys: :class:`collections.abc.Iterable`
+    :param namespace: the canonical namespace of the page
+    :type namespace: :class:`str`
+    :param name: the canonical name of the page
+    :type name: :class:`str`
+
+    """
+    keys = {key for key in keys if key and key != (namespace, name)}
+    if not keys:
+        return
+    pending = or_(*(and_(Relation.destination_namespace == key_namespace,
+                         Relation.destination_name == key_name)
+                    for key_namespace, key_name in keys))
+    with session.begin():
+        resolved = set(
+            session.query(Relation.origin_namespace, Relation.origin_name)
+                   .filter_by(destination_namespace=namespace,
+                              destination_name=name)
+        )
+        for relation in session.query(Relation).filter(pending):
+            origin = relation.origin_namespace, relation.origin_name
+            if origin in resolved:
+                session.delete(relation)
+            else:
+                relation.destination_namespace = namespace
+                relation.destination_name = name
+                resolved.add(origin)
+
+
+def find_canonical_names(session, links):
+    """Find canonical names of already crawled pages among ``links``.
+
+    :param session: a database session
+    :param links: the mapping of urls to their url paths
+                  (see :func:`parse_wiki_url()`)
+    :type links: :class:`collections.abc.Mapping`
+    :returns: the mapping of url paths to canonical ``(namespace, name)``
+              pairs.  Pages never crawled are missing
+    :rtype: :class:`dict`
+
+    """
+    if not links:
+        return {}
+    canonical = {}
+    for namespace, name, url in session.query(
+            Entity.namespace, Entity.name, Entity.url
+    ).filter(Entity.url.in_(list(links))):
+        canonical[links[url]] = namespace, name
+    keys = set(links.values())
+    aliases = session.query(
+        Redirection.alias_namespace, Redirection.alias_name,
+        Redirection.original_namespace, Redirection.original_name
+    ).filter(Redirection.alias_name.in_({name for _, name in keys}))
+    for alias_namespace, alias_name, namespace, name in aliases:
+        if (alias_namespace, alias_name) in keys:
+            canonical.setdefault((alias_namespace, alias_name),
+                                 (namespace, name))
+    return canonical
+
+
+def get_validators(session, url):
+    """Get the ``namespace``, ``name``, ``etag`` and ``last_modified`` of
+    the already crawled page of the ``url``, or :const:`None`.
+
+    """
+    return session.query(
+        Entity.namespace, Entity.name, Entity.etag, Entity.last_modified
+    ).filter_by(url=url).first()
+
+
+def get_conditional_headers(validators):
+    """Make conditional request headers from the ``validators`` returned by
+    :func:`get_validators()`.
+
+    """
+    headers = {}
+    if validators is not None:
+        if validators.etag:
+            headers['If-None-Match'] = validators.etag
+        if validators.last_modified:
+            headers['If-Modified-Since'] = validators.last_modified
+    return headers
+
+
+def parse_page(text, chunk_size=16384):
+    """Extract the title and links in the wikitext out of a page.
+
+    Unlike :func:`~lxml.html.document_fromstring()`, it parses the page
+    incrementally, and stops as soon as both of the title and the wikitext
+    are parsed, so that the rest of the page (comments, sidebars, footers)
+    is never parsed.
+
+    :param text: the html of a page
+    :type text: :class:`str`
+    :param chunk_size: the number of characters to parse at once
+    :type chunk_size: :class:`int`
+    :returns: the title and hrefs.  the title is :const:`None` if the page
+              has no title
+    :rtype: :class:`Page`
+
+    """
+    parser = HTMLPullParser(events=('start', 'end'))
+    title = None
+    hrefs = []
+    in_wikitext = wikitext_done = False
+    for offset in range(0, len(text), chunk_size):
+        parser.feed(text[offset:offset + chunk_size])
+        for event, element in parser.read_events():
+            if event == 'start':
+                if not wikitext_done and element.tag == 'div' and \
+                   element.get('id') == 'wikitext':
+                    in_wikitext = True
+            elif in_wikitext and element.tag == 'a':
+                if element.get('class') == 'twikilink' and \
+                   element.get('href'):
+                    hrefs.append(element.get('href'))
+            elif in_wikitext and element.tag == 'div' and \
+                    element.get('id') == 'wikitext':
+                in_wikitext = False
+                wikitext_done = True
+            elif title is None and \
+                    'article_title' in element.get('class', '').split():
+                title = ''.join(element.itertext())
+        if wikitext_done and title is not None:
+            break
+    return Page(title, hrefs)
+
+
+def parse_title(title):
+    """Parse the namespace and the name out of the ``title`` of a page
+    e.g. ``('Film', 'Iron Man')`` from ``'Film: Iron Man'``.
+
+    """
+    *namespace, name = title.split(':')
+    name = name.strip()
+    namespace = 'Main' if not namespace else namespace[0]
+    return namespace, name
+
+
+def archive_page(url, response):
+    """Store the ``response`` of the ``url`` into the archive if
+    ``TVTROPES_ARCHIVE_PATH`` is configured.  See also
+    :mod:`cliche.services.tvtropes.archive`.
+
+    """
+    archive = get_archive()
+    if archive is not None:
+        archive.write(url, response.text)
+
+
+def read_page(url, response, validators=None, *, log_prefix=''):
+    '''Parse the ``response`` of the ``url`` without touching the database.
+    Returns result, page, namespace, name, final_url like :func:`fetch_link()`.
+
+    '''
+    logger = get_task_logger(__name__ + '.read_page')
+    if response.status_code == 304 and validators is not None:
+        logger.info('%s%s is not modified.', log_prefix, url)
+        return True, None, validators.namespace, validators.name, url
     try:
-        final_url = r.url[:r.url.index('?')]
+        final_url = response.url[:response.url.index('?')]
     except ValueError:
-        final_url = r.url
+        final_url = response.url
     if not is_wiki_page(final_url):
         return False, None, None, None, final_url
-    tree = document_fromstring(r.text)
-    try:
-        name = tree.find_class('article_title')[0].text_content()
-    except (AttributeError, AssertionError, IndexError):
+    with PARSE_SECONDS.time(service='tvtropes'):
+        page = parse_page(response.text)
+    if page.title is None:
         logger.warning('%sWarning on url %s: '
                        'There is no pagetitle on this page. Ignoring.',
                        log_prefix, url)
-        return False, tree, None, None, final_url
-    else:
-        *namespace, name = name.split(':')
-        name = name.strip()
-        namespace = 'Main' if not namespace else namespace[0]
-        type = determine_type(namespace)
-        if type == 'Administrivia':
-            return False, tree, namespace, name, final_url
-        upsert_entity(session, namespace, name, type, final_url)
-        process_redirections(session, url, final_url, namespace, name)
-        return True, tree, namespace, name, final_url
+        return False, page, None, None, final_url
+    namespace, name = parse_title(page.title)
+    if determine_type(namespace) == 'Administrivia':
+        return False, page, namespace, name, final_url
+    return True, page, namespace, name, final_url
+
+
+@DB_WRITE_SECONDS.time(operation='tvtropes.save_page')
+def save_page(session, url, final_url, namespace, name, headers, aliases):
+    """Save the page read by :func:`read_page()` and its ``aliases``."""
+    upsert_entity(session, namespace, name, determine_type(namespace),
+                  final_url,
+                  etag=headers.get('ETag'),
+                  last_modified=headers.get('Last-Modified'))
+    save_redirections(session, aliases, namespace, name)
+    resolve_relations(
+        session,
+        [parse_wiki_url(url), parse_wiki_url(final_url)] + aliases,
+        namespace, name
+    )
+
+
+@OPERATION_SECONDS.time(operation='tvtropes.fetch_link')
+def fetch_link(url, session, *, log_prefix=''):
+    '''Returns result, page, namespace, name, final_url.  The page is
+    a :class:`Page` parsed by :func:`parse_page()`.
+
+    If the page of the ``url`` was crawled before and hasn't been modified
+    since then, the returned page is :const:`None`.
+
+    '''
+    if not is_wiki_page(url):
+        return False, None, None, None, url
+    validators = get_validators(session, url)
+    r = http_get(url, headers=get_conditional_headers(validators))
+    result, page, namespace, name, final_url = read_page(
+        url, r, validators, log_prefix=log_prefix
+    )
+    if result and page is not None:
+        archive_page(final_url, r)
+        aliases = lookup_redirections(session, url, final_url)
+        save_page(session, url, final_url, namespace, name, r.headers,
+                  aliases)
+    return result, page, namespace, name, final_url
 
 
 def recently_crawled(current_time, url, session):
     logger = get_task_logger(__name__ + '.recently_crawled')
-    try:
-        last_crawled = session.query(Entity).filter_by(url=url) \
-                              .one().last_crawled
-        if last_crawled:
-            if current_time - last_crawled < CRAWL_INTERVAL:
-                logger.info('%s was recently crawled in %s days.',
-                            url, CRAWL_INTERVAL)
-                return True
-    except NoResultFound:
-        pass
+    last_crawled = session.query(func.max(Entity.last_crawled)) \
+                          .filter_by(url=url) \
+                          .scalar()
+    if last_crawled and current_time - last_crawled < CRAWL_INTERVAL:
+        logger.info('%s was recently crawled in %s days.',
+                    url, CRAWL_INTERVAL)
+        return True
     return False
 
 
+def admit_links(session, urls):
+    """Filter ``urls`` which are not enqueued yet during the current
+    :const:`CRAWL_INTERVAL`, and remember them in the crawl frontier so that
+    other tasks don't enqueue them again.
+
+    :param session: a database session
+    :param urls: urls to enqueue
+    :type urls: :class:`collections.abc.Iterable`
+    :returns: the list of urls to be enqueued
+    :rtype: :class:`list`
+
+    """
+    frontier = get_store('tvtropes.frontier', session)
+    return frontier.add_many(urls, CRAWL_INTERVAL)
+
+
+def release_links(session, urls):
+    """Forget ``urls`` admitted by :func:`admit_links()`, e.g. when crawling
+    them failed, so that they can be enqueued again during the current
+    :const:`CRAWL_INTERVAL`.
+
+    :param session: a database session
+    :param urls: urls to forget
+    :type urls: :class:`collections.abc.Iterable`
+
+    """
+    get_store('tvtropes.frontier', session).delete_many(urls)
+
+
 def is_wiki_page(url):
     return (BASE_URL not in url or WIKI_PAGE in url)
 
 
+def extract_links(page):
+    """Extract links to other wiki pages from the :class:`Page`.
+
+    :returns: the mapping of urls to their url paths
+              (see :func:`parse_wiki_url()`)
+    :rtype: :class:`dict`
+
+    """
+    links = {}
+    for href in page.hrefs:
+        destination_url = urllib.parse.urljoin(WIKI_PAGE, href)
+        key = parse_wiki_url(destination_url)
+        if key is None or determine_type(key[0]) == 'Administrivia':
+            continue
+        links[destination_url] = key
+    return links
+
+
+@DB_WRITE_SECONDS.time(operation='tvtropes.save_relations')
+def save_relations(session, namespace, name, links):
+    """Save relations from the page to ``links`` returned by
+    :func:`extract_links()`.
+
+    """
+    # destinations are not fetched here; they are named after their url
+    # paths until they are crawled by their own tasks.  see also
+    # resolve_relations()
+    canonical = find_canonical_names(session, links)
+    insert_ignore(session, Relation.__table__, [
+        {
+            'origin_namespace': namespace,
+            'origin_name': name,
+            'destination_namespace': destination_namespace,
+            'destination_name': destination_name,
+        }
+        for destination_namespace, destination_name in (
+            canonical.get(key, key) for key in links.values()
+        )
+    ])
+
+
+def reparse_archive(session, archive):
+    """Rebuild relations from pages in the ``archive`` without network
+    access.  Relations from each archived page are replaced by links
+    extracted again from the latest archived html of the page.
+
+    :param session: a database session
+    :param archive: the archive to read pages from
+    :type archive: :class:`~.archive.Archive`
+    :returns: the number of parsed pages
+    :rtype: :class:`int`
+
+    """
+    logger = get_task_logger(__name__ + '.reparse_archive')
+    parsed = 0
+    for archived in archive.pages():
+        page = parse_page(archive.read(archived))
+        if page.title is None:
+            continue
+        namespace, name = parse_title(page.title)
+        if determine_type(namespace) == 'Administrivia':
+            continue
+        with session.begin():
+            session.query(Relation) \
+                   .filter_by(origin_namespace=namespace, origin_name=name) \
+                   .delete(synchronize_session=False)
+            save_relations(session, namespace, name, extract_links(page))
+        parsed += 1
+        logger.info('Reparsed %s/%s @ %s', namespace, name, archived.url)
+    return parsed
+
+
+@DB_WRITE_SECONDS.time(operation='tvtropes.mark_crawled')
+def mark_crawled(session, url, current_time):
+    with session.begin():
+        session.query(Entity) \
+               .filter_by(url=url) \
+               .update({'last_crawled': current_time},
+                       synchronize_session=False)
+    PAGES.inc(service='tvtropes')
+
+
 @app.task
-def crawl_link(url):
+def crawl_link(url, run_id=None):
+    """Crawl the page of the ``url``, and enqueue pages it links to.
+
+    If ``run_id`` is given, the url is recorded as a partition of
+    the :class:`~cliche.services.runs.CrawlRun`, and so are linked pages.
+
+    """
     session = get_session()
+    with track(session, run_id, url):
+        _crawl_link(session, url, run_id)
+
+
+def _crawl_link(session, url, run_id):
     logger = get_task_logger(__name__ + '.crawl_link')
     current_time = datetime.datetime.now(datetime.timezone.utc)
     if recently_crawled(current_time, url, session):
         return
-    result, tree, namespace, name, url = fetch_link(url, session)
+    result, page, namespace, name, url = fetch_link(url, session)
     if not result:
         return
     # make sure that if redirected, final url is not also recently crawled.
     if recently_crawled(current_time, url, session):
         return
+    if page is None:
+        # not modified since the last crawl; its relations are still valid.
+        logger.info('%s/%s @ %s is not modified.', namespace, name, url)
+        mark_crawled(session, url, current_time)
+        return
     logger.info("Fetching: %s/%s @ %s", namespace, name, url)
-    for a in tree.xpath('//div[@id="wikitext"]//a[@class="twikilink"]'):
-        try:
-            destination_url = urllib.parse.urljoin(
-                WIKI_PAGE, a.attrib['href']
-            )
-            destination_result, destination_tree, destination_namespace, \
-                destination_name, destination_url = fetch_link(
-                    destination_url,
-                    session,
-                    log_prefix='(child) '
-                )
-            if not result:
-                return
-            try:
-                with session.begin():
-                    new_relation = Relation(
-                        origin_namespace=namespace,
-                        origin_name=name,
-                        destination_namespace=destination_namespace,
-                        destination_name=destination_name
-                    )
-                    session.add(new_relation)
-            except IntegrityError:
-                pass
-            # FIXME if next_crawl not in crawl_stack:
-            crawl_link.delay(destination_url)
-        except AttributeError:
-            pass
+    links = extract_links(page)
+    save_relations(session, namespace, name, links)
+    destination_urls = admit_links(session, links)
+    for destination_url in destination_urls:
+        crawl_link.delay(destination_url, run_id)
+    # added after they are queued, so that no pending url is left without
+    # its task (see :func:`~cliche.services.runs.resume_items()`)
+    add_items(session, run_id, destination_urls)
     logger.info('Crawling %s/%s @ %s completed at %s',
                 namespace, name, url, current_time)
-    with session.begin():
-        entity = session.query(Entity) \
-                        .filter_by(url=url) \
-                        .one()
-        entity.last_crawled = current_time
+    mark_crawled(session, url, current_time)
+
+
+def iter_stale_urls(session, current_time, chunk_size=None):
+    """Find urls of entities which were not crawled during the
+    :const:`CRAWL_INTERVAL` before ``current_time``, and yield them in
+    chunks.  Chunks are paginated by the last ``(namespace, name)`` key
+    instead of ``OFFSET``, and only urls are loaded, so that it takes flat
+    memory and time per chunk regardless of the size of the table.
+
+    :param session: a database session
+    :param current_time: the time to determine staleness
+    :type current_time: :class:`datetime.datetime`
+    :param chunk_size: the maximum number of urls per chunk.
+                       ``TVTROPES_SEED_BATCH_SIZE`` (100) by default
+    :type chunk_size: :class:`int`
+    :returns: lists of urls
+    :rtype: :class:`collections.abc.Iterator`
+
+    """
+    if chunk_size is None:
+        chunk_size = app.conf.get('TVTROPES_SEED_BATCH_SIZE', 100)
+    query = session.query(Entity.namespace, Entity.name, Entity.url).filter(
+        or_(Entity.last_crawled.is_(None),
+            Entity.last_crawled <= current_time - CRAWL_INTERVAL)
+    ).order_by(Entity.namespace, Entity.name)
+    last_namespace = last_name = None
+    while True:
+        chunk = query
+        if last_namespace is not None:
+            chunk = chunk.filter(or_(
+                Entity.namespace > last_namespace,
+                and_(Entity.namespace == last_namespace,
+                     Entity.name > last_name)
+            ))
+        rows = chunk.limit(chunk_size).all()
+        if not rows:
+            break
+        yield [url for _, _, url in rows]
+        last_namespace, last_name, _ = rows[-1]
 
 
 @app.task
 def crawl():
+    """Start a new run of crawling, or resume the unfinished run.  When
+    the run is resumed, only urls of the run which are left behind are
+    enqueued again (see :func:`~cliche.services.runs.resume_items()`).
+    Seeding is continued from its checkpoints whenever it's incomplete
+    (see :func:`is_seeding()`), however many entities there already are.
+
+    """
     session = get_session()
-    if session.query(Entity).count() < 1:
-        seeds = list(list_pages())
-        for url in seeds:
-            crawl_link.delay(url)
-    else:
-        for entity in session.query(Entity) \
-                             .order_by(Entity.namespace, Entity.name):
-            crawl_link.delay(entity.url)
+    # expired urls of the frontier and caches would be kept forever
+    # otherwise
+    for bucket in STORE_BUCKETS:
+        get_store(bucket, session).purge()
+    run_id, resumed = begin_run(session, 'tvtropes')
+
+    def enqueue(urls):
+        enqueue_links(urls, run_id)
+        add_items(session, run_id, urls)
+    if resumed:
+        for urls in resume_items(session, run_id):
+            enqueue_links(urls, run_id)
+    if needs_seeding(session):
+        seed_pages(session, enqueue)
+    elif not resumed:
+        current_time = datetime.datetime.now(datetime.timezone.utc)
+        for urls in iter_stale_urls(session, current_time):
+            urls = admit_links(session, urls)
+            if urls:
+                enqueue(urls)
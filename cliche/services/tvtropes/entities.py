@@ -21,10 +21,22 @@ class Entity(Base):
 
     namespace = Column(String, primary_key=True)
     name = Column(String, primary_key=True)
-    url = Column(String, nullable=False)
+
+    #: (:class:`str`) The url of the page.  It's indexed but not unique,
+    #: since an entity of the old title is left behind when the title
+    #: of a page is changed.
+    url = Column(String, nullable=False, index=True)
+
     last_crawled = Column(DateTime(timezone=True))
     type = Column(String, nullable=False)
 
+    #: (:class:`str`) The ``ETag`` header of the last fetched response.
+    etag = Column(String)
+
+    #: (:class:`str`) The ``Last-Modified`` header of the last fetched
+    #: response.
+    last_modified = Column(String)
+
     relations = relationship(
         lambda: Relation,
         foreign_keys=[namespace, name],
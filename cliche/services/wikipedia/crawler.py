@@ -16,61 +16,408 @@ References
 ----------
 """
 import datetime
+import functools
+import hashlib
+import random
+import time
 from http.client import IncompleteRead
-from urllib.error import HTTPError, URLError
 
+from celery import current_task
 from celery.utils.log import get_task_logger
-from SPARQLWrapper import JSON, SPARQLWrapper
-from SPARQLWrapper.SPARQLExceptions import EndPointNotFound
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy.sql.expression import func
+from requests import RequestException
+from sqlalchemy.sql.expression import and_, func
 
 from ...celery import app, get_session
+from ...metrics import (DB_WRITE_SECONDS, HTTP_SECONDS, OPERATION_SECONDS,
+                        PAGES, RETRIES, ROWS)
+from ...orm import insert_ignore, upsert
+from ..ratelimit import throttle, trip, tripped_until
+from ..runs import (DONE, FAILED, RUNNING, add_items, begin_run, format_error,
+                    record, resume_items, track)
+from ..store import get_store
+from .sparql import get_concurrency, get_sparql_client
 from .work import (
-    Artist, Book, Entity, Film, Relation, Work
+    Artist, Book, ClassCursor, Entity, Film, Relation, RelationPartition, Work
 )
 
 
 PAGE_ITEM_COUNT = 100
+RELATION_PREDICATES = [
+    'dbpprop:author',
+    'dbpedia-owl:writer',
+    'dbpedia-owl:author'
+]
+#: (:class:`list`) Sets of classes which :func:`crawl()` harvests.
+CRAWLED_CLASSES = [
+    ['dbpedia-owl:Artist'],
+    ['dbpedia-owl:Book', 'dbpedia-owl:Novel'],
+    ['dbpedia-owl:Cartoon'],
+    ['dbpedia-owl:Film'],
+    ['dbpedia-owl:Work'],
+]
+DBPEDIA_ENDPOINT = 'http://dbpedia.org/sparql'
+REVISION_PROPERTY = 'dbpedia-owl:wikiPageRevisionID'
+SPARQL_PREFIXES = '''PREFIX dbpedia-owl: <http://dbpedia.org/ontology/>
+    PREFIX dbpprop: <http://dbpedia.org/property/>'''
+SPARQL_ERRORS = (ConnectionResetError, IncompleteRead, RequestException,
+                 ValueError, KeyError)
+
+
+def chunks(iterable, size):
+    """Split the ``iterable`` into lists of ``size`` items.  The last list
+    can be shorter.
+
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 def get_wikipedia_limit():
     return app.conf.get('WIKIPEDIA_RETRY_LIMIT', 20)
 
 
-def select_dbpedia(query):
+class DBpediaUnavailable(Exception):
+    """Raised when DBpedia didn't respond even after retries, or the circuit
+    breaker of DBpedia is open because it recently did so.  It differs from
+    an empty result, so that callers never take a failure as the end of
+    results.
+
+    """
+
+
+def get_backoff(tried):
+    """Get seconds to wait after ``tried`` attempts failed.  It's chosen
+    randomly up to ``WIKIPEDIA_RETRY_BACKOFF`` (1) seconds doubled for each
+    attempt, but up to ``WIKIPEDIA_RETRY_BACKOFF_MAX`` (60) seconds, so that
+    workers don't retry at the same time.
+
+    """
+    base = app.conf.get('WIKIPEDIA_RETRY_BACKOFF', 1)
+    cap = app.conf.get('WIKIPEDIA_RETRY_BACKOFF_MAX', 60)
+    return random.uniform(0, min(cap, base * 2 ** (tried - 1)))
+
+
+class AdaptivePageSize(object):
+    """The number of rows per page which adapts to the endpoint.  It grows
+    twice while full pages are returned faster than ``fast`` seconds,
+    and shrinks by half whenever a request fails e.g. timeouts,
+    :exc:`~http.client.IncompleteRead`.
+
+    :param size: the initial size.  ``WIKIPEDIA_PAGE_SIZE``
+                 (:const:`PAGE_ITEM_COUNT`) by default
+    :type size: :class:`int`
+    :param minimum: the minimum size.  ``WIKIPEDIA_MIN_PAGE_SIZE`` (10)
+                    by default
+    :type minimum: :class:`int`
+    :param maximum: the maximum size.  ``WIKIPEDIA_MAX_PAGE_SIZE`` (10000,
+                    the limit of DBpedia) by default
+    :type maximum: :class:`int`
+    :param fast: responses faster than it are considered fast, in seconds.
+                 ``WIKIPEDIA_FAST_RESPONSE`` (5) by default
+    :type fast: :class:`float`
+
+    """
+
+    def __init__(self, size=None, minimum=None, maximum=None, fast=None):
+        conf = app.conf
+        self.minimum = minimum or conf.get('WIKIPEDIA_MIN_PAGE_SIZE', 10)
+        self.maximum = maximum or conf.get('WIKIPEDIA_MAX_PAGE_SIZE', 10000)
+        self.fast = fast or conf.get('WIKIPEDIA_FAST_RESPONSE', 5)
+        size = size or conf.get('WIKIPEDIA_PAGE_SIZE', PAGE_ITEM_COUNT)
+        self.size = min(self.maximum, max(self.minimum, size))
+
+    def succeeded(self, limit, count, elapsed):
+        """Adapt to a successful request.
+
+        :param limit: the number of rows requested
+        :type limit: :class:`int`
+        :param count: the number of rows returned
+        :type count: :class:`int`
+        :param elapsed: how long the request took in seconds
+        :type elapsed: :class:`float`
+
+        """
+        if count >= limit and elapsed < self.fast:
+            self.size = min(self.maximum, max(self.size, limit * 2))
+
+    def failed(self, limit):
+        """Adapt to a failed request of ``limit`` rows."""
+        self.size = max(self.minimum, min(self.size, limit // 2))
+
+
+def get_page_size(kind):
+    """Get the :class:`AdaptivePageSize` of the ``kind`` of queries,
+    shared in the current process.
+
+    """
+    page_sizes = app.conf.get('WIKIPEDIA_PAGE_SIZES')
+    if page_sizes is None:
+        page_sizes = {}
+        app.conf['WIKIPEDIA_PAGE_SIZES'] = page_sizes
+    try:
+        return page_sizes[kind]
+    except KeyError:
+        page_size = AdaptivePageSize()
+        page_sizes[kind] = page_size
+        return page_size
+
+
+def get_query_cache():
+    """Get the store of cached query results, or :const:`None` if results
+    can't be cached, i.e. ``WIKIPEDIA_QUERY_CACHE_TTL`` is 0, or it's
+    outside of tasks while the store needs the database session of a task.
+
+    """
+    if not app.conf.get('WIKIPEDIA_QUERY_CACHE_TTL', 86400):
+        return None
+    if current_task._get_current_object() is not None:
+        session = get_session()
+    elif app.conf.get('STORE_BACKEND', 'database') == 'memory':
+        session = None
+    else:
+        return None
+    return get_store('wikipedia.queries', session)
+
+
+def get_query_key(query):
+    """Get the cache key of the ``query``, which ignores differences of
+    whitespaces.
+
+    """
+    normalized = ' '.join(query.split())
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+def select_dbpedia(query, page_size=None, cache=False, client=None):
+    """Send a SPARQL ``query`` to DBpedia, retrying up to
+    ``WIKIPEDIA_RETRY_LIMIT`` times with backoff (see :func:`get_backoff()`).
+
+    If every attempt fails, it opens the circuit breaker of DBpedia for
+    ``WIKIPEDIA_CIRCUIT_TIMEOUT`` (300) seconds, i.e. queries of every
+    worker sharing the rate limit backend (see
+    :mod:`cliche.services.ratelimit`) fail immediately meanwhile, instead of
+    hammering the overloaded endpoint.
+
+    :param query: the query.  if ``page_size`` is given, a function which
+                  takes the number of rows and returns the query instead
+    :type query: :class:`str`, :class:`collections.abc.Callable`
+    :param page_size: the page size to adapt to responses
+    :type page_size: :class:`AdaptivePageSize`
+    :param cache: whether to reuse the result of the same query for
+                  ``WIKIPEDIA_QUERY_CACHE_TTL`` (86400) seconds.  results
+                  which expire earliest are evicted if there are more than
+                  ``WIKIPEDIA_QUERY_CACHE_SIZE`` (1000) results.  it can't
+                  be used with ``page_size``
+    :type cache: :class:`bool`
+    :param client: the pooled client to send the query.  the shared client
+                   by default
+    :type client: :class:`~.sparql.SparqlClient`
+    :return: rows
+    :rtype: :class:`list`
+    :raise DBpediaUnavailable: if every attempt failed, or the circuit
+                               breaker is open
+
+    """
+    if cache:
+        if page_size is not None:
+            raise TypeError('page_size cannot be cached')
+        store = get_query_cache()
+        if store is not None:
+            key = get_query_key(query)
+            rows = store.get(key)
+            if rows is None:
+                rows = select_dbpedia(query, client=client)
+                ttl = app.conf.get('WIKIPEDIA_QUERY_CACHE_TTL', 86400)
+                store.set(key, rows, datetime.timedelta(seconds=ttl))
+                store.evict(app.conf.get('WIKIPEDIA_QUERY_CACHE_SIZE', 1000))
+            return rows
+    return select_dbpedia_many([query], page_size, client)[0]
+
+
+@OPERATION_SECONDS.time(operation='wikipedia.select_dbpedia')
+def select_dbpedia_many(queries, page_size=None, client=None):
+    """Send SPARQL ``queries`` to DBpedia at once.  Failed queries are
+    retried together like :func:`select_dbpedia()` does.
+
+    :param queries: queries.  if ``page_size`` is given, functions which
+                    take the number of rows and return queries instead
+    :type queries: :class:`collections.abc.Sequence`
+    :param page_size: the page size to adapt to responses
+    :type page_size: :class:`AdaptivePageSize`
+    :param client: the pooled client to send queries at once.  the shared
+                   client by default
+    :type client: :class:`~.sparql.SparqlClient`
+    :return: rows of each query, in the order of ``queries``
+    :rtype: :class:`list`
+    :raise DBpediaUnavailable: if every attempt of any query failed, or
+                               the circuit breaker is open
+
+    """
     logger = get_task_logger(__name__ + '.select_dbpedia')
-    sparql = SPARQLWrapper("http://dbpedia.org/sparql")
-    sparql.setReturnFormat(JSON)
-    sparql.setQuery('''PREFIX dbpedia-owl: <http://dbpedia.org/ontology/>
-    PREFIX dbpprop: <http://dbpedia.org/property/>'''+query)
+    if client is None:
+        client = get_sparql_client(DBPEDIA_ENDPOINT)
+    send = functools.partial(send_client, client)
+    results = [None] * len(queries)
+    pending = list(range(len(queries)))
+    tried = 0
+    wikipedia_limit = get_wikipedia_limit()
+    while pending and tried < wikipedia_limit:
+        check_circuit()
+        tried = tried + 1
+        if page_size is None:
+            limit = None
+            texts = [queries[i] for i in pending]
+        else:
+            limit = page_size.size
+            texts = [queries[i](limit) for i in pending]
+        for _ in texts:
+            throttle(DBPEDIA_ENDPOINT)
+        texts = [SPARQL_PREFIXES + text for text in texts]
+        responses = client.map(send, texts)
+        failed = []
+        for i, (tuples, elapsed) in zip(pending, responses):
+            if isinstance(tuples, Exception):
+                logger.warning('%r, tried %d/%d', tuples, tried,
+                               wikipedia_limit, exc_info=tuples)
+                failed.append(i)
+                continue
+            if page_size is not None:
+                page_size.succeeded(limit, len(tuples), elapsed)
+            results[i] = [{k: v['value'] for k, v in tupl.items()}
+                          for tupl in tuples]
+            PAGES.inc(service='wikipedia')
+            ROWS.inc(len(tuples), service='wikipedia')
+        pending = failed
+        if not pending:
+            return results
+        if page_size is not None:
+            page_size.failed(limit)
+        if tried < wikipedia_limit:
+            RETRIES.inc(len(pending), service='wikipedia')
+            time.sleep(get_backoff(tried))
+    give_up(tried)
+
+
+def stream_dbpedia(query, page_size=None, client=None):
+    """Send a SPARQL ``query`` to DBpedia like :func:`select_dbpedia()`,
+    but yield rows one by one while the response is being received.
+
+    Attempts are retried only until the first row is yielded.  If the
+    response is cut after that, :exc:`DBpediaUnavailable` is raised, so
+    callers can keep rows already yielded, e.g. rows ordered by a keyset.
+
+    :param query: the query.  if ``page_size`` is given, a function which
+                  takes the number of rows and returns the query instead
+    :type query: :class:`str`, :class:`collections.abc.Callable`
+    :param page_size: the page size to adapt to responses
+    :type page_size: :class:`AdaptivePageSize`
+    :param client: the pooled client to send the query.  the shared client
+                   by default
+    :type client: :class:`~.sparql.SparqlClient`
+    :return: rows
+    :rtype: :class:`collections.abc.Iterator`
+    :raise DBpediaUnavailable: if every attempt failed, the response is
+                               cut, or the circuit breaker is open
+
+    """
+    logger = get_task_logger(__name__ + '.stream_dbpedia')
+    if client is None:
+        client = get_sparql_client(DBPEDIA_ENDPOINT)
     tried = 0
     wikipedia_limit = get_wikipedia_limit()
     while tried < wikipedia_limit:
+        check_circuit()
+        tried = tried + 1
+        if page_size is None:
+            text = query
+        else:
+            limit = page_size.size
+            text = query(limit)
+        throttle(DBPEDIA_ENDPOINT)
+        rows = client.stream(SPARQL_PREFIXES + text)
+        # only time spent receiving rows counts, not time the caller spends
+        # on each row while this generator is suspended
+        elapsed = 0.0
+        count = 0
         try:
-            tried = tried + 1
-            tuples = sparql.query().convert()['results']['bindings']
-        except HTTPError as e:
-            logger.exception('HTTPError %s: %s, tried %d/%d',
-                             e.code, e.reason, tried, wikipedia_limit)
-        except URLError as e:
-            logger.exception('URLError %s, tried %d/%d',
-                             e.args, tried, wikipedia_limit)
-        except ConnectionResetError as e:
-            logger.exception('ConnectionResetError %s', e)
-        except IncompleteRead as e:
-            logger.exception('Network Error, retry %d', tried)
-        except EndPointNotFound as e:
-            logger.exception('SQLAlchemy Error, retry %d', tried)
+            while True:
+                started = time.monotonic()
+                try:
+                    row = next(rows, None)
+                finally:
+                    elapsed += time.monotonic() - started
+                if row is None:
+                    break
+                count += 1
+                ROWS.inc(service='wikipedia')
+                yield row
+        except SPARQL_ERRORS as e:
+            count_request(elapsed)
+            if count:
+                raise DBpediaUnavailable(
+                    'the response was cut after {} rows'.format(count)
+                ) from e
+            logger.warning('%r, tried %d/%d', e, tried, wikipedia_limit,
+                           exc_info=e)
         else:
-            return[{k: v['value'] for k, v in tupl.items()} for tupl in tuples]
-    return []
+            count_request(elapsed)
+            PAGES.inc(service='wikipedia')
+            if page_size is not None:
+                page_size.succeeded(limit, count, elapsed)
+            return
+        if page_size is not None:
+            page_size.failed(limit)
+        if tried < wikipedia_limit:
+            RETRIES.inc(service='wikipedia')
+            time.sleep(get_backoff(tried))
+    give_up(tried)
+
+
+def check_circuit():
+    until = tripped_until(DBPEDIA_ENDPOINT)
+    if until is not None:
+        raise DBpediaUnavailable('DBpedia is paused until ' +
+                                 until.isoformat())
+
+
+def give_up(tried):
+    timeout = app.conf.get('WIKIPEDIA_CIRCUIT_TIMEOUT', 300)
+    trip(DBPEDIA_ENDPOINT, datetime.timedelta(seconds=timeout))
+    raise DBpediaUnavailable('DBpedia failed {} times'.format(tried))
+
+
+def count_request(elapsed):
+    """Count the latency of a request to DBpedia which took ``elapsed``
+    seconds in :mod:`cliche.metrics`, and return the seconds.  Requests
+    themselves are counted by :class:`~.sparql.SparqlClient`.
+
+    """
+    HTTP_SECONDS.observe(elapsed, service='wikipedia')
+    return elapsed
+
+
+def send_client(client, text):
+    started = time.monotonic()
+    try:
+        tuples = client.query(text)
+    except SPARQL_ERRORS as e:
+        count_request(time.monotonic() - started)
+        return e, None
+    return tuples, count_request(time.monotonic() - started)
 
 
-def select_property(s, s_name='property', return_json=False):
+def select_property(s, s_name='property', return_json=False, cache=True):
     """Get properties of a ontology.
 
     :param str s: Ontology name of subject.
+    :param bool cache: Whether to reuse the cached result.  See also
+                       :func:`select_dbpedia()`.
     :return: list of objects which contain properties.
     :rtype: :class:`list`
 
@@ -112,7 +459,7 @@ def select_property(s, s_name='property', return_json=False):
         }}
     }}'''.format(s, s)
 
-    properties = select_dbpedia(query)
+    properties = select_dbpedia(query, cache=cache)
 
     if return_json:
         return properties
@@ -124,10 +471,12 @@ def select_property(s, s_name='property', return_json=False):
         return tuples
 
 
-def count_by_relation(p):
+def count_by_relation(p, cache=True):
     """Get count of all works
 
     :param list p: List of properties
+    :param bool cache: Whether to reuse the cached result.  See also
+                       :func:`select_dbpedia()`.
     :rtype: :class:`int`
     """
 
@@ -144,17 +493,19 @@ def count_by_relation(p):
     }}
     '''.format(filt=' || '.join('?p = %s\n' % x for x in p))
 
-    cnt = select_dbpedia(query)
+    cnt = select_dbpedia(query, cache=cache)
     if cnt:
         return int(cnt[0]['callret-0'])
     else:
         return 0
 
 
-def count_by_class(class_list):
+def count_by_class(class_list, cache=True):
     """Get count of a ontology class
 
     :param list class_list: List of properties
+    :param bool cache: Whether to reuse the cached result.  See also
+                       :func:`select_dbpedia()`.
     :rtype: :class:`int`
     """
 
@@ -168,24 +519,41 @@ def count_by_class(class_list):
     }}'''.format(classes=' UNION '.join('{ ?subject a %s . }'
                                         % x for x in class_list))
 
-    cnt = select_dbpedia(query)
+    cnt = select_dbpedia(query, cache=cache)
     if cnt:
         return int(cnt[0]['callret-0'])
     else:
         return 0
 
 
-def select_by_relation(p, revision, s_name='subject', o_name='object', page=1):
+def select_by_relation(p, revision, s_name='subject', o_name='object',
+                       until=None, limit=None, client=None, stream=False):
     """Find author of something
 
     Retrieves the list of s_name and o_name, the relation is
-    a kind of ontology properties.
+    a kind of ontology properties.  Rows are ordered by revision, and
+    paginated by the last revision of the previous page instead of
+    ``OFFSET``, which DBpedia executes in time proportional to the offset.
 
     :param list p: List of properties between s_name and o_name.
+    :param revision: Only subjects of revisions greater than it are
+                     retrieved.  Pass the last revision of the previous page
+                     to get the next page.
+    :type revision: :class:`int`
     :param str s_name: Name of subject. It doesn't affect the results.
     :param str o_name: Name of object. It doesn't affect the results.
-    :param page: The offset of query, each page will return 100 entities.
-    :type page: :class:`int`
+    :param until: Only subjects of revisions less than or equal to it are
+                  retrieved if it's given.
+    :type until: :class:`int`
+    :param limit: The number of rows per page.  It adapts to responses of
+                  the endpoint by default (see :class:`AdaptivePageSize`).
+    :type limit: :class:`int`
+    :param client: The pooled client to send the query.  See also
+                   :func:`select_dbpedia()`.
+    :type client: :class:`~.sparql.SparqlClient`
+    :param stream: Whether to yield rows while the response is being
+                   received.  See also :func:`stream_dbpedia()`.
+    :type stream: :class:`bool`
     :return: list of a dict mapping keys to the matching table row fetched.
     :rtype: :class:`list`
 
@@ -193,7 +561,7 @@ def select_by_relation(p, revision, s_name='subject', o_name='object', page=1):
 
         select_by_relation(s_name='work',
         p=['dbpprop:author', 'dbpedia-owl:writer', 'dbpedia-owl:author'],
-        o_name='author', page=0)
+        o_name='author', revision=0)
 
 
     .. code-block:: json
@@ -208,11 +576,32 @@ def select_by_relation(p, revision, s_name='subject', o_name='object', page=1):
        }]
 
     When the row has more than two items, the items are combined by EOL.
+    """
+    make_query = relation_query(p, revision, s_name, o_name, until)
+    if limit is None:
+        page_size = get_page_size('relation')
+    else:
+        page_size = None
+        make_query = make_query(limit)
+    if stream:
+        return stream_dbpedia(make_query, page_size, client)
+    return select_dbpedia(make_query, page_size, client=client)
+
+
+def relation_query(p, revision, s_name='subject', o_name='object',
+                   until=None):
+    """Make the query of :func:`select_by_relation()`.
+
+    :returns: a function which takes the number of rows and returns
+              the query
+    :rtype: :class:`collections.abc.Callable`
+
     """
     if not p:
         raise ValueError('at least one property required')
 
-    query = '''SELECT DISTINCT
+    def make_query(limit):
+        return '''SELECT DISTINCT
         ?{s_name}
         ?{s_name}_label
         ?{o_name}
@@ -228,19 +617,47 @@ def select_by_relation(p, revision, s_name='subject', o_name='object', page=1):
         (  {filt}  )
         && STRSTARTS(STR(?{s_name}), "http://dbpedia.org/")) .
         ?{s_name} dbpedia-owl:wikiPageRevisionID ?revision .
-        FILTER( ?revision > {revision} )
+        FILTER( ?revision > {revision} {until} )
     }}
     GROUP BY ?{s_name}
-    LIMIT {limit}
-    OFFSET {offset}'''.format(
-        s_name=s_name,
-        o_name=o_name,
-        filt=' || '.join('?p = %s\n' % x for x in p),
-        limit=PAGE_ITEM_COUNT,
-        offset=PAGE_ITEM_COUNT * page,
-        revision=revision,
-    )
-    return select_dbpedia(query)
+    ORDER BY ?revision
+    LIMIT {limit}'''.format(
+            s_name=s_name,
+            o_name=o_name,
+            filt=' || '.join('?p = %s\n' % x for x in p),
+            limit=limit,
+            revision=revision,
+            until='' if until is None else '&& ?revision <= %d' % until,
+        )
+    return make_query
+
+
+def max_revision_by_relation(p):
+    """Get the latest revision of works which have any of properties.
+
+    :param list p: List of properties
+    :rtype: :class:`int`
+    """
+
+    if not p:
+        raise ValueError('at least one property required')
+
+    query = '''SELECT
+        max(?revision)
+    WHERE {{
+        ?work ?p ?author .
+    FILTER(
+        (  {filt}  )
+        && STRSTARTS(STR(?work), "http://dbpedia.org/")) .
+        ?work dbpedia-owl:wikiPageRevisionID ?revision .
+    }}
+    '''.format(filt=' || '.join('?p = %s\n' % x for x in p))
+
+    revision = select_dbpedia(query)
+    if revision:
+        return int(revision[0]['callret-0'])
+    else:
+        return 0
 
 
 def parse_entity(entity):
@@ -254,14 +671,29 @@ def parse_entity(entity):
     return col_name
 
 
-def select_by_class(s, s_name='subject',  p={}, entities=[], page=1):
+def select_by_class(s, s_name='subject',  p={}, entities=[], offset=0,
+                    limit=None, revision=None, client=None, stream=False):
     """List of **s** which as property as **entities**
 
     :param str s: Ontology name of subject.
     :param str s_name: Name of subject. It doesn't affect the results.
     :param list entities: List of property ontologies.
-    :param page: The offset of query, each page will return 100 entities.
-    :type page: :class:`int`
+    :param offset: The number of rows to skip.
+    :type offset: :class:`int`
+    :param revision: If it's given, only subjects of later revisions than
+                     it are retrieved in revision order instead, and
+                     ``offset`` is ignored.  Pass the last revision of
+                     a page to get the next page.
+    :type revision: :class:`int`
+    :param limit: The number of rows per page.  It adapts to responses of
+                  the endpoint by default (see :class:`AdaptivePageSize`).
+    :type limit: :class:`int`
+    :param client: The pooled client to send the query.  See also
+                   :func:`select_dbpedia()`.
+    :type client: :class:`~.sparql.SparqlClient`
+    :param stream: Whether to yield rows while the response is being
+                   received.  See also :func:`stream_dbpedia()`.
+    :type stream: :class:`bool`
     :return: list of a dict mapping keys which have 'entities' as property.
     :rtype: :class:`list`
 
@@ -289,70 +721,181 @@ def select_by_class(s, s_name='subject',  p={}, entities=[], page=1):
     if not s:
         raise ValueError('at least one class required')
 
-    query = '''SELECT DISTINCT
+    if revision is None:
+        optional_entities = entities
+        revision_filter = order = ''
+        paging = 'OFFSET %d' % offset
+    else:
+        # keyset pagination; subjects without revisions can't be paged
+        # this way, so the revision is required.
+        revision_name = parse_entity(REVISION_PROPERTY)
+        optional_entities = [entity for entity in entities
+                             if entity != REVISION_PROPERTY]
+        entities = optional_entities + [REVISION_PROPERTY]
+        revision_filter = '''?{0} {1} ?{2} .
+            FILTER( ?{2} > {3} )'''.format(s_name, REVISION_PROPERTY,
+                                           revision_name, int(revision))
+        order = 'ORDER BY ?' + revision_name
+        paging = ''
+
+    def make_query(limit):
+        query = '''SELECT DISTINCT
         ?{s_name}
         {entities}
         WHERE {{
             {is_in_class}
             {has_property}
             {optional_properties}
+            {revision_filter}
         }}
         GROUP BY ?{s_name}
+        {order}
         LIMIT {limit}
-        OFFSET {offset}'''.format(
-        s_name=s_name,
-        entities='\n'.join('?%s'
-                           % parse_entity(entity) for entity in entities),
-        is_in_class=' UNION '.join('{ ?%s a %s . }\n'
-                                   % (s_name, x) for x in s),
-        has_property=''.join('UNION { ?%s %s ?prop . }\n'
-                             % (s_name, prop) for prop in p),
-        optional_properties=''.join('OPTIONAL { ?%s %s ?%s . }\n'
-                                    % (s_name, entity, parse_entity(entity))
-                                    for entity in entities),
-        limit=PAGE_ITEM_COUNT,
-        offset=PAGE_ITEM_COUNT * page
-    )
-    query = query.replace('?label . ',
-                          '?label .  filter langMatches( lang(?label), "EN" )')
+        {paging}'''.format(
+            s_name=s_name,
+            entities='\n'.join('?%s'
+                               % parse_entity(entity) for entity in entities),
+            is_in_class=' UNION '.join('{ ?%s a %s . }\n'
+                                       % (s_name, x) for x in s),
+            has_property=''.join('UNION { ?%s %s ?prop . }\n'
+                                 % (s_name, prop) for prop in p),
+            optional_properties=''.join(
+                'OPTIONAL { ?%s %s ?%s . }\n'
+                % (s_name, entity, parse_entity(entity))
+                for entity in optional_entities
+            ),
+            revision_filter=revision_filter,
+            order=order,
+            limit=limit,
+            paging=paging
+        )
+        return query.replace(
+            '?label . ',
+            '?label .  filter langMatches( lang(?label), "EN" )'
+        )
 
-    return select_dbpedia(query)
+    if limit is None:
+        page_size = get_page_size('class')
+    else:
+        page_size = None
+        make_query = make_query(limit)
+    if stream:
+        return stream_dbpedia(make_query, page_size, client)
+    return select_dbpedia(make_query, page_size, client=client)
+
+
+def entity_row(object_, item, current_time):
+    entity = object_.initialize(item)
+    mapper = object_.__mapper__
+    row = {prop.columns[0].name: getattr(entity, prop.key)
+           for prop in mapper.column_attrs}
+    row['type'] = mapper.polymorphic_identity
+    row['last_crawled'] = current_time
+    return row
+
+
+@DB_WRITE_SECONDS.time(operation='wikipedia.save_entities')
+def save_entities(session, object_, items, current_time):
+    """Save entities of ``items`` as ``object_`` at once.
+
+    Existing entities of superclasses of ``object_`` become of ``object_``,
+    but ones of more specific classes remain as they are, so that e.g. a film
+    is never turned into a work.
+
+    """
+    rows = [entity_row(object_, item, current_time) for item in items]
+    if not rows:
+        return
+    mapper = object_.__mapper__
+    superclasses = [m.polymorphic_identity for m in mapper.iterate_to_root()
+                    if m is not mapper]
+    table = Entity.__table__
+    with session.begin(subtransactions=True):
+        upsert(session, table, rows, update_columns=[
+            name for name in rows[0] if name not in ('name', 'type')
+        ])
+        if superclasses:
+            session.execute(table.update().where(and_(
+                table.c.name.in_([row['name'] for row in rows]),
+                table.c.type.in_(superclasses)
+            )).values(type=mapper.polymorphic_identity))
 
 
 @app.task
-def fetch_classes(page, object_, identity):
-    logger = get_task_logger(__name__ + '.fetch_classes')
+def fetch_classes(offset, object_, identity, revision=None, run_id=None):
+    """Fetch a page of entities of the ``identity`` classes after
+    ``offset`` rows, and return the number of fetched rows.
+
+    If ``revision`` is given, the page of entities of later revisions than
+    it is fetched instead, and the :class:`~.work.ClassCursor` ledger of
+    the classes advances to the last revision of the page in the same
+    transaction as entities of the page.
+
+    If ``WIKIPEDIA_STREAM`` is :const:`True`, entities are saved every
+    ``WIKIPEDIA_STREAM_BATCH_SIZE`` (100) rows while the page is being
+    received (see :func:`stream_dbpedia()`).
+
+    If ``run_id`` is given, the classes are recorded as a partition of
+    the :class:`~cliche.services.runs.CrawlRun`, which is done when
+    an empty page is fetched.
+
+    """
     session = get_session()
+    partition = get_classes_partition(identity)
+    record(session, run_id, partition, RUNNING, page=revision)
+    try:
+        count = save_classes(session, offset, object_, identity, revision)
+    except Exception as e:
+        record(session, run_id, partition, FAILED, error=format_error(e))
+        raise
+    if not count:
+        record(session, run_id, partition, DONE)
+    return count
+
+
+def save_classes(session, offset, object_, identity, revision):
+    logger = get_task_logger(__name__ + '.fetch_classes')
+    stream = app.conf.get('WIKIPEDIA_STREAM', False)
     res = select_by_class(
         s=identity,
         s_name='name',
         entities=object_.PROPERTIES,
-        page=page,
+        offset=offset,
         p=object_.TYPE_PREDICATES,
+        revision=revision,
+        stream=stream,
     )
+    if stream:
+        batches = chunks(res, app.conf.get('WIKIPEDIA_STREAM_BATCH_SIZE', 100))
+    else:
+        batches = [res]
 
     current_time = datetime.datetime.now(datetime.timezone.utc)
-    logger.warning('fetching %s, %d', identity, len(res))
-    for item in res:
-        try:
-            with session.begin():
-                new_entity = object_.initialize(item)
-                new_entity.last_crawled = current_time
-                new_entity = session.merge(new_entity)
-                session.add(new_entity)
-        except IntegrityError:
-            entities = session.query(object_) \
-                .filter_by(
-                    name=item['name']
-                )
-            if entities.count() > 0:
-                entity = entities.one()
-                entity.last_crawled = current_time
-                entity.initalize(item)
-
-
-def crawl_classes(identity):
-    entity_num = count_by_class(identity)
+    count = 0
+    for batch in batches:
+        with session.begin():
+            save_entities(session, object_, batch, current_time)
+            if revision is not None and batch:
+                revision_name = parse_entity(REVISION_PROPERTY)
+                session.query(ClassCursor) \
+                       .filter_by(classes=' '.join(identity)) \
+                       .update({
+                           'revision': max(int(item[revision_name])
+                                           for item in batch)
+                       }, synchronize_session=False)
+        count += len(batch)
+    logger.warning('fetching %s, %d', identity, count)
+    return count
+
+
+@app.task
+def crawl_classes(identity, run_id=None):
+    """Harvest entities of the ``identity`` classes incrementally.  Only
+    entities of later revisions than the :class:`~.work.ClassCursor` ledger
+    of the classes are fetched, i.e. new or edited entities since the last
+    crawl.
+
+    """
     sql_classes = {
         'dbpedia-owl:Artist': Artist,
         'dbpedia-owl:Book': Book,
@@ -361,68 +904,242 @@ def crawl_classes(identity):
         'dbpedia-owl:Relation': Relation,
         'dbpedia-owl:Work': Work
     }
+    session = get_session()
+    classes = ' '.join(identity)
+    insert_ignore(session, ClassCursor.__table__,
+                  [{'classes': classes, 'revision': 0}])
+    cursor = session.query(ClassCursor.revision).filter_by(classes=classes)
+    # the page size adapts to the endpoint, so a short page doesn't mean
+    # the last page.
+    while fetch_classes(0, sql_classes.get(identity[0], Entity), identity,
+                        revision=cursor.scalar(), run_id=run_id):
+        pass
 
-    for x in range(0, entity_num // PAGE_ITEM_COUNT + 1):
-        fetch_classes(x, sql_classes.get(identity[0], Entity), identity)
+
+def get_classes_partition(identity):
+    """Get the :class:`~cliche.services.runs.CrawlRunItem` partition of
+    the ``identity`` classes.
+
+    """
+    return 'classes:' + ' '.join(identity)
+
+
+def get_relation_partition(low, high):
+    """Get the :class:`~cliche.services.runs.CrawlRunItem` partition of
+    relations whose revisions are in ``(low, high]``.
+
+    """
+    return 'relation:{}:{}'.format(low, high)
+
+
+def split_range(low, high, count):
+    """Split ``(low, high]`` into at most ``count`` ranges of the same
+    width.
+
+    :returns: pairs of ``(low, high]``
+    :rtype: :class:`list`
+
+    """
+    if high <= low:
+        return []
+    width = max(1, -(-(high - low) // max(1, count)))
+    return [(start, min(start + width, high))
+            for start in range(low, high, width)]
+
+
+def plan_relation_partitions(session, low, high, count=None):
+    """Split revisions in ``(low, high]`` into partitions, and record them
+    in the :class:`~.work.RelationPartition` ledger.  Partitions already in
+    the ledger are left as they are.
+
+    :param session: a database session
+    :param low: the exclusive lower bound of revisions
+    :type low: :class:`int`
+    :param high: the inclusive upper bound of revisions
+    :type high: :class:`int`
+    :param count: the number of partitions.
+                  ``WIKIPEDIA_RELATION_PARTITIONS`` (16) by default
+    :type count: :class:`int`
+
+    """
+    if count is None:
+        count = app.conf.get('WIKIPEDIA_RELATION_PARTITIONS', 16)
+    insert_ignore(session, RelationPartition.__table__, [
+        {'low': start, 'high': end, 'cursor': start}
+        for start, end in split_range(low, high, count)
+    ])
 
 
 @app.task
-def crawl_relation(page, relation_num, revision):
-    session = get_session()
-    res = select_by_relation(
-        p=[
-            'dbpprop:author',
-            'dbpedia-owl:writer',
-            'dbpedia-owl:author'
-        ],
-        revision=revision,
-        s_name='work',
-        o_name='author',
-        page=page
-    )
+def crawl_relation(low, high, run_id=None):
+    """Harvest relations of works whose revisions are in ``(low, high]``.
 
-    for item in res:
-        with session.begin():
-            new_entity = Relation(
-                work=item.get('work', ''),
-                work_label=item.get('work_label', ''),
-                author=item.get('author', ''),
-                author_label=item.get('author_label', ''),
-                revision=item.get('revision', ''),
-            )
-            session.add(new_entity)
-
-    result_len = len(res)
-    current_retrieved = (page * PAGE_ITEM_COUNT) + result_len
-    if (relation_num <= current_retrieved and result_len == PAGE_ITEM_COUNT):
-        crawl_relation.delay(
-            page + 1,
-            current_retrieved + PAGE_ITEM_COUNT,
-            revision
+    Pages are fetched in revision order, and the last fetched revision is
+    saved to the :class:`~.work.RelationPartition` ledger in the same
+    transaction as relations of the page, so that a retried or duplicated
+    task continues from the next page instead of fetching pages again.
+    If DBpedia is unavailable, :exc:`DBpediaUnavailable` is raised and the
+    partition remains incomplete, so that the next :func:`crawl()`
+    continues it.
+
+    If ``WIKIPEDIA_CONCURRENCY`` (see :func:`~.sparql.get_concurrency()`)
+    is more than 1, the partition is split into as many slices, and a page
+    of each slice is fetched at once through the pooled
+    :class:`~.sparql.SparqlClient`.
+
+    If ``WIKIPEDIA_STREAM`` is :const:`True` instead, relations and the
+    ledger are saved every ``WIKIPEDIA_STREAM_BATCH_SIZE`` (100) rows while
+    each page is being received (see :func:`stream_dbpedia()`).
+
+    If ``run_id`` is given, the partition is recorded as a partition of
+    the :class:`~cliche.services.runs.CrawlRun` as well.
+
+    """
+    session = get_session()
+    plan_relation_partitions(session, low, high, count=1)
+    partition = session.query(RelationPartition.cursor,
+                              RelationPartition.completed_at) \
+                       .filter_by(low=low, high=high) \
+                       .one()
+    with track(session, run_id, get_relation_partition(low, high),
+               page=partition.cursor):
+        if partition.completed_at is not None:
+            return
+        if app.conf.get('WIKIPEDIA_STREAM', False):
+            stream_relations(session, low, high, partition.cursor)
+        else:
+            fetch_relations(session, low, high, partition.cursor)
+
+
+def fetch_relations(session, low, high, cursor):
+    logger = get_task_logger(__name__ + '.crawl_relation')
+    concurrency = get_concurrency()
+    # the rest of the partition is split into slices, whose pages are
+    # fetched at once.  the ledger cursor is the cursor of the first
+    # incomplete slice, since every revision before it is fetched.
+    slices = split_range(cursor, high, concurrency)
+    cursors = [slice_low for slice_low, _ in slices]
+    page_size = get_page_size('relation')
+    last = cursor
+    while slices:
+        queries = [
+            relation_query(p=RELATION_PREDICATES, revision=cursor,
+                           until=slice_high, s_name='work', o_name='author')
+            for cursor, (_, slice_high) in zip(cursors, slices)
+        ]
+        pages = select_dbpedia_many(queries, page_size)
+        res = [item for page in pages for item in page]
+        # the page size adapts to the endpoint, so a short page doesn't
+        # mean the last page.
+        for i, page in enumerate(pages):
+            if page:
+                cursors[i] = max(int(item['revision']) for item in page)
+                last = max(last, cursors[i])
+        incomplete = [i for i, page in enumerate(pages) if page]
+        slices = [slices[i] for i in incomplete]
+        cursors = [cursors[i] for i in incomplete]
+        cursor = cursors[0] if cursors else last
+        save_relations(session, low, high, res, cursor, not slices)
+        logger.info('fetched %d relations in (%d, %d], until %d',
+                    len(res), low, high, cursor)
+
+
+def stream_relations(session, low, high, cursor):
+    logger = get_task_logger(__name__ + '.crawl_relation')
+    batch_size = app.conf.get('WIKIPEDIA_STREAM_BATCH_SIZE', 100)
+    while True:
+        rows = select_by_relation(
+            p=RELATION_PREDICATES,
+            revision=cursor,
+            until=high,
+            s_name='work',
+            o_name='author',
+            stream=True
         )
+        fetched = 0
+        # rows are ordered by revision, so the ledger can advance to
+        # the last revision of each batch.
+        for batch in chunks(rows, batch_size):
+            cursor = max(int(item['revision']) for item in batch)
+            save_relations(session, low, high, batch, cursor, False)
+            fetched += len(batch)
+        if not fetched:
+            save_relations(session, low, high, [], cursor, True)
+            break
+        logger.info('fetched %d relations in (%d, %d], until %d',
+                    fetched, low, high, cursor)
+
+
+@DB_WRITE_SECONDS.time(operation='wikipedia.save_relations')
+def save_relations(session, low, high, rows, cursor, completed):
+    """Save relations of ``rows``, and the ``cursor`` of the partition
+    ``(low, high]`` to the ledger in the same transaction.
 
-    if app.conf['CELERY_ALWAYS_EAGER']:
-        return
+    """
+    with session.begin():
+        upsert(session, Relation.__table__, [
+            {
+                'work': item.get('work', ''),
+                'work_label': item.get('work_label', ''),
+                'author': item.get('author', ''),
+                'author_label': item.get('author_label', ''),
+                'revision': int(item['revision']),
+            }
+            for item in rows
+        ])
+        values = {'cursor': cursor}
+        if completed:
+            values['completed_at'] = \
+                datetime.datetime.now(datetime.timezone.utc)
+        session.query(RelationPartition) \
+               .filter_by(low=low, high=high) \
+               .update(values, synchronize_session=False)
 
 
 @app.task
 def crawl():
-    relation_revision = \
-        get_session().query(func.max(Relation.revision)).scalar()
-    if not relation_revision:
-        relation_revision = 0
-    relation_num = count_by_relation(
-        p=[
-            'dbpprop:author',
-            'dbpedia-owl:writer',
-            'dbpedia-owl:author'
-        ]
-    )
-    for x in range(0, relation_num // PAGE_ITEM_COUNT + 1):
-        crawl_relation.delay(x, relation_num, relation_revision)
-
-    crawl_classes(['dbpedia-owl:Artist'])
-    crawl_classes(['dbpedia-owl:Book', 'dbpedia-owl:Novel'])
-    crawl_classes(['dbpedia-owl:Cartoon'])
-    crawl_classes(['dbpedia-owl:Film'])
-    crawl_classes(['dbpedia-owl:Work'])
+    """Start a new run of crawling, or resume the unfinished run.
+
+    A new run plans relation partitions up to the latest revision, and
+    harvests every set of :data:`CRAWLED_CLASSES`.  A resumed run only
+    continues its partitions which are left behind (see
+    :func:`~cliche.services.runs.resume_items()`).
+
+    """
+    session = get_session()
+    run_id, resumed = begin_run(session, 'wikipedia')
+    if resumed:
+        partitions = [partition
+                      for chunk in resume_items(session, run_id)
+                      for partition in chunk]
+    else:
+        low = session.query(func.max(RelationPartition.high)).scalar()
+        if low is None:
+            low = session.query(func.max(Relation.revision)).scalar() or 0
+        high = max_revision_by_relation(p=RELATION_PREDICATES)
+        plan_relation_partitions(session, low, high)
+        incompleted = session.query(RelationPartition.low,
+                                    RelationPartition.high) \
+            .filter(RelationPartition.completed_at.is_(None)) \
+            .order_by(RelationPartition.low)
+        partitions = [get_relation_partition(partition_low, partition_high)
+                      for partition_low, partition_high in incompleted]
+        partitions.extend(get_classes_partition(identity)
+                          for identity in CRAWLED_CLASSES)
+    relations = []
+    classes = []
+    for partition in partitions:
+        kind, key = partition.split(':', 1)
+        if kind == 'relation':
+            partition_low, partition_high = map(int, key.split(':'))
+            crawl_relation.delay(partition_low, partition_high, run_id)
+            relations.append(partition)
+        elif kind == 'classes':
+            classes.append(key.split(' '))
+    # added after they are queued, so that no pending partition is left
+    # without its task (see :func:`~cliche.services.runs.resume_items()`).
+    # classes aren't queued but harvested right below, and each of them is
+    # recorded when it starts
+    add_items(session, run_id, relations)
+    for identity in classes:
+        crawl_classes(identity, run_id)
@@ -0,0 +1,293 @@
+""":mod:`cliche.services.wikipedia.dump` --- DBpedia dump importer
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+An alternative to :mod:`cliche.services.wikipedia.crawler` which loads
+`DBpedia dumps`__ instead of querying the live SPARQL endpoint::
+
+    $ cliche import-dbpedia -c CONFIG_FILE \
+        instance_types_en.nt.bz2 labels_en.nt.bz2 \
+        page_ids_en.nt.bz2 revision_ids_en.nt.bz2 \
+        mappingbased_properties_en.nt.bz2 raw_infobox_properties_en.nt.bz2
+
+Dumps are N-Triples files, optionally compressed using bzip2 (:file:`.bz2`)
+or gzip (:file:`.gz`).  Turtle dumps which DBpedia publishes are also
+accepted, since they are written a triple per line as well.
+
+Files are streamed line by line twice, so that memory doesn't depend on
+the size of dumps:
+
+1. ``rdf:type`` triples of the classes :func:`~.crawler.crawl()`
+   harvests make rows of :class:`~.work.Entity`.
+2. Triples of :attr:`~.work.Entity.PROPERTIES` of entity classes update
+   those rows, and triples of :data:`~.crawler.RELATION_PREDICATES` make
+   rows of :class:`~.work.Relation`.
+
+Lastly labels and revisions of relations are filled from entities.
+
+__ http://wiki.dbpedia.org/Downloads
+
+"""
+import bz2
+import datetime
+import gzip
+import re
+
+from celery.utils.log import get_task_logger
+from sqlalchemy.sql.expression import and_, bindparam, select
+
+from ...celery import app
+from ...orm import insert_ignore, upsert
+from .crawler import RELATION_PREDICATES, chunks
+from .work import Artist, Book, Entity, Film, Relation, Work, url_to_label
+
+__all__ = ('CLASS_TYPES', 'PREFIXES', 'PROPERTY_COLUMNS', 'expand',
+           'import_dump', 'open_dump', 'parse_triple', 'read_triples')
+
+
+#: (:class:`dict`) Namespaces of prefixes used by queries.
+PREFIXES = {
+    'dbpedia-owl': 'http://dbpedia.org/ontology/',
+    'dbpprop': 'http://dbpedia.org/property/',
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'rdfs': 'http://www.w3.org/2000/01/rdf-schema#',
+}
+
+#: (:class:`dict`) Polymorphic identities of :class:`~.work.Entity` by
+#: classes, which :func:`~.crawler.crawl()` harvests.
+CLASS_TYPES = {
+    'dbpedia-owl:Artist': 'artist',
+    'dbpedia-owl:Book': 'book',
+    'dbpedia-owl:Novel': 'book',
+    'dbpedia-owl:Cartoon': 'entity',
+    'dbpedia-owl:Film': 'film',
+    'dbpedia-owl:Work': 'work',
+}
+
+#: (:class:`dict`) Column names of properties, and functions to convert
+#: values to them.  Only properties in ``PROPERTIES`` of entity classes are
+#: imported.
+PROPERTY_COLUMNS = {
+    'dbpedia-owl:wikiPageRevisionID': ('revision', int),
+    'rdfs:label': ('label', str),
+    'dbpprop:country': (
+        'country',
+        lambda value: url_to_label(value)
+        if value.startswith('http://dbpedia.org/resource/')
+        else value.strip().lower()
+    ),
+    'dbpedia-owl:notableWork': ('notable_work', str),
+    'dbpedia-owl:writer': ('writer', str),
+    'dbpedia-owl:author': ('author', str),
+    'dbpedia-owl:mainCharacter': ('main_character', str),
+    'dbpedia-owl:previousWork': ('previous_work', str),
+    'dbpedia-owl:director': ('director', str),
+    'dbpedia-owl:illustrator': ('illustrator', str),
+    'dbpedia-owl:isbn': ('isbn', str),
+    'dbpedia-owl:numberOfPages': ('number_of_pages', int),
+}
+
+#: (:class:`dict`) Ranks of polymorphic identities.  An entity of several
+#: classes takes the most specific one.
+TYPE_RANKS = {'entity': 0, 'artist': 1, 'work': 2, 'film': 3, 'book': 3}
+
+TRIPLE_PATTERN = re.compile(
+    r'^<([^>]*)>\s+<([^>]*)>\s+'
+    r'(?:<([^>]*)>|"((?:[^"\\]|\\.)*)"(?:@([-A-Za-z0-9]+)|\^\^<[^>]*>)?)'
+    r'\s*\.\s*$'
+)
+ESCAPE_PATTERN = re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)')
+ESCAPES = {'t': '\t', 'b': '\b', 'n': '\n', 'r': '\r', 'f': '\f'}
+
+
+def expand(name):
+    """Expand a prefixed ``name`` e.g. ``'rdfs:label'`` to its uri."""
+    prefix, local = name.split(':', 1)
+    return PREFIXES[prefix] + local
+
+
+def unescape(match):
+    escape = match.group(1)
+    if escape[0] in 'uU':
+        return chr(int(escape[1:], 16))
+    return ESCAPES.get(escape, escape)
+
+
+def parse_triple(line):
+    """Parse a line of N-Triples.
+
+    :param line: a line
+    :type line: :class:`str`
+    :returns: the subject, the predicate, the object, and the language tag
+              of the object (:const:`None` if it's not a literal of
+              a language), or :const:`None` if the line isn't a triple
+    :rtype: :class:`tuple`
+
+    """
+    match = TRIPLE_PATTERN.match(line)
+    if match is None:
+        return None
+    subject, predicate, uri, literal, language = match.groups()
+    if uri is None:
+        return subject, predicate, ESCAPE_PATTERN.sub(unescape, literal), \
+            language
+    return subject, predicate, uri, None
+
+
+def open_dump(path):
+    """Open a dump file as text, decompressing it if its name ends with
+    :file:`.bz2` or :file:`.gz`.
+
+    """
+    path = str(path)
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rt', encoding='utf-8')
+    elif path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def read_triples(paths):
+    """Stream triples of dump files of ``paths``.  Lines which aren't
+    triples e.g. comments, ``@prefix`` are ignored.
+
+    """
+    for path in paths:
+        with open_dump(path) as f:
+            for line in f:
+                triple = parse_triple(line)
+                if triple is not None:
+                    yield triple
+
+
+def get_properties():
+    properties = set()
+    for cls in Entity, Artist, Work, Film, Book:
+        properties.update(cls.PROPERTIES)
+    return {expand(name): PROPERTY_COLUMNS[name]
+            for name in properties if name in PROPERTY_COLUMNS}
+
+
+def import_types(session, paths, batch_size, current_time):
+    table = Entity.__table__
+    classes = {expand(name): type_ for name, type_ in CLASS_TYPES.items()}
+    rdf_type = expand('rdf:type')
+    triples = (
+        (subject, classes[object_])
+        for subject, predicate, object_, _ in read_triples(paths)
+        if predicate == rdf_type and object_ in classes
+    )
+    count = 0
+    for chunk in chunks(triples, batch_size):
+        types = {}
+        for subject, type_ in chunk:
+            if TYPE_RANKS[type_] >= TYPE_RANKS[types.get(subject, 'entity')]:
+                types[subject] = type_
+        with session.begin():
+            insert_ignore(session, table, [
+                {'name': subject, 'type': type_,
+                 'label': url_to_label(subject),
+                 'last_crawled': current_time}
+                for subject, type_ in types.items()
+            ])
+            for type_ in set(types.values()):
+                # upgrade entities of less specific types
+                lower = [t for t, rank in TYPE_RANKS.items()
+                         if rank < TYPE_RANKS[type_]]
+                if not lower:
+                    continue
+                session.execute(table.update().where(and_(
+                    table.c.name.in_([s for s, t in types.items()
+                                      if t == type_]),
+                    table.c.type.in_(lower)
+                )).values(type=type_))
+        count += len(chunk)
+    return count
+
+
+def import_properties(session, paths, batch_size):
+    table = Entity.__table__
+    properties = get_properties()
+    label = expand('rdfs:label')
+    relation_predicates = {expand(name) for name in RELATION_PREDICATES}
+    updates = {}
+    relations = {}
+    count = 0
+
+    def flush_updates(column):
+        rows = updates.pop(column)
+        statement = table.update() \
+                         .where(table.c.name == bindparam('entity_name')) \
+                         .values({column: bindparam('value')})
+        with session.begin():
+            session.execute(statement, rows)
+
+    def flush_relations():
+        upsert(session, Relation.__table__, relations.values())
+        relations.clear()
+
+    for subject, predicate, object_, language in read_triples(paths):
+        if predicate in relation_predicates and \
+           subject.startswith('http://dbpedia.org/'):
+            relations[subject] = {'work': subject, 'author': object_}
+            if len(relations) >= batch_size:
+                flush_relations()
+        if predicate not in properties:
+            continue
+        if predicate == label and not (language or '').startswith('en'):
+            continue
+        column, convert = properties[predicate]
+        try:
+            value = convert(object_)
+        except ValueError:
+            continue
+        rows = updates.setdefault(column, [])
+        rows.append({'entity_name': subject, 'value': value})
+        count += 1
+        if len(rows) >= batch_size:
+            flush_updates(column)
+    for column in list(updates):
+        flush_updates(column)
+    flush_relations()
+    return count
+
+
+def fill_relations(session):
+    entities = Entity.__table__
+    relations = Relation.__table__
+
+    def entity_column(column, name):
+        return select([column]).where(entities.c.name == name) \
+                               .limit(1).as_scalar()
+    with session.begin():
+        session.execute(relations.update().values(
+            work_label=entity_column(entities.c.label, relations.c.work),
+            author_label=entity_column(entities.c.label, relations.c.author),
+            revision=entity_column(entities.c.revision, relations.c.work),
+        ))
+
+
+def import_dump(session, paths, batch_size=None):
+    """Import DBpedia dump files.
+
+    :param session: a database session
+    :type session: :class:`~cliche.orm.Session`
+    :param paths: paths of dump files.  they are read twice
+    :type paths: :class:`collections.abc.Sequence`
+    :param batch_size: the number of rows per statement.
+                       ``WIKIPEDIA_DUMP_BATCH_SIZE`` (1000) by default
+    :type batch_size: :class:`int`
+    :returns: the numbers of type triples and property triples read
+    :rtype: :class:`tuple`
+
+    """
+    logger = get_task_logger(__name__ + '.import_dump')
+    if batch_size is None:
+        batch_size = app.conf.get('WIKIPEDIA_DUMP_BATCH_SIZE', 1000)
+    paths = list(paths)
+    current_time = datetime.datetime.now(datetime.timezone.utc)
+    types = import_types(session, paths, batch_size, current_time)
+    logger.info('imported %d types', types)
+    properties = import_properties(session, paths, batch_size)
+    logger.info('imported %d properties', properties)
+    fill_relations(session)
+    return types, properties
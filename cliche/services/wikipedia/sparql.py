@@ -0,0 +1,240 @@
+""":mod:`cliche.services.wikipedia.sparql` --- Pooled SPARQL client
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+:class:`SparqlClient` keeps HTTP connections to a SPARQL endpoint alive,
+and sends several queries at once from a thread pool, so that a single
+task can keep as many queries in flight as the endpoint allows::
+
+    client = get_sparql_client('http://dbpedia.org/sparql')
+    pages = client.map(client.query, queries)
+
+Results can also be streamed using :meth:`SparqlClient.stream()`, which
+decodes bindings one by one while the response is being received, so that
+callers can process rows before the whole response arrives, and a large
+response is never loaded at once.
+
+It only sends queries and decodes results.  Retries, rate limits and
+the circuit breaker are up to callers, e.g.
+:func:`~cliche.services.wikipedia.crawler.select_dbpedia()`.
+
+"""
+import codecs
+import concurrent.futures
+import json
+import re
+
+from celery.signals import worker_process_init
+from requests import RequestException, Session
+from requests.adapters import HTTPAdapter
+
+from ...celery import app
+from ...metrics import HTTP_BYTES, HTTP_REQUESTS
+
+__all__ = ('DEFAULT_CONCURRENCY', 'SparqlClient', 'get_concurrency',
+           'get_sparql_client', 'iter_bindings', 'reset_sparql_client')
+
+#: (:class:`int`) The maximum number of queries in flight to an endpoint
+#: if ``WIKIPEDIA_CONCURRENCY`` is not configured.
+DEFAULT_CONCURRENCY = 1
+
+BINDINGS_PATTERN = re.compile(r'"bindings"\s*:\s*\[')
+SEPARATOR_PATTERN = re.compile(r'[\s,]*')
+
+
+def iter_bindings(chunks):
+    """Decode result bindings from ``chunks`` of a SPARQL JSON result
+    incrementally.
+
+    :param chunks: pieces of the JSON text
+    :type chunks: :class:`collections.abc.Iterable`
+    :returns: flattened bindings, i.e. mappings of variable names to values
+    :rtype: :class:`collections.abc.Iterator`
+    :raise ValueError: if the text is not a SPARQL JSON result, or is cut
+
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ''
+    while True:
+        match = BINDINGS_PATTERN.search(buffer)
+        if match is not None:
+            break
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError('bindings are missing')
+        buffer += chunk
+    position = match.end()
+    while True:
+        position = SEPARATOR_PATTERN.match(buffer, position).end()
+        if buffer.startswith(']', position):
+            return
+        try:
+            binding, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            # the binding is not received entirely yet
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise ValueError('bindings are cut')
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield {k: v['value'] for k, v in binding.items()}
+
+
+def get_concurrency():
+    """Get the maximum number of queries in flight to an endpoint,
+    configured by ``WIKIPEDIA_CONCURRENCY``.
+
+    :returns: :const:`DEFAULT_CONCURRENCY` if it's not configured
+    :rtype: :class:`int`
+
+    """
+    return app.conf.get('WIKIPEDIA_CONCURRENCY', DEFAULT_CONCURRENCY)
+
+
+def count_bytes(chunks):
+    for chunk in chunks:
+        HTTP_BYTES.inc(len(chunk), service='wikipedia')
+        yield chunk
+
+
+class SparqlClient(object):
+    """The pooled client of a SPARQL endpoint.
+
+    :param endpoint: the url of the endpoint
+    :type endpoint: :class:`str`
+    :param concurrency: the maximum number of queries in flight.
+                        :func:`get_concurrency()` by default
+    :type concurrency: :class:`int`
+    :param timeout: seconds to wait for a response.
+                    ``WIKIPEDIA_TIMEOUT`` (120) by default
+    :type timeout: :class:`float`
+
+    """
+
+    def __init__(self, endpoint, concurrency=None, timeout=None):
+        if concurrency is None:
+            concurrency = get_concurrency()
+        if timeout is None:
+            timeout = app.conf.get('WIKIPEDIA_TIMEOUT', 120)
+        self.endpoint = endpoint
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.concurrency)
+        self.http = Session()
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+        self.http.headers['Accept'] = 'application/sparql-results+json'
+        self.executor = None
+
+    def post(self, query, **kwargs):
+        """Send a ``query``, and count the request in :mod:`cliche.metrics`
+        by its status code.
+
+        :param query: the SPARQL query
+        :type query: :class:`str`
+        :returns: the response
+        :rtype: :class:`requests.Response`
+        :raise requests.RequestException: if the request failed
+
+        """
+        try:
+            response = self.http.post(self.endpoint, data={'query': query},
+                                      timeout=self.timeout, **kwargs)
+        except RequestException:
+            HTTP_REQUESTS.inc(service='wikipedia', status='error')
+            raise
+        HTTP_REQUESTS.inc(service='wikipedia', status=response.status_code)
+        return response
+
+    def query(self, query):
+        """Send a ``query``, and return its result bindings.
+
+        :param query: the SPARQL query
+        :type query: :class:`str`
+        :returns: bindings of the result, i.e. mappings of variable names to
+                  mappings of ``'type'`` and ``'value'``
+        :rtype: :class:`list`
+        :raise requests.RequestException: if the request failed
+
+        """
+        response = self.post(query)
+        HTTP_BYTES.inc(len(response.content), service='wikipedia')
+        response.raise_for_status()
+        return response.json()['results']['bindings']
+
+    def stream(self, query, chunk_size=16384):
+        """Send a ``query``, and yield its result bindings one by one while
+        the response is being received.
+
+        :param query: the SPARQL query
+        :type query: :class:`str`
+        :param chunk_size: the number of bytes to read at once
+        :type chunk_size: :class:`int`
+        :returns: flattened bindings, i.e. mappings of variable names to
+                  values
+        :rtype: :class:`collections.abc.Iterator`
+        :raise requests.RequestException: if the request failed
+        :raise ValueError: if the response is not a result, or is cut
+
+        """
+        response = self.post(query, stream=True)
+        try:
+            response.raise_for_status()
+            # JSON is encoded in UTF-8 unless specified
+            yield from iter_bindings(codecs.iterdecode(
+                count_bytes(response.iter_content(chunk_size)),
+                response.encoding or 'utf-8'
+            ))
+        finally:
+            response.close()
+
+    def map(self, function, iterable):
+        """Call the ``function`` with each item of the ``iterable`` from
+        the thread pool, e.g. to send several queries at once.  At most
+        :attr:`concurrency` calls run at the same time.
+
+        :returns: results in the order of the ``iterable``
+        :rtype: :class:`list`
+
+        """
+        items = list(iterable)
+        if len(items) < 2 or self.concurrency < 2:
+            return [function(item) for item in items]
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.concurrency
+            )
+        return list(self.executor.map(function, items))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.http.close()
+
+
+def get_sparql_client(endpoint):
+    """Get the shared client of the ``endpoint``.
+
+    :param endpoint: the url of the endpoint
+    :type endpoint: :class:`str`
+    :returns: the client
+    :rtype: :class:`SparqlClient`
+
+    """
+    client = app.conf.get('WIKIPEDIA_SPARQL_CLIENT')
+    if client is None or client.endpoint != endpoint:
+        client = SparqlClient(endpoint)
+        app.conf['WIKIPEDIA_SPARQL_CLIENT'] = client
+    return client
+
+
+@worker_process_init.connect
+def reset_sparql_client(**kwargs):
+    """Drop the client inherited from the parent process, so that forked
+    workers never share pooled sockets and threads.
+
+    """
+    app.conf['WIKIPEDIA_SPARQL_CLIENT'] = None
@@ -16,8 +16,8 @@ from ...orm import Base
 from ...work import Work as ClicheWork
 
 
-__all__ = ('ClicheWikipediaEdge', 'Entity', 'Relation', 'Artist', 'Work',
-           'Film', 'Book')
+__all__ = ('ClassCursor', 'ClicheWikipediaEdge', 'Entity', 'Relation',
+           'RelationPartition', 'Artist', 'Work', 'Film', 'Book')
 
 
 def url_to_label(url):
@@ -75,6 +75,48 @@ class Relation(Base):
     __repr_columns__ = work, work_label, author, author_label, revision
 
 
+class RelationPartition(Base):
+    """The ledger of a revision range of :class:`Relation` harvesting.
+    See also :func:`~cliche.services.wikipedia.crawler.crawl_relation()`.
+
+    """
+
+    #: (:class:`int`) The exclusive lower bound of revisions.
+    low = Column(Integer, primary_key=True)
+
+    #: (:class:`int`) The inclusive upper bound of revisions.
+    high = Column(Integer, primary_key=True)
+
+    #: (:class:`int`) The last revision fetched so far.  The next page
+    #: starts after it.
+    cursor = Column(Integer, nullable=False)
+
+    #: (:class:`datetime.datetime`) The time every page of the partition
+    #: was fetched.  :const:`None` if it's not completed yet.
+    completed_at = Column(DateTime(timezone=True))
+
+    __tablename__ = 'wikipedia_relation_partitions'
+    __repr_columns__ = low, high, cursor, completed_at
+
+
+class ClassCursor(Base):
+    """The ledger of :class:`Entity` harvesting of DBpedia classes.
+    See also :func:`~cliche.services.wikipedia.crawler.crawl_classes()`.
+
+    """
+
+    #: (:class:`str`) Names of the classes harvested together, separated
+    #: by spaces e.g. ``'dbpedia-owl:Book dbpedia-owl:Novel'``.
+    classes = Column(String, primary_key=True)
+
+    #: (:class:`int`) The latest revision fetched so far.  Later crawls
+    #: fetch only entities of newer revisions.
+    revision = Column(Integer, nullable=False)
+
+    __tablename__ = 'wikipedia_class_cursors'
+    __repr_columns__ = classes, revision
+
+
 class Artist(Entity):
     """Representation of artist as an ontology."""
     TYPE_PREDICATES = {
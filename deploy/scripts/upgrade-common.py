@@ -39,7 +39,7 @@ def main():
                     'sudo',
                     '-ucliche',
                     'which',
-                    'python3.4',
+                    'python3.7',
                 ],
                 universal_newlines=True
             ).strip(),
@@ -15,9 +15,9 @@ except ImportError:
 from setuptools.command.test import test
 
 
-if sys.version_info < (3, 3, 0):
+if sys.version_info < (3, 7, 0):
     warnings.warn(
-        'Cliche requires Python 3.3 or higher; the currently running '
+        'Cliche requires Python 3.7 or higher; the currently running '
         'Python version is: ' + sys.version
     )
 
@@ -32,7 +32,7 @@ def readme():
 
 install_requires = {
     # Entity classes
-    'SQLAlchemy >= 1.0.0',
+    'SQLAlchemy >= 1.1.0',
     'alembic >= 0.7.5',
     # Configuration
     'PyYAML >= 3.11',
@@ -44,8 +44,6 @@ install_requires = {
     # Web
     'Flask >= 0.10.1',
     'Werkzeug >= 0.10.4',
-    # Sparql
-    'SPARQLWrapper >= 1.6.2',
     # CLI
     'click >= 4.0',
     # Locale
@@ -59,12 +57,6 @@ install_requires = {
     'blinker >= 1.3',
 }
 
-if sys.version_info < (3, 4, 0):
-    install_requires |= {
-        'pathlib >= 1.0',
-        'enum34 >= 1.0',
-    }
-
 tests_require = {
     'pytest >= 2.6.4',
     'cssselect >= 0.9.1',
@@ -244,7 +236,7 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Operating System :: MacOS :: MacOS X',
         'Operating System :: POSIX :: Linux',
-        'Programming Language :: Python :: 3.3',
+        'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: Implementation :: CPython',
         'Topic :: Database',
         'Topic :: Documentation',
@@ -1,13 +1,20 @@
+import datetime
 import json
 import os.path
+import re
 
+from pytest import raises
 from sqlalchemy.sql.expression import func
 
+from cliche.services.runs import DONE, RUNNING, CrawlRunItem, record
 from cliche.services.wikipedia import crawler as dbpedia
+from cliche.services.wikipedia.sparql import SparqlClient
 from cliche.services.wikipedia.work import (
-    Artist, Book, Entity, Film, Relation, Work
+    Artist, Book, ClassCursor, Entity, Film, Relation, RelationPartition, Work
 )
 
+from .sparql_dbpedia_test import fake_query
+
 
 def test_revision_crawler(monkeypatch, fx_session, fx_celery_app):
     class FakeQuery(object):
@@ -20,7 +27,7 @@ def test_revision_crawler(monkeypatch, fx_session, fx_celery_app):
                 }
             }
 
-    monkeypatch.setattr("SPARQLWrapper.SPARQLWrapper.query", FakeQuery)
+    monkeypatch.setattr(SparqlClient, 'query', fake_query(FakeQuery))
 
     relation_num = dbpedia.count_by_relation(
         p=[
@@ -42,11 +49,29 @@ def test_revision_crawler(monkeypatch, fx_session, fx_celery_app):
                 FakeQuery.offset += 100
                 return {"results": {"bindings": fakeResult}}
 
-    monkeypatch.setattr("SPARQLWrapper.SPARQLWrapper.query", FakeQuery)
-    dbpedia.crawl_relation(1, relation_num, 0)
+    monkeypatch.setattr(SparqlClient, 'query', fake_query(FakeQuery))
+    dbpedia.crawl_relation(0, 2 ** 31 - 1)
     num = fx_session.query(Relation).count()
-    assert fx_session.query(func.max(Relation.revision)).scalar() > 0
+    max_revision = fx_session.query(func.max(Relation.revision)).scalar()
+    assert max_revision > 0
     assert num == 100
+    partition = fx_session.query(RelationPartition).one()
+    assert partition.cursor == max_revision
+    assert partition.completed_at is not None
+    # the completed partition is never fetched again
+    dbpedia.crawl_relation(0, 2 ** 31 - 1)
+    assert FakeQuery.offset == 200
+
+
+def test_plan_relation_partitions(fx_session, fx_celery_app):
+    dbpedia.plan_relation_partitions(fx_session, 0, 10, count=4)
+    dbpedia.plan_relation_partitions(fx_session, 0, 10, count=4)
+    dbpedia.plan_relation_partitions(fx_session, 10, 10, count=4)
+    partitions = fx_session.query(RelationPartition) \
+                           .order_by(RelationPartition.low)
+    assert [(p.low, p.high, p.cursor) for p in partitions] == [
+        (0, 3, 0), (3, 6, 3), (6, 9, 6), (9, 10, 9)
+    ]
 
 
 def test_fetch_Entity(monkeypatch, fx_session, fx_celery_app):
@@ -62,7 +87,7 @@ def test_fetch_Entity(monkeypatch, fx_session, fx_celery_app):
                 FakeQuery.offset += 100
                 return {"results": {"bindings": fakeResult}}
 
-    monkeypatch.setattr("SPARQLWrapper.SPARQLWrapper.query", FakeQuery)
+    monkeypatch.setattr(SparqlClient, 'query', fake_query(FakeQuery))
 
     dbpedia.fetch_classes(1, Entity, [
         'dbpedia-owl:Cartoon',
@@ -89,7 +114,7 @@ def test_fetch_Artist(monkeypatch, fx_session, fx_celery_app):
                 FakeQuery.offset += 100
                 return {"results": {"bindings": fakeResult}}
 
-    monkeypatch.setattr("SPARQLWrapper.SPARQLWrapper.query", FakeQuery)
+    monkeypatch.setattr(SparqlClient, 'query', fake_query(FakeQuery))
 
     dbpedia.fetch_classes(1, Artist, ['dbpedia-owl:Artist'])
     assert fx_session.query(Artist).count() > 0
@@ -108,7 +133,7 @@ def test_fetch_Work(monkeypatch, fx_session, fx_celery_app):
                 FakeQuery.offset += 100
                 return {"results": {"bindings": fakeResult}}
 
-    monkeypatch.setattr("SPARQLWrapper.SPARQLWrapper.query", FakeQuery)
+    monkeypatch.setattr(SparqlClient, 'query', fake_query(FakeQuery))
 
     dbpedia.fetch_classes(1, Work, ['dbpedia-owl:Work'])
     assert fx_session.query(Work).count() > 0
@@ -127,7 +152,7 @@ def test_fetch_Film(monkeypatch, fx_session, fx_celery_app):
                 FakeQuery.offset += 100
                 return {"results": {"bindings": fakeResult}}
 
-    monkeypatch.setattr("SPARQLWrapper.SPARQLWrapper.query", FakeQuery)
+    monkeypatch.setattr(SparqlClient, 'query', fake_query(FakeQuery))
 
     dbpedia.fetch_classes(1, Film, ['dbpedia-owl:Film'])
     assert fx_session.query(Film).count() > 0
@@ -146,7 +171,212 @@ def test_fetch_Book(monkeypatch, fx_session, fx_celery_app):
                 FakeQuery.offset += 100
                 return {"results": {"bindings": fakeResult}}
 
-    monkeypatch.setattr("SPARQLWrapper.SPARQLWrapper.query", FakeQuery)
+    monkeypatch.setattr(SparqlClient, 'query', fake_query(FakeQuery))
 
     dbpedia.fetch_classes(1, Book, ['dbpedia-owl:Book', 'dbpedia-owl:Novel'])
     assert fx_session.query(Book).count() > 0
+
+
+def test_fetch_classes_types(monkeypatch, fx_session, fx_celery_app):
+    bindings = []
+
+    class FakeQuery(object):
+        def convert(self):
+            return {"results": {"bindings": bindings}}
+
+    monkeypatch.setattr(SparqlClient, 'query', fake_query(FakeQuery))
+    name = 'http://dbpedia.org/resource/The_Wall'
+    bindings[:] = [{'name': {'value': name},
+                    'wikiPageRevisionID': {'value': '1'}}]
+    assert dbpedia.fetch_classes(0, Entity, ['dbpedia-owl:Cartoon']) == 1
+    assert dbpedia.fetch_classes(0, Film, ['dbpedia-owl:Film']) == 1
+    bindings[:] = [{'name': {'value': name},
+                    'wikiPageRevisionID': {'value': '2'},
+                    'writer': {'value': 'Roger Waters'}}]
+    # a film is never turned into a less specific work
+    assert dbpedia.fetch_classes(0, Work, ['dbpedia-owl:Work']) == 1
+    fx_session.expunge_all()
+    entity = fx_session.query(Entity).filter_by(name=name).one()
+    assert isinstance(entity, Film)
+    assert entity.revision == 2
+    assert entity.writer == 'Roger Waters'
+    assert entity.label == 'the wall'
+    assert fx_session.query(Entity).count() == 1
+
+
+def test_crawl_classes(monkeypatch, fx_session, fx_celery_app):
+    pages = []
+    queries = []
+
+    def query(self, text):
+        queries.append(text)
+        return pages.pop(0) if pages else []
+
+    def make_item(name, revision):
+        return {'name': {'value': 'http://dbpedia.org/resource/' + name},
+                'wikiPageRevisionID': {'value': str(revision)}}
+
+    monkeypatch.setattr(SparqlClient, 'query', query)
+    pages[:] = [[make_item('Alien', 10), make_item('Heat', 20)],
+                [make_item('Ran', 30)]]
+    dbpedia.crawl_classes(['dbpedia-owl:Film'])
+    assert fx_session.query(Film).count() == 3
+    cursor = fx_session.query(ClassCursor).one()
+    assert cursor.classes == 'dbpedia-owl:Film'
+    assert cursor.revision == 30
+    assert ['?wikiPageRevisionID > %d' % revision in query
+            for revision, query in zip([0, 20, 30], queries)] == [True] * 3
+    # the next crawl fetches only later revisions
+    del queries[:]
+    pages[:] = [[make_item('Heat', 40)]]
+    dbpedia.crawl_classes(['dbpedia-owl:Film'])
+    assert len(queries) == 2
+    assert '?wikiPageRevisionID > 30' in queries[0]
+    fx_session.expunge_all()
+    assert fx_session.query(ClassCursor).one().revision == 40
+    assert fx_session.query(Film.revision) \
+                     .filter_by(name='http://dbpedia.org/resource/Heat') \
+                     .scalar() == 40
+
+
+def test_crawl_relation_concurrency(monkeypatch, fx_session, fx_celery_app):
+    revisions = list(range(1, 51))
+    queries = []
+
+    def query(self, text):
+        queries.append(text)
+        low, high = map(int, re.search(
+            r'\?revision > (\d+) && \?revision <= (\d+)', text
+        ).groups())
+        limit = int(re.search(r'LIMIT (\d+)', text).group(1))
+        return [
+            {'work': {'value': 'http://dbpedia.org/resource/W%d' % r},
+             'author': {'value': 'http://dbpedia.org/resource/A%d' % r},
+             'revision': {'value': str(r)}}
+            for r in revisions if low < r <= high
+        ][:limit]
+
+    monkeypatch.setattr(SparqlClient, 'query', query)
+    monkeypatch.setitem(fx_celery_app.conf, 'WIKIPEDIA_CONCURRENCY', 3)
+    monkeypatch.setitem(fx_celery_app.conf, 'WIKIPEDIA_SPARQL_CLIENT', None)
+    monkeypatch.setitem(fx_celery_app.conf, 'WIKIPEDIA_PAGE_SIZES', {
+        'relation': dbpedia.AdaptivePageSize(size=10, minimum=10, maximum=10)
+    })
+    dbpedia.crawl_relation(0, 60)
+    assert fx_session.query(Relation).count() == 50
+    partition = fx_session.query(RelationPartition).one()
+    assert partition.completed_at is not None
+    # slices of (0, 20], (20, 40], (40, 60] were fetched at once
+    assert sum('?revision > 0 && ?revision <= 20' in q for q in queries) == 1
+    assert sum('?revision > 20 && ?revision <= 40' in q
+               for q in queries) == 1
+    assert sum('?revision > 40 && ?revision <= 60' in q
+               for q in queries) == 1
+    assert len(queries) == 8
+
+
+def test_split_range():
+    assert dbpedia.split_range(0, 10, 4) == [(0, 3), (3, 6), (6, 9), (9, 10)]
+    assert dbpedia.split_range(0, 2, 4) == [(0, 1), (1, 2)]
+    assert dbpedia.split_range(5, 5, 4) == []
+
+
+def test_crawl_relation_stream(monkeypatch, fx_session, fx_celery_app):
+    revisions = list(range(1, 26))
+    cut = [True]
+
+    def stream(self, text, chunk_size=16384):
+        low, high = map(int, re.search(
+            r'\?revision > (\d+) && \?revision <= (\d+)', text
+        ).groups())
+        limit = int(re.search(r'LIMIT (\d+)', text).group(1))
+        rows = [r for r in revisions if low < r <= high][:limit]
+        for i, r in enumerate(rows):
+            if i == 7 and cut:
+                cut.pop()
+                raise ValueError('bindings are cut')
+            yield {'work': 'http://dbpedia.org/resource/W%d' % r,
+                   'author': 'http://dbpedia.org/resource/A%d' % r,
+                   'revision': str(r)}
+
+    monkeypatch.setattr(SparqlClient, 'stream', stream)
+    monkeypatch.setitem(fx_celery_app.conf, 'WIKIPEDIA_STREAM', True)
+    monkeypatch.setitem(fx_celery_app.conf, 'WIKIPEDIA_STREAM_BATCH_SIZE', 3)
+    monkeypatch.setitem(fx_celery_app.conf, 'WIKIPEDIA_SPARQL_CLIENT', None)
+    monkeypatch.setitem(fx_celery_app.conf, 'WIKIPEDIA_PAGE_SIZES', {
+        'relation': dbpedia.AdaptivePageSize(size=10, minimum=10, maximum=10)
+    })
+    with raises(dbpedia.DBpediaUnavailable):
+        dbpedia.crawl_relation(0, 30)
+    # rows of completed batches were saved with the ledger
+    assert fx_session.query(Relation).count() == 6
+    partition = fx_session.query(RelationPartition).one()
+    assert partition.cursor == 6
+    assert partition.completed_at is None
+    fx_session.expunge_all()
+    dbpedia.crawl_relation(0, 30)
+    assert fx_session.query(Relation).count() == 25
+    partition = fx_session.query(RelationPartition).one()
+    assert partition.cursor == 25
+    assert partition.completed_at is not None
+
+
+def test_crawl_classes_stream(monkeypatch, fx_session, fx_celery_app):
+    revisions = list(range(1, 8))
+
+    def stream(self, text, chunk_size=16384):
+        low = int(re.search(r'\?wikiPageRevisionID > (\d+)', text).group(1))
+        for r in revisions:
+            if r > low:
+                yield {'name': 'http://dbpedia.org/resource/F%d' % r,
+                       'wikiPageRevisionID': str(r)}
+
+    monkeypatch.setattr(SparqlClient, 'stream', stream)
+    monkeypatch.setitem(fx_celery_app.conf, 'WIKIPEDIA_STREAM', True)
+    monkeypatch.setitem(fx_celery_app.conf, 'WIKIPEDIA_STREAM_BATCH_SIZE', 3)
+    monkeypatch.setitem(fx_celery_app.conf, 'WIKIPEDIA_SPARQL_CLIENT', None)
+    assert dbpedia.fetch_classes(0, Film, ['dbpedia-owl:Film'],
+                                 revision=0) == 7
+    dbpedia.crawl_classes(['dbpedia-owl:Film'])
+    assert fx_session.query(Film).count() == 7
+    assert fx_session.query(ClassCursor).one().revision == 7
+
+
+def test_crawl_resume(monkeypatch, fx_session, fx_celery_app):
+    delayed = []
+    crawled = []
+    monkeypatch.setattr(dbpedia, 'max_revision_by_relation', lambda p: 40)
+    monkeypatch.setattr(dbpedia.crawl_relation, 'delay',
+                        lambda *args: delayed.append(args))
+    monkeypatch.setattr(dbpedia, 'crawl_classes',
+                        lambda identity, run_id: crawled.append(identity))
+    monkeypatch.setitem(fx_celery_app.conf, 'WIKIPEDIA_RELATION_PARTITIONS', 2)
+    dbpedia.crawl()
+    run_id = fx_session.query(CrawlRunItem.run_id).distinct().scalar()
+    assert delayed == [(0, 20, run_id), (20, 40, run_id)]
+    assert crawled == dbpedia.CRAWLED_CLASSES
+    # classes are recorded when they start harvesting
+    assert fx_session.query(CrawlRunItem).count() == 2
+    record(fx_session, run_id, 'relation:0:20', DONE)
+    record(fx_session, run_id, 'relation:20:40', RUNNING)
+    record(fx_session, run_id, 'classes:dbpedia-owl:Artist', DONE)
+    record(fx_session, run_id, 'classes:dbpedia-owl:Film', RUNNING)
+    # the unfinished run is resumed, but only its partitions left behind
+    # are crawled again
+    del delayed[:], crawled[:]
+    dbpedia.crawl()
+    assert delayed == crawled == []
+    monkeypatch.setitem(fx_celery_app.conf, 'CRAWL_RUN_TIMEOUT',
+                        datetime.timedelta(0))
+    dbpedia.crawl()
+    assert delayed == [(20, 40, run_id)]
+    assert crawled == [['dbpedia-owl:Film']]
+    for partition, in fx_session.query(CrawlRunItem.partition):
+        record(fx_session, run_id, partition, DONE)
+    # a new run starts when the run is finished, and partitions still
+    # incomplete in the ledger are carried over to it
+    del delayed[:], crawled[:]
+    dbpedia.crawl()
+    assert [args[:2] for args in delayed] == [(0, 20), (20, 40)]
+    assert delayed[0][2] != run_id
+    assert crawled == dbpedia.CRAWLED_CLASSES
@@ -0,0 +1,94 @@
+import types
+import urllib.request
+
+from pytest import raises
+
+from cliche.celery import finish_task_metrics
+from cliche.metrics import (TASK_SECONDS, Counter, Histogram, Registry,
+                            serve, summarize)
+
+
+def test_counter():
+    counter = Counter('test_total', 'Test.', ['service'])
+    counter.inc(service='a')
+    counter.inc(2, service='a')
+    counter.inc(service='b"\n')
+    assert counter.get(service='a') == 3
+    assert counter.total() == 4
+    with raises(ValueError):
+        counter.inc(host='a')
+    assert counter.render() == (
+        '# HELP test_total Test.\n'
+        '# TYPE test_total counter\n'
+        'test_total{service="a"} 3.0\n'
+        'test_total{service="b\\"\\n"} 1.0\n'
+    )
+
+
+def test_histogram():
+    histogram = Histogram('test_seconds', 'Test.', buckets=[0.1, 1])
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    assert histogram.get() == (3, 5.55)
+    assert histogram.render() == (
+        '# HELP test_seconds Test.\n'
+        '# TYPE test_seconds histogram\n'
+        'test_seconds_bucket{le="0.1"} 1.0\n'
+        'test_seconds_bucket{le="1.0"} 2.0\n'
+        'test_seconds_bucket{le="+Inf"} 3.0\n'
+        'test_seconds_sum 5.55\n'
+        'test_seconds_count 3.0\n'
+    )
+
+    @histogram.time()
+    def work():
+        return 'done'
+    assert work() == 'done'
+    with histogram.time():
+        pass
+    assert histogram.get()[0] == 5
+    histogram.clear()
+    assert histogram.get() == (0, 0.0)
+
+
+def test_serve():
+    registry = Registry()
+    counter = registry.register(Counter('test_total', 'Test.'))
+    counter.inc()
+    server = serve(0, registry=registry)
+    try:
+        url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+        with urllib.request.urlopen(url) as response:
+            assert response.headers['Content-Type'].startswith('text/plain')
+            assert response.read().decode() == registry.render()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_summarize():
+    registry = Registry()
+    pages = registry.register(Counter('pages_total', 'Test.'))
+    seconds = registry.register(Histogram('write_seconds', 'Test.'))
+    summary, state = summarize(registry=registry)
+    assert summary == ''
+    pages.inc(10)
+    seconds.observe(0.5)
+    seconds.observe(1.5)
+    summary, state = summarize(state, registry=registry)
+    assert summary.startswith('pages_total 10 (')
+    assert summary.endswith('/s), write_seconds 2 (mean 1.000s)')
+
+
+def test_finish_task_metrics(monkeypatch, fx_celery_app):
+    monkeypatch.setitem(fx_celery_app.conf, 'METRICS_SUMMARY', None)
+    TASK_SECONDS.clear()
+    task = types.SimpleNamespace(
+        name='test.task',
+        request=types.SimpleNamespace(metrics_started_at=0.0)
+    )
+    finish_task_metrics('id', task, state='SUCCESS')
+    count, _ = TASK_SECONDS.get(task='test.task', state='SUCCESS')
+    assert count == 1
+    assert fx_celery_app.conf['METRICS_SUMMARY'] is not None
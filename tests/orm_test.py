@@ -6,9 +6,12 @@ import tempfile
 from pytest import fixture
 from sqlalchemy import create_engine
 
+from cliche import orm
 from cliche.orm import (downgrade_database, get_database_revision,
                         import_all_modules, initialize_database,
-                        upgrade_database)
+                        insert_ignore, select_existing_keys,
+                        upgrade_database, upsert)
+from cliche.services.tvtropes.entities import Entity
 
 
 @fixture
@@ -42,3 +45,75 @@ def test_import_all_modules():
     for mod in modules:
         assert mod.startswith('cliche.')
     assert modules <= frozenset(sys.modules)
+
+
+def make_entity_rows(*names):
+    return [
+        {'namespace': 'Main', 'name': name, 'type': 'Trope',
+         'url': 'http://tvtropes.org/pmwiki/pmwiki.php/Main/' + name}
+        for name in names
+    ]
+
+
+def test_insert_ignore(fx_session):
+    table = Entity.__table__
+    insert_ignore(fx_session, table, make_entity_rows('A', 'B', 'A'))
+    assert fx_session.query(Entity).count() == 2
+    rows = make_entity_rows('B', 'C')
+    rows[0]['url'] = 'changed'
+    insert_ignore(fx_session, table, rows)
+    assert {(e.name, e.url) for e in fx_session.query(Entity)} == {
+        ('A', 'http://tvtropes.org/pmwiki/pmwiki.php/Main/A'),
+        ('B', 'http://tvtropes.org/pmwiki/pmwiki.php/Main/B'),
+        ('C', 'http://tvtropes.org/pmwiki/pmwiki.php/Main/C'),
+    }
+    insert_ignore(fx_session, table, [])
+
+
+def test_select_existing_keys(fx_session):
+    table = Entity.__table__
+    insert_ignore(fx_session, table, make_entity_rows('A', 'B'))
+    keys = [('Main', 'A'), ('Main', 'C'), ('Work', 'B')]
+    existing = select_existing_keys(fx_session.connection(), table, keys)
+    assert existing == {('Main', 'A')}
+
+
+def test_upsert(fx_session):
+    table = Entity.__table__
+    upsert(fx_session, table, make_entity_rows('A', 'B'))
+    rows = make_entity_rows('B', 'C')
+    rows[0]['url'] = 'changed'
+    rows[0]['type'] = 'Work'
+    upsert(fx_session, table, rows, update_columns=['url'])
+    assert {(e.name, e.type, e.url) for e in fx_session.query(Entity)} == {
+        ('A', 'Trope', 'http://tvtropes.org/pmwiki/pmwiki.php/Main/A'),
+        ('B', 'Trope', 'changed'),
+        ('C', 'Trope', 'http://tvtropes.org/pmwiki/pmwiki.php/Main/C'),
+    }
+    upsert(fx_session, table, [])
+
+
+def test_upsert_inserted_meanwhile(monkeypatch, fx_session):
+    table = Entity.__table__
+    upsert(fx_session, table, make_entity_rows('A'))
+    # the row is inserted by another transaction after keys are selected
+    monkeypatch.setattr(orm, 'select_existing_keys',
+                        lambda connection, table, keys, key_columns: set())
+    rows = make_entity_rows('A', 'B')
+    rows[0]['url'] = 'changed'
+    upsert(fx_session, table, rows)
+    assert {(e.name, e.url) for e in fx_session.query(Entity)} == {
+        ('A', 'changed'),
+        ('B', 'http://tvtropes.org/pmwiki/pmwiki.php/Main/B'),
+    }
+
+
+def test_upsert_key_columns(fx_session):
+    table = Entity.__table__
+    upsert(fx_session, table, make_entity_rows('A'))
+    upsert(fx_session, table, [{'namespace': 'Main', 'name': 'A',
+                                'url': 'changed'}],
+           key_columns=[table.c.namespace, 'name'])
+    entity = fx_session.query(Entity).one()
+    assert entity.url == 'changed'
+    assert entity.type == 'Trope'
@@ -0,0 +1,112 @@
+import datetime
+import time
+
+from pytest import approx, fixture
+
+from cliche.services import ratelimit
+from cliche.services.ratelimit import (DatabaseBackend, LocalBackend,
+                                       get_rate_limit, refill, reserve,
+                                       throttle, trip, tripped_until)
+
+
+@fixture
+def fx_rate_limits(monkeypatch, fx_celery_app):
+    monkeypatch.setitem(fx_celery_app.conf, 'RATE_LIMITS', {
+        'tvtropes.org': 2,
+        'dbpedia.org': {'rate': 0.5, 'burst': 3},
+    })
+    LocalBackend.buckets.clear()
+    monkeypatch.setattr(LocalBackend, 'circuits', {})
+
+
+def test_get_rate_limit(fx_rate_limits):
+    assert get_rate_limit('tvtropes.org') == (2.0, 2.0)
+    assert get_rate_limit('live.dbpedia.org') == (0.5, 3.0)
+    assert get_rate_limit('DBpedia.org') == (0.5, 3.0)
+    assert get_rate_limit('example.com') is None
+    assert get_rate_limit('org') is None
+
+
+def test_refill():
+    assert refill(2.0, 0.0, 0.0, 1.0, 2.0) == (1.0, 0.0)
+    assert refill(0.0, 0.0, 0.0, 2.0, 2.0) == (-1.0, 0.5)
+    # waiting requests are queued
+    assert refill(-1.0, 0.0, 0.0, 2.0, 2.0) == (-2.0, 1.0)
+    # tokens never exceed the burst
+    assert refill(1.0, 0.0, 100.0, 2.0, 2.0) == (1.0, 0.0)
+
+
+def test_local_backend(fx_rate_limits):
+    backend = LocalBackend()
+    waits = [backend.reserve('tvtropes.org', 2.0, 2.0) for _ in range(4)]
+    assert waits[:2] == [0.0, 0.0]
+    assert waits[2] == approx(0.5, abs=0.05)
+    assert waits[3] == approx(1.0, abs=0.05)
+    assert backend.reserve('dbpedia.org', 0.5, 3.0) == 0.0
+
+
+def test_database_backend(fx_session):
+    backend = DatabaseBackend(fx_session)
+    waits = [backend.reserve('tvtropes.org', 1.0, 1.0) for _ in range(3)]
+    assert waits[0] == 0.0
+    assert waits[1] == approx(1.0, abs=0.1)
+    assert waits[2] == approx(2.0, abs=0.1)
+
+
+def test_database_backend_time_zone(monkeypatch, fx_session):
+    # naive times from e.g. SQLite must not be taken as local times
+    monkeypatch.setenv('TZ', 'Asia/Seoul')
+    time.tzset()
+    try:
+        test_database_backend(fx_session)
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+def test_throttle(monkeypatch, fx_rate_limits):
+    slept = []
+    monkeypatch.setattr(time, 'sleep', slept.append)
+    for _ in range(3):
+        throttle('http://tvtropes.org/pmwiki/pmwiki.php/Main/GodJob')
+    assert throttle('http://example.com/') == 0.0
+    assert len(slept) == 1
+    assert slept[0] == approx(0.5, abs=0.05)
+    monkeypatch.setitem(ratelimit.app.conf, 'RATE_LIMIT_BACKEND', 'database')
+    assert isinstance(ratelimit.get_backend(), DatabaseBackend)
+
+
+def test_reserve(fx_rate_limits):
+    assert reserve('http://example.com/') == 0.0
+    # the default applies only to hosts not configured
+    assert reserve('http://example.com/', (1.0, 1.0)) == 0.0
+    assert reserve('http://example.com/', (1.0, 1.0)) == \
+        approx(1.0, abs=0.05)
+    for _ in range(2):
+        reserve('http://tvtropes.org/', (100.0, 100.0))
+    assert reserve('http://tvtropes.org/', (100.0, 100.0)) == \
+        approx(0.5, abs=0.05)
+
+
+def test_trip(fx_rate_limits):
+    url = 'http://dbpedia.org/sparql'
+    assert tripped_until(url) is None
+    trip(url, datetime.timedelta(minutes=5))
+    until = tripped_until(url)
+    assert until > datetime.datetime.now(datetime.timezone.utc)
+    assert tripped_until('http://tvtropes.org/') is None
+    # an earlier pause doesn't shorten the current one
+    trip(url, datetime.timedelta(seconds=1))
+    assert tripped_until(url) == until
+    trip('http://tvtropes.org/', datetime.timedelta(seconds=-1))
+    assert tripped_until('http://tvtropes.org/') is None
+
+
+def test_database_backend_trip(fx_session):
+    backend = DatabaseBackend(fx_session)
+    assert backend.get_tripped('dbpedia.org') is None
+    until = datetime.datetime.now(datetime.timezone.utc) + \
+        datetime.timedelta(minutes=5)
+    backend.trip('dbpedia.org', until)
+    backend.trip('dbpedia.org', until - datetime.timedelta(minutes=1))
+    assert backend.get_tripped('dbpedia.org') == until
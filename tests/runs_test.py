@@ -0,0 +1,151 @@
+import datetime
+
+from pytest import raises
+from sqlalchemy.exc import IntegrityError
+
+from cliche.services import runs
+from cliche.services.runs import (DONE, FAILED, PENDING, RUNNING, CrawlRun,
+                                  CrawlRunItem, add_items, begin_run, record,
+                                  resume_items, track)
+
+
+def get_item(session, run_id, partition):
+    session.expire_all()
+    return session.query(CrawlRunItem) \
+                  .filter_by(run_id=run_id, partition=partition) \
+                  .one()
+
+
+def test_begin_run(fx_session, fx_celery_app):
+    run_id, resumed = begin_run(fx_session, 'test')
+    assert not resumed
+    add_items(fx_session, run_id, ['a', 'b'])
+    assert begin_run(fx_session, 'test') == (run_id, True)
+    # a run without items yet is being planned by another caller
+    other_run_id, _ = begin_run(fx_session, 'other')
+    assert begin_run(fx_session, 'other') == (other_run_id, True)
+    # runs of other services are separate
+    assert begin_run(fx_session, 'other')[0] != run_id
+    record(fx_session, run_id, 'a', DONE)
+    record(fx_session, run_id, 'b', DONE)
+    next_run_id, resumed = begin_run(fx_session, 'test')
+    assert next_run_id != run_id
+    assert not resumed
+    fx_session.expire_all()
+    assert fx_session.query(CrawlRun).get(run_id).finished_at is not None
+    # items of the last finished run are kept, but earlier ones are purged
+    add_items(fx_session, next_run_id, ['c'])
+    record(fx_session, next_run_id, 'c', DONE)
+    begin_run(fx_session, 'test')
+    assert fx_session.query(CrawlRunItem.run_id) \
+                     .distinct().all() == [(next_run_id,)]
+
+
+def test_begin_run_unfinished_unique(fx_session, fx_celery_app):
+    begin_run(fx_session, 'test')
+    with raises(IntegrityError):
+        with fx_session.begin():
+            fx_session.add(CrawlRun(service='test',
+                                    started_at=datetime.datetime.now()))
+
+
+def test_track(fx_session, fx_celery_app):
+    run_id, _ = begin_run(fx_session, 'test')
+    with track(fx_session, run_id, 'a', page=10):
+        item = get_item(fx_session, run_id, 'a')
+        assert item.status == RUNNING
+        assert item.page == 10
+        assert item.attempts == 1
+        assert item.started_at is not None
+    item = get_item(fx_session, run_id, 'a')
+    assert item.status == DONE
+    assert item.finished_at is not None
+    with raises(ValueError):
+        with track(fx_session, run_id, 'b'):
+            raise ValueError('broken page')
+    item = get_item(fx_session, run_id, 'b')
+    assert item.status == FAILED
+    assert item.error == 'ValueError: broken page'
+    # nothing is recorded without a run
+    with track(fx_session, None, 'c'):
+        pass
+    assert fx_session.query(CrawlRunItem).count() == 2
+
+
+def test_record_pages(fx_session, fx_celery_app):
+    run_id, _ = begin_run(fx_session, 'test')
+    record(fx_session, run_id, 'a', RUNNING, page=0)
+    started_at = get_item(fx_session, run_id, 'a').started_at
+    # the next page of the running partition continues the attempt
+    record(fx_session, run_id, 'a', RUNNING, page=20)
+    item = get_item(fx_session, run_id, 'a')
+    assert (item.page, item.attempts, item.started_at) == \
+        (20, 1, started_at)
+    record(fx_session, run_id, 'a', FAILED, error='timeout')
+    record(fx_session, run_id, 'a', RUNNING, page=20)
+    item = get_item(fx_session, run_id, 'a')
+    assert (item.status, item.attempts, item.error) == (RUNNING, 2, None)
+
+
+def backdate(session, run_id, hours=7):
+    """Pretend items of the run were last updated ``hours`` ago."""
+    with session.begin():
+        session.query(CrawlRunItem).filter_by(run_id=run_id).update({
+            'updated_at': datetime.datetime.now(datetime.timezone.utc) -
+            datetime.timedelta(hours=hours)
+        }, synchronize_session=False)
+
+
+def test_resume_items(fx_session, fx_celery_app):
+    run_id, _ = begin_run(fx_session, 'test')
+    add_items(fx_session, run_id, ['a', 'b'])
+    record(fx_session, run_id, 'b', DONE)
+    record(fx_session, run_id, 'c', RUNNING)
+    with raises(IOError):
+        with track(fx_session, run_id, 'd'):
+            raise IOError()
+    # items updated recently are not left behind yet
+    assert list(resume_items(fx_session, run_id)) == []
+    backdate(fx_session, run_id)
+    assert list(resume_items(fx_session, run_id, chunk_size=2)) == \
+        [['a', 'c'], ['d']]
+    assert get_item(fx_session, run_id, 'c').status == PENDING
+    # resumed items are not resumed again until the timeout
+    assert list(resume_items(fx_session, run_id)) == []
+
+
+def test_resume_items_given_up(monkeypatch, fx_session, fx_celery_app):
+    run_id, _ = begin_run(fx_session, 'test')
+    add_items(fx_session, run_id, ['a'])
+    record(fx_session, run_id, 'b', RUNNING)
+    backdate(fx_session, run_id)
+    # items which failed too many times are given up
+    monkeypatch.setitem(fx_celery_app.conf, 'CRAWL_RUN_MAX_ATTEMPTS', 1)
+    assert list(resume_items(fx_session, run_id)) == [['a']]
+    record(fx_session, run_id, 'a', DONE)
+    assert not begin_run(fx_session, 'test')[1]
+
+
+def test_resume_lost_pending_items(fx_session, fx_celery_app):
+    run_id, _ = begin_run(fx_session, 'test')
+    # the queued task of the pending item is lost e.g. by a broker purge
+    add_items(fx_session, run_id, ['a'])
+    assert begin_run(fx_session, 'test') == (run_id, True)
+    backdate(fx_session, run_id)
+    assert list(resume_items(fx_session, run_id)) == [['a']]
+    record(fx_session, run_id, 'a', DONE)
+    assert begin_run(fx_session, 'test')[0] != run_id
+
+
+def test_begin_run_integrity_error(monkeypatch, fx_session, fx_celery_app):
+    calls = []
+
+    def begin_run_(session, service):
+        calls.append(service)
+        raise IntegrityError('INSERT', {}, Exception())
+
+    monkeypatch.setattr(runs, '_begin_run', begin_run_)
+    # it's retried only once, not forever
+    with raises(IntegrityError):
+        begin_run(fx_session, 'test')
+    assert calls == ['test', 'test']
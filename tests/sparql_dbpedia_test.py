@@ -1,7 +1,24 @@
 import json
 import os.path
+import time
+from http.client import IncompleteRead
 
+from pytest import raises
+
+from cliche.services.ratelimit import LocalBackend
+from cliche.services.store import MemoryStore
 from cliche.services.wikipedia import crawler as dbpedia
+from cliche.services.wikipedia.sparql import SparqlClient
+
+
+def fake_query(query_class):
+    """Make a fake :meth:`SparqlClient.query()` which returns bindings of
+    results the ``query_class`` converts.
+
+    """
+    def query(self, text):
+        return query_class().convert()['results']['bindings']
+    return query
 
 
 def test_select_property(monkeypatch):
@@ -12,7 +29,7 @@ def test_select_property(monkeypatch):
                 fakeResult = (json.load(fp))
                 return {"results": {"bindings": fakeResult}}
 
-    monkeypatch.setattr("SPARQLWrapper.SPARQLWrapper.query", FakeQuery)
+    monkeypatch.setattr(SparqlClient, 'query', fake_query(FakeQuery))
     res = dbpedia.select_property(s='dbpedia-owl:Person', return_json=True)
     assert type(res[0]['property']) == str
 
@@ -28,7 +45,7 @@ def test_count_by_relation(monkeypatch):
                 }
             }
 
-    monkeypatch.setattr("SPARQLWrapper.SPARQLWrapper.query", FakeQuery)
+    monkeypatch.setattr(SparqlClient, 'query', fake_query(FakeQuery))
     res = dbpedia.count_by_relation(
         p=[
             'dbpprop:author',
@@ -50,7 +67,7 @@ def test_count_by_classes(monkeypatch):
                 }
             }
 
-    monkeypatch.setattr("SPARQLWrapper.SPARQLWrapper.query", FakeQuery)
+    monkeypatch.setattr(SparqlClient, 'query', fake_query(FakeQuery))
     res = dbpedia.count_by_class(
         class_list=[
             'dbpedia-owl:Artist',
@@ -79,7 +96,7 @@ def test_select_by_relation(monkeypatch):
                 FakeQuery.offset += 100
                 return {"results": {"bindings": fakeResult}}
 
-    monkeypatch.setattr("SPARQLWrapper.SPARQLWrapper.query", FakeQuery)
+    monkeypatch.setattr(SparqlClient, 'query', fake_query(FakeQuery))
 
     res = dbpedia.select_by_relation(
         p=[
@@ -90,7 +107,7 @@ def test_select_by_relation(monkeypatch):
         revision=0,
         s_name='work',
         o_name='author',
-        page=1
+        until=2 ** 31 - 1
     )
     assert len(res) == 100
 
@@ -107,12 +124,136 @@ def test_select_by_class(monkeypatch):
                 FakeQuery.offset += 100
                 return {"results": {"bindings": fakeResult}}
 
-    monkeypatch.setattr("SPARQLWrapper.SPARQLWrapper.query", FakeQuery)
+    monkeypatch.setattr(SparqlClient, 'query', fake_query(FakeQuery))
 
     res = dbpedia.select_by_class(
         s=['dbpedia-owl:Artist'],
         s_name='artists',
         entities=['foaf:name', 'dbpedia-owl:birthDate'],
-        page=1
+        offset=100
     )
     assert len(res) == 100
+
+
+def test_adaptive_page_size(fx_celery_app):
+    page_size = dbpedia.AdaptivePageSize(size=100, minimum=10, maximum=300,
+                                         fast=1)
+    page_size.succeeded(100, 100, 0.5)
+    assert page_size.size == 200
+    # not full or not fast
+    page_size.succeeded(200, 150, 0.5)
+    page_size.succeeded(200, 200, 2)
+    assert page_size.size == 200
+    page_size.succeeded(200, 200, 0.5)
+    assert page_size.size == 300
+    page_size.failed(300)
+    assert page_size.size == 150
+    for _ in range(10):
+        page_size.failed(page_size.size)
+    assert page_size.size == 10
+
+
+def test_select_dbpedia_page_size(monkeypatch, fx_celery_app):
+    limits = []
+
+    class FakeQuery(object):
+        def convert(self):
+            if len(limits) == 1:
+                raise IncompleteRead(b'')
+            return {"results": {"bindings": [{"a": {"value": "b"}}]}}
+
+    monkeypatch.setattr(SparqlClient, 'query', fake_query(FakeQuery))
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+    page_size = dbpedia.AdaptivePageSize(size=100, minimum=10)
+
+    def make_query(limit):
+        limits.append(limit)
+        return 'SELECT ?a WHERE { ?a ?b ?c } LIMIT %d' % limit
+
+    assert dbpedia.select_dbpedia(make_query, page_size) == [{'a': 'b'}]
+    assert limits == [100, 50]
+    assert page_size.size == 50
+
+
+def test_get_backoff(monkeypatch, fx_celery_app):
+    monkeypatch.setitem(fx_celery_app.conf, 'WIKIPEDIA_RETRY_BACKOFF', 2)
+    monkeypatch.setitem(fx_celery_app.conf, 'WIKIPEDIA_RETRY_BACKOFF_MAX', 10)
+    for tried, cap in [(1, 2), (2, 4), (3, 8), (4, 10), (10, 10)]:
+        for _ in range(20):
+            assert 0 <= dbpedia.get_backoff(tried) <= cap
+
+
+def test_select_dbpedia_circuit_breaker(monkeypatch, fx_celery_app):
+    queried = []
+    slept = []
+
+    class FakeQuery(object):
+        def convert(self):
+            queried.append(True)
+            raise IncompleteRead(b'')
+
+    monkeypatch.setattr(SparqlClient, 'query', fake_query(FakeQuery))
+    monkeypatch.setattr(time, 'sleep', slept.append)
+    monkeypatch.setattr(LocalBackend, 'circuits', {})
+    with raises(dbpedia.DBpediaUnavailable):
+        dbpedia.select_dbpedia('SELECT ?a WHERE { ?a ?b ?c }')
+    assert len(queried) == 10
+    # no backoff after the last attempt
+    assert len(slept) == 9
+    # the circuit is open; fails without querying
+    with raises(dbpedia.DBpediaUnavailable):
+        dbpedia.select_dbpedia('SELECT ?a WHERE { ?a ?b ?c }')
+    assert len(queried) == 10
+
+
+def test_query_cache(monkeypatch, fx_celery_app):
+    queried = []
+
+    class FakeQuery(object):
+        def convert(self):
+            queried.append(True)
+            return {
+                "results": {
+                    "bindings": [
+                        {"callret-0": {"value": str(len(queried))}}
+                    ]
+                }
+            }
+
+    monkeypatch.setattr(SparqlClient, 'query', fake_query(FakeQuery))
+    monkeypatch.setitem(fx_celery_app.conf, 'STORE_BACKEND', 'memory')
+    monkeypatch.setitem(fx_celery_app.conf, 'WIKIPEDIA_QUERY_CACHE_SIZE', 1)
+    monkeypatch.setattr(MemoryStore, 'buckets', {})
+    assert dbpedia.count_by_class(['dbpedia-owl:Book']) == 1
+    assert dbpedia.count_by_class(['dbpedia-owl:Book']) == 1
+    assert dbpedia.count_by_class(['dbpedia-owl:Book'], cache=False) == 2
+    # whitespaces don't matter
+    assert dbpedia.get_query_key('SELECT  ?a\n WHERE { ?a ?b ?c }') == \
+        dbpedia.get_query_key(' SELECT ?a WHERE {\n?a ?b ?c }')
+    # evicted by another query
+    assert dbpedia.count_by_class(['dbpedia-owl:Film']) == 3
+    assert dbpedia.count_by_class(['dbpedia-owl:Film']) == 3
+    assert dbpedia.count_by_class(['dbpedia-owl:Book']) == 4
+    monkeypatch.setitem(fx_celery_app.conf, 'WIKIPEDIA_QUERY_CACHE_TTL', 0)
+    assert dbpedia.count_by_class(['dbpedia-owl:Book']) == 5
+
+
+def test_stream_dbpedia_elapsed(monkeypatch, fx_celery_app):
+    class FakeClient(object):
+        def stream(self, text):
+            for i in range(3):
+                yield {'a': str(i)}
+
+    succeeded = []
+    page_size = dbpedia.AdaptivePageSize(size=10, minimum=10, maximum=10)
+    monkeypatch.setattr(page_size, 'succeeded',
+                        lambda *args: succeeded.append(args))
+    monkeypatch.setattr(LocalBackend, 'circuits', {})
+    rows = dbpedia.stream_dbpedia(lambda limit: 'SELECT ?a WHERE {}',
+                                  page_size, client=FakeClient())
+    for row in rows:
+        # time the caller spends on rows is not the latency of DBpedia
+        time.sleep(0.05)
+    [(limit, count, elapsed)] = succeeded
+    assert (limit, count) == (10, 3)
+    assert elapsed < 0.05
@@ -0,0 +1,93 @@
+import datetime
+
+from pytest import fixture
+
+from cliche.services.store import DatabaseStore, MemoryStore, get_store
+
+
+@fixture(params=['memory', 'database'])
+def fx_store(request, fx_session):
+    MemoryStore.buckets.clear()
+    if request.param == 'memory':
+        return MemoryStore('test')
+    return DatabaseStore('test', fx_session)
+
+
+def test_store_get_set(fx_store):
+    ttl = datetime.timedelta(minutes=1)
+    assert fx_store.get('a') is None
+    fx_store.set_many({'a': [1, 2], 'b': None}, ttl)
+    assert fx_store.get_many(['a', 'b', 'c']) == {'a': [1, 2], 'b': None}
+    fx_store.set('a', {'x': 'y'}, ttl)
+    assert fx_store.get('a') == {'x': 'y'}
+
+
+def test_store_expire(fx_store):
+    fx_store.set('a', 1, datetime.timedelta(seconds=-1))
+    fx_store.set('b', 2, datetime.timedelta(minutes=1))
+    assert fx_store.get_many(['a', 'b']) == {'b': 2}
+    fx_store.purge()
+    assert fx_store.get_many(['a', 'b']) == {'b': 2}
+    fx_store.set('a', 3, datetime.timedelta(minutes=1))
+    assert fx_store.get('a') == 3
+
+
+def test_store_add_many(fx_store):
+    ttl = datetime.timedelta(minutes=1)
+    assert fx_store.add_many(['a', 'b', 'a'], ttl) == ['a', 'b']
+    assert fx_store.add_many(['c', 'b', 'd'], ttl) == ['c', 'd']
+    assert fx_store.add_many([], ttl) == []
+    # expired keys are added again
+    fx_store.set('e', 1, datetime.timedelta(seconds=-1))
+    assert fx_store.add_many(['e', 'a'], ttl) == ['e']
+    assert fx_store.get_many(['e']) == {'e': None}
+
+
+def test_store_delete_many(fx_store):
+    ttl = datetime.timedelta(minutes=1)
+    fx_store.set_many({'a': 1, 'b': 2, 'c': 3}, ttl)
+    fx_store.delete_many(['a', 'c', 'd'])
+    assert fx_store.get_many(['a', 'b', 'c']) == {'b': 2}
+    fx_store.delete_many([])
+    # deleted keys can be added again
+    assert fx_store.add_many(['a', 'b'], ttl) == ['a']
+
+
+def test_database_store_add_many_shared(fx_session):
+    ttl = datetime.timedelta(minutes=1)
+    first = DatabaseStore('test', fx_session)
+    second = DatabaseStore('test', fx_session)
+    assert first.add_many(['a', 'b'], ttl) == ['a', 'b']
+    # another worker never gets keys already added
+    assert second.add_many(['b', 'c'], ttl) == ['c']
+    second.set_many({'c': 1, 'd': 2}, ttl)
+    assert first.get_many(['c', 'd']) == {'c': 1, 'd': 2}
+
+
+def test_store_buckets(fx_store):
+    ttl = datetime.timedelta(minutes=1)
+    fx_store.set('a', 1, ttl)
+    if isinstance(fx_store, MemoryStore):
+        other = MemoryStore('other')
+    else:
+        other = DatabaseStore('other', fx_store.session)
+    assert other.get('a') is None
+
+
+def test_get_store(fx_session, fx_celery_app):
+    fx_celery_app.conf['STORE_BACKEND'] = 'memory'
+    assert isinstance(get_store('test', fx_session), MemoryStore)
+    fx_celery_app.conf['STORE_BACKEND'] = 'database'
+    assert isinstance(get_store('test', fx_session), DatabaseStore)
+
+
+def test_store_evict(fx_store):
+    for i in range(5):
+        fx_store.set(str(i), i, datetime.timedelta(minutes=i))
+    # the item 0 has expired, and the item 1 expires earliest
+    fx_store.evict(3)
+    assert fx_store.get_many(map(str, range(5))) == {'2': 2, '3': 3, '4': 4}
+    fx_store.evict(2)
+    assert fx_store.get_many(map(str, range(5))) == {'3': 3, '4': 4}
+    fx_store.evict(2)
+    assert fx_store.get_many(map(str, range(5))) == {'3': 3, '4': 4}
@@ -0,0 +1,212 @@
+import asyncio
+import concurrent.futures
+import http.server
+import threading
+
+from pytest import approx, raises, yield_fixture
+
+from cliche.services.ratelimit import LocalBackend
+from cliche.services.tvtropes import aiocrawler
+from cliche.services.tvtropes.aiocrawler import DEFAULT_RATE, Crawler
+from cliche.services.tvtropes.crawler import INDEX_INDEX, is_seeding
+from cliche.services.tvtropes.entities import Entity, Relation
+
+from .tvtropes_crawler_test import fake_pages
+
+
+PAGES = {
+    '/pmwiki/pmwiki.php/Main/GodJob': (
+        'God Job',
+        ['/pmwiki/pmwiki.php/Main/TheAce', '/pmwiki/pmwiki.php/Film/IronMan']
+    ),
+    '/pmwiki/pmwiki.php/Main/TheAce': (
+        'The Ace',
+        ['/pmwiki/pmwiki.php/Main/GodJob', '/pmwiki/pmwiki.php/Film/IronMan']
+    ),
+    '/pmwiki/pmwiki.php/Film/IronMan': (
+        'Film: Iron Man',
+        ['/pmwiki/pmwiki.php/Administrivia/HomePage']
+    ),
+}
+
+
+@yield_fixture
+def fx_tvtropes_server():
+    requested = []
+    failing = set()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            requested.append(self.path)
+            if self.path in failing:
+                self.send_error(503)
+                return
+            try:
+                title, links = PAGES[self.path]
+            except KeyError:
+                self.send_error(404)
+                return
+            host = 'http://{0}:{1}'.format(*self.server.server_address)
+            body = (
+                '<div class="pagetitle"><div class="article_title"><h1>'
+                '<span>{}</span></h1></div></div><div id="wikitext">{}</div>'
+            ).format(title, ''.join(
+                '<a class="twikilink" href="{}{}">link</a>'.format(host, link)
+                for link in links
+            )).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server.requested = requested
+    server.failing = failing
+    server.url = 'http://{0}:{1}'.format(*server.server_address)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_crawler(fx_session, fx_celery_app, fx_tvtropes_server):
+    seed = fx_tvtropes_server.url + '/pmwiki/pmwiki.php/Main/GodJob'
+    crawler = Crawler(fx_session, concurrency=4, rate=100.0)
+    assert crawler.run([seed]) == 3
+    assert sorted(fx_tvtropes_server.requested) == sorted(PAGES)
+    entities = {(e.namespace, e.name) for e in fx_session.query(Entity)}
+    assert entities == {('Main', 'God Job'), ('Main', 'The Ace'),
+                        ('Film', 'Iron Man')}
+    relations = {
+        (r.origin_name, r.destination_namespace, r.destination_name)
+        for r in fx_session.query(Relation)
+    }
+    assert relations == {
+        ('God Job', 'Main', 'The Ace'),
+        ('God Job', 'Film', 'Iron Man'),
+        ('The Ace', 'Main', 'God Job'),
+        ('The Ace', 'Film', 'Iron Man'),
+    }
+    # pages are neither recrawled nor enqueued again
+    assert Crawler(fx_session, concurrency=4).run([seed]) == 0
+    assert len(fx_tvtropes_server.requested) == len(PAGES)
+
+
+def test_crawler_admits_fetched_pages(fx_session, fx_celery_app,
+                                      fx_tvtropes_server):
+    seed = fx_tvtropes_server.url + '/pmwiki/pmwiki.php/Main/GodJob'
+    crawler = Crawler(fx_session, concurrency=1, rate=100.0)
+    crawler.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    crawler.database_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=1
+    )
+    loop = asyncio.new_event_loop()
+    try:
+        next_urls = loop.run_until_complete(crawler.crawl_page(seed))
+    finally:
+        crawler.executor.shutdown()
+        crawler.database_executor.shutdown()
+        loop.close()
+    assert sorted(next_urls) == [
+        fx_tvtropes_server.url + '/pmwiki/pmwiki.php/Film/IronMan',
+        fx_tvtropes_server.url + '/pmwiki/pmwiki.php/Main/TheAce',
+    ]
+    # urls to crawl next are not blocked even if the run is interrupted
+    # before they are fetched
+    assert Crawler(fx_session, concurrency=4, rate=100.0).run(next_urls) == 2
+
+
+def test_crawler_database_thread(monkeypatch, fx_session, fx_celery_app,
+                                 fx_tvtropes_server):
+    threads = set()
+
+    def save_relations(*args):
+        threads.add(threading.current_thread())
+        return original(*args)
+
+    original = aiocrawler.save_relations
+    monkeypatch.setattr(aiocrawler, 'save_relations', save_relations)
+    seed = fx_tvtropes_server.url + '/pmwiki/pmwiki.php/Main/GodJob'
+    assert Crawler(fx_session, concurrency=4, rate=100.0).run([seed]) == 3
+    # the event loop runs in the main thread, and never blocks on the
+    # database
+    assert len(threads) == 1
+    assert threading.main_thread() not in threads
+
+
+def test_crawler_releases_failed_pages(monkeypatch, fx_session,
+                                       fx_celery_app, fx_tvtropes_server):
+    monkeypatch.setitem(fx_celery_app.conf, 'TVTROPES_RETRY_LIMIT', 0)
+    seed = fx_tvtropes_server.url + '/pmwiki/pmwiki.php/Main/GodJob'
+    fx_tvtropes_server.failing.add('/pmwiki/pmwiki.php/Main/GodJob')
+    assert Crawler(fx_session, concurrency=4, rate=100.0).run([seed]) == 0
+    # a transient failure doesn't block the url until the frontier expires
+    fx_tvtropes_server.failing.clear()
+    assert Crawler(fx_session, concurrency=4, rate=100.0).run([seed]) == 3
+
+
+def test_crawler_seeds_pages(monkeypatch, fx_session, fx_celery_app):
+    page = 'http://tvtropes.org/pmwiki/pmwiki.php/{}'.format
+    title = ('<div class="pagetitle"><div class="article_title"><h1>'
+             '<span>{}</span></h1></div></div>').format
+    film = INDEX_INDEX + '?groupname=Film'
+    pages = {
+        INDEX_INDEX: '<a class="twikilink" href="{}">page</a>'
+                     '<a href="index_report.php?groupname=Film">film</a>'
+                     .format(page('Main/GodJob')),
+        page('Main/GodJob'): title('God Job'),
+        page('Film/IronMan'): title('Film: Iron Man'),
+    }
+    fetched = fake_pages(monkeypatch, pages)
+    crawler = Crawler(fx_session, concurrency=4, rate=100.0)
+    with raises(KeyError):
+        # the film index is not available
+        crawler.run()
+    # pages are crawled while seeding goes on
+    assert crawler.crawled == 1
+    assert is_seeding(fx_session)
+    pages[film] = '<a class="twikilink" href="{}">page</a>'.format(
+        page('Film/IronMan')
+    )
+    del fetched[:]
+    # it continues seeding from the film index, although there are entities
+    assert Crawler(fx_session, concurrency=4, rate=100.0).run() == 1
+    assert fetched == [INDEX_INDEX, film, page('Film/IronMan')]
+    assert not is_seeding(fx_session)
+    entities = {(e.namespace, e.name) for e in fx_session.query(Entity)}
+    assert entities == {('Main', 'God Job'), ('Film', 'Iron Man')}
+
+
+def test_crawler_rate(monkeypatch, fx_session, fx_celery_app):
+    monkeypatch.setattr(LocalBackend, 'buckets', {})
+    url = 'http://tvtropes.org/pmwiki/pmwiki.php/Main/GodJob'
+    slept = []
+
+    async def sleep(seconds):
+        slept.append(seconds)
+
+    monkeypatch.setattr(asyncio, 'sleep', sleep)
+    crawler = Crawler(fx_session)
+    assert crawler.rate == DEFAULT_RATE
+    crawler.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    crawler.database_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=1
+    )
+    monkeypatch.setattr(aiocrawler, 'measured_get',
+                        lambda http, url, **kwargs: None)
+    loop = asyncio.new_event_loop()
+    try:
+        for _ in range(3):
+            loop.run_until_complete(crawler.fetch(url))
+    finally:
+        crawler.executor.shutdown()
+        crawler.database_executor.shutdown()
+        loop.close()
+    assert slept == [approx(1.0, abs=0.1), approx(2.0, abs=0.1)]
@@ -0,0 +1,49 @@
+import datetime
+
+from cliche.services.tvtropes.archive import Archive, get_archive
+from cliche.services.tvtropes.crawler import fetch_link, reparse_archive
+from cliche.services.tvtropes.entities import Relation
+from .tvtropes_crawler_test import fake_pages, make_page
+
+
+def test_archive(fx_tmpdir):
+    archive = Archive(fx_tmpdir / 'archive')
+    yesterday = datetime.datetime.now(datetime.timezone.utc) - \
+        datetime.timedelta(days=1)
+    first = archive.write('http://example.com/a', 'old', yesterday)
+    second = archive.write('http://example.com/a', 'new')
+    third = archive.write('http://example.com/b', 'new')
+    assert second.digest == third.digest
+    assert second.offset == third.offset
+    assert archive.read(first) == 'old'
+    assert archive.read(third) == 'new'
+    archive.close()
+    archive = Archive(fx_tmpdir / 'archive')
+    pages = archive.pages()
+    assert [page.url for page in pages] == ['http://example.com/a',
+                                            'http://example.com/b']
+    assert [archive.read(page) for page in pages] == ['new', 'new']
+    archive.close()
+
+
+def test_reparse_archive(monkeypatch, fx_tmpdir, fx_session, fx_celery_app):
+    monkeypatch.setitem(fx_celery_app.conf, 'TVTROPES_ARCHIVE_PATH',
+                        str(fx_tmpdir / 'archive'))
+    monkeypatch.setitem(fx_celery_app.conf, 'TVTROPES_ARCHIVE', None)
+    url = 'http://tvtropes.org/pmwiki/pmwiki.php/Main/GodJob'
+    fake_pages(monkeypatch, {
+        url: make_page('God Job', '/pmwiki/pmwiki.php/Film/IronMan'),
+    })
+    fetch_link(url, fx_session)
+    archive = get_archive()
+    assert [page.url for page in archive.pages()] == [url]
+    # links are extracted again from the archive, without network access
+    fake_pages(monkeypatch, {})
+    assert reparse_archive(fx_session, archive) == 1
+    relation = fx_session.query(Relation).one()
+    assert (relation.origin_namespace, relation.origin_name,
+            relation.destination_namespace, relation.destination_name) == \
+        ('Main', 'God Job', 'Film', 'IronMan')
+    assert reparse_archive(fx_session, archive) == 1
+    assert fx_session.query(Relation).count() == 1
+    archive.close()
@@ -1,6 +1,33 @@
+import datetime
+
 import requests
 
-from cliche.services.tvtropes.crawler import fetch_link
+from pytest import raises
+
+from cliche.services.store import StoreItem, get_store
+from cliche.services.tvtropes.crawler import (INDEX_INDEX, RELATED_SEARCH,
+                                              crawl, crawl_link, fetch_link,
+                                              get_http_session, is_seeding,
+                                              iter_stale_urls,
+                                              lookup_redirections,
+                                              parse_page, parse_wiki_url,
+                                              reset_http_session, seed_pages)
+from cliche.services.runs import (DONE, FAILED, PENDING, CrawlRunItem,
+                                  add_items, begin_run)
+from cliche.services.tvtropes import crawler
+from cliche.services.tvtropes.entities import Entity, Relation
+
+from .runs_test import backdate
+
+
+def make_response(url, text, status_code=200, headers={}):
+    response = requests.Response()
+    response.url = url
+    response.status_code = status_code
+    response.headers.update(headers)
+    response.encoding = 'utf-8'
+    response._content = text.encode('utf-8')
+    return response
 
 
 def test_fetch_link(monkeypatch, fx_session, fx_celery_app):
@@ -9,13 +36,314 @@ def test_fetch_link(monkeypatch, fx_session, fx_celery_app):
     text = '<div class="pagetitle"><div class="article_title"><h1>' \
            '<span>God Job</span></h1></div></div>'
 
-    def mockreturn(path):
-        req = requests.Request()
-        req.url = url
-        req.text = text
-        return req
+    def mockreturn(self, path, **kwargs):
+        return make_response(url, text)
 
-    monkeypatch.setattr(requests, "get", mockreturn)
+    monkeypatch.setattr(requests.Session, "get", mockreturn)
 
     result = fetch_link(url, fx_session)
     assert result[-3:] == ('Main', 'God Job', url)
+
+
+def test_get_http_session(fx_celery_app):
+    fx_celery_app.conf['TVTROPES_POOL_SIZE'] = 3
+    fx_celery_app.conf['TVTROPES_RETRY_LIMIT'] = 5
+    reset_http_session()
+    session = get_http_session()
+    assert get_http_session() is session
+    adapter = session.get_adapter('http://tvtropes.org/')
+    assert adapter._pool_maxsize == 3
+    assert adapter.max_retries.total == 5
+    reset_http_session()
+    assert get_http_session() is not session
+
+
+def test_parse_wiki_url():
+    assert parse_wiki_url(
+        'http://tvtropes.org/pmwiki/pmwiki.php/Main/GodJob'
+    ) == ('Main', 'GodJob')
+    assert parse_wiki_url(
+        'http://tvtropes.org/pmwiki/pmwiki.php/Film/IronMan?from=Main.X'
+    ) == ('Film', 'IronMan')
+    assert parse_wiki_url(
+        'http://tvtropes.org/pmwiki/index_report.php'
+    ) is None
+    assert parse_wiki_url('http://tvtropes.org/pmwiki/pmwiki.php/Main') \
+        is None
+
+
+def fake_pages(monkeypatch, pages):
+    fetched = []
+
+    def mockreturn(self, url, **kwargs):
+        fetched.append(url)
+        return make_response(url, pages[url])
+
+    monkeypatch.setattr(requests.Session, "get", mockreturn)
+    return fetched
+
+
+def make_page(title, *links):
+    return (
+        '<div class="pagetitle"><div class="article_title"><h1>'
+        '<span>{}</span></h1></div></div><div id="wikitext">{}</div>'
+    ).format(title, ''.join(
+        '<a class="twikilink" href="{}">link</a>'.format(link)
+        for link in links
+    ))
+
+
+def test_crawl_link_does_not_fetch_children(monkeypatch, fx_session,
+                                            fx_celery_app):
+    origin = 'http://tvtropes.org/pmwiki/pmwiki.php/Main/GodJob'
+    destination = 'http://tvtropes.org/pmwiki/pmwiki.php/Film/IronMan'
+    fetched = fake_pages(monkeypatch, {
+        origin: make_page('God Job',
+                          '/pmwiki/pmwiki.php/Film/IronMan',
+                          '/pmwiki/pmwiki.php/Administrivia/Foo'),
+        destination: make_page('Film: Iron Man'),
+    })
+    delayed = []
+    monkeypatch.setattr(crawl_link, 'delay',
+                        lambda url, run_id=None: delayed.append(url))
+    crawl_link(origin)
+    assert fetched == [origin]
+    assert delayed == [destination]
+    relation = fx_session.query(Relation).one()
+    assert (relation.destination_namespace, relation.destination_name) == \
+        ('Film', 'IronMan')
+    # the relation is resolved when its destination is crawled
+    crawl_link(destination)
+    assert fetched == [origin, destination]
+    fx_session.expire_all()
+    relation = fx_session.query(Relation).one()
+    assert (relation.destination_namespace, relation.destination_name) == \
+        ('Film', 'Iron Man')
+
+
+def test_crawl_link_frontier(monkeypatch, fx_session, fx_celery_app):
+    first = 'http://tvtropes.org/pmwiki/pmwiki.php/Main/GodJob'
+    second = 'http://tvtropes.org/pmwiki/pmwiki.php/Main/TheAce'
+    fake_pages(monkeypatch, {
+        first: make_page('God Job', '/pmwiki/pmwiki.php/Film/IronMan'),
+        second: make_page('The Ace', '/pmwiki/pmwiki.php/Film/IronMan',
+                          '/pmwiki/pmwiki.php/Main/GodJob'),
+    })
+    delayed = []
+    monkeypatch.setattr(crawl_link, 'delay',
+                        lambda url, run_id=None: delayed.append(url))
+    crawl_link(first)
+    crawl_link(second)
+    assert delayed == ['http://tvtropes.org/pmwiki/pmwiki.php/Film/IronMan',
+                       first]
+
+
+def test_crawl_link_run(monkeypatch, fx_session, fx_celery_app):
+    origin = 'http://tvtropes.org/pmwiki/pmwiki.php/Main/GodJob'
+    destination = 'http://tvtropes.org/pmwiki/pmwiki.php/Film/IronMan'
+    fake_pages(monkeypatch, {
+        origin: make_page('God Job', '/pmwiki/pmwiki.php/Film/IronMan'),
+    })
+    delayed = []
+    monkeypatch.setattr(crawl_link, 'delay',
+                        lambda url, run_id=None: delayed.append(run_id))
+    run_id, _ = begin_run(fx_session, 'tvtropes')
+    crawl_link(origin, run_id)
+    assert delayed == [run_id]
+    items = dict(fx_session.query(CrawlRunItem.partition,
+                                  CrawlRunItem.status))
+    assert items == {origin: DONE, destination: PENDING}
+    with raises(KeyError):
+        crawl_link(destination, run_id)
+    item = fx_session.query(CrawlRunItem) \
+                     .filter_by(partition=destination) \
+                     .one()
+    assert item.status == FAILED
+    assert item.error.startswith('KeyError')
+
+
+def test_crawl_purges_store(fx_session, fx_celery_app):
+    current_time = datetime.datetime.now(datetime.timezone.utc)
+    with fx_session.begin():
+        fx_session.add(Entity(namespace='Main', name='GodJob',
+                              url='Main/GodJob', type='Trope',
+                              last_crawled=current_time))
+    frontier = get_store('tvtropes.frontier', fx_session)
+    frontier.set_many({'expired': True}, datetime.timedelta(seconds=-1))
+    frontier.set_many({'fresh': True}, datetime.timedelta(days=1))
+    crawl()
+    assert fx_session.query(StoreItem.key).all() == [('fresh',)]
+
+
+def test_crawl_resumes_lost_tasks(monkeypatch, fx_session, fx_celery_app):
+    url = 'http://tvtropes.org/pmwiki/pmwiki.php/Main/GodJob'
+    current_time = datetime.datetime.now(datetime.timezone.utc)
+    with fx_session.begin():
+        fx_session.add(Entity(namespace='Main', name='GodJob', url=url,
+                              type='Trope', last_crawled=current_time))
+    run_id, _ = begin_run(fx_session, 'tvtropes')
+    # the task of the pending url was lost
+    add_items(fx_session, run_id, [url])
+    backdate(fx_session, run_id)
+    enqueued = []
+    monkeypatch.setattr(crawler, 'enqueue_links',
+                        lambda urls, run_id=None: enqueued.append(
+                            (urls, run_id)
+                        ))
+    crawl()
+    assert enqueued == [([url], run_id)]
+
+
+def test_crawl_link_not_modified(monkeypatch, fx_session, fx_celery_app):
+    url = 'http://tvtropes.org/pmwiki/pmwiki.php/Main/GodJob'
+    text = make_page('God Job', '/pmwiki/pmwiki.php/Film/IronMan')
+    requested = []
+
+    def mockreturn(self, path, headers=None, **kwargs):
+        requested.append(headers)
+        if headers.get('If-None-Match') == '"v1"':
+            return make_response(url, '', status_code=304)
+        return make_response(url, text, headers={
+            'ETag': '"v1"',
+            'Last-Modified': 'Sun, 18 Oct 2026 10:00:00 GMT',
+        })
+
+    monkeypatch.setattr(requests.Session, "get", mockreturn)
+    monkeypatch.setattr(crawl_link, 'delay', lambda url, run_id=None: None)
+    crawl_link(url)
+    entity = fx_session.query(Entity).filter_by(url=url).one()
+    assert entity.etag == '"v1"'
+    assert entity.last_modified == 'Sun, 18 Oct 2026 10:00:00 GMT'
+    with fx_session.begin():
+        entity.last_crawled = None
+        fx_session.query(Relation).delete()
+    crawl_link(url)
+    assert requested[-1] == {
+        'If-None-Match': '"v1"',
+        'If-Modified-Since': 'Sun, 18 Oct 2026 10:00:00 GMT',
+    }
+    fx_session.expire_all()
+    entity = fx_session.query(Entity).filter_by(url=url).one()
+    assert entity.last_crawled is not None
+    # relations are not rewritten for the unmodified page
+    assert fx_session.query(Relation).count() == 0
+
+
+def test_lookup_redirections_cache(monkeypatch, fx_session, fx_celery_app):
+    original = 'http://tvtropes.org/pmwiki/pmwiki.php/Main/Ace'
+    final = 'http://tvtropes.org/pmwiki/pmwiki.php/Main/TheAce'
+    related = RELATED_SEARCH + 'Main/TheAce'
+    fetched = fake_pages(monkeypatch, {
+        related: '<div id="wikimiddle"><div>This article is the target of '
+                 '1 redirect(s).<ul><li><a>Main/Ace</a></li></ul></div></div>',
+    })
+    assert lookup_redirections(fx_session, original, final) == \
+        [('Main', 'Ace')]
+    assert lookup_redirections(fx_session, original, final) == \
+        [('Main', 'Ace')]
+    assert fetched == [related]
+    assert lookup_redirections(fx_session, final, final) == []
+    assert fetched == [related]
+
+
+def test_seed_pages(monkeypatch, fx_session, fx_celery_app):
+    def make_index(*hrefs):
+        return ''.join('<a class="twikilink" href="{}">page</a>'.format(href)
+                       if 'pmwiki.php' in href else
+                       '<a href="{}">namespace</a>'.format(href)
+                       for href in hrefs)
+    page = 'http://tvtropes.org/pmwiki/pmwiki.php/{}'.format
+    main = INDEX_INDEX + '?groupname=Main'
+    film = INDEX_INDEX + '?groupname=Film'
+    pages = {
+        INDEX_INDEX: make_index(page('Main/HomePage'),
+                                'index_report.php?groupname=Main',
+                                'index_report.php?groupname=Administrivia',
+                                'index_report.php?groupname=Film'),
+        main: make_index(page('Main/GodJob'), page('Main/TheAce'),
+                         page('Main/HomePage')),
+    }
+    fetched = fake_pages(monkeypatch, pages)
+    batches = []
+    with raises(KeyError):
+        # the film index is not available
+        seed_pages(fx_session, batches.append, batch_size=1)
+    assert batches == [[page('Main/HomePage')], [page('Main/GodJob')],
+                       [page('Main/TheAce')]]
+    pages[film] = make_index(page('Film/IronMan'), page('Main/GodJob'))
+    del fetched[:]
+    del batches[:]
+    # it resumes from the film index
+    assert seed_pages(fx_session, batches.append) == 1
+    assert fetched == [INDEX_INDEX, film]
+    assert batches == [[page('Film/IronMan')]]
+    assert not is_seeding(fx_session)
+
+
+def test_crawl_continues_seeding(monkeypatch, fx_session, fx_celery_app):
+    page = 'http://tvtropes.org/pmwiki/pmwiki.php/{}'.format
+    film = INDEX_INDEX + '?groupname=Film'
+    pages = {
+        INDEX_INDEX: '<a class="twikilink" href="{}">page</a>'
+                     '<a href="index_report.php?groupname=Film">film</a>'
+                     .format(page('Main/GodJob')),
+    }
+    fake_pages(monkeypatch, pages)
+    enqueued = []
+    monkeypatch.setattr(crawler, 'enqueue_links',
+                        lambda urls, run_id=None: enqueued.extend(urls))
+    with raises(KeyError):
+        # the film index is not available
+        crawl()
+    assert enqueued == [page('Main/GodJob')]
+    assert is_seeding(fx_session)
+    with fx_session.begin():
+        fx_session.add(Entity(namespace='Main', name='GodJob',
+                              url=page('Main/GodJob'), type='Trope'))
+    pages[film] = '<a class="twikilink" href="{}">page</a>'.format(
+        page('Film/IronMan')
+    )
+    del enqueued[:]
+    # it continues seeding, although there are entities
+    crawl()
+    assert enqueued == [page('Film/IronMan')]
+    assert not is_seeding(fx_session)
+
+
+def test_iter_stale_urls(fx_session):
+    current_time = datetime.datetime.now(datetime.timezone.utc)
+    recent = current_time - datetime.timedelta(days=1)
+    stale = current_time - datetime.timedelta(days=10)
+    with fx_session.begin():
+        for namespace, name, last_crawled in [('Main', 'B', stale),
+                                              ('Main', 'A', None),
+                                              ('Film', 'C', recent),
+                                              ('Film', 'D', stale),
+                                              ('Main', 'C', stale)]:
+            fx_session.add(Entity(namespace=namespace, name=name,
+                                  url=namespace + '/' + name, type='Trope',
+                                  last_crawled=last_crawled))
+    assert list(iter_stale_urls(fx_session, current_time, chunk_size=2)) == \
+        [['Film/D', 'Main/A'], ['Main/B', 'Main/C']]
+    assert list(iter_stale_urls(fx_session, current_time, chunk_size=3)) == \
+        [['Film/D', 'Main/A', 'Main/B'], ['Main/C']]
+
+
+def test_parse_page():
+    text = (
+        '<html><body><a class="twikilink" href="/pmwiki/pmwiki.php/Main/A">'
+        'a</a><div class="pagetitle"><div class="article_title"><h1>'
+        '<span>Film: </span>Iron Man</h1></div></div><div id="wikitext">'
+        '<p><a class="twikilink" href="/pmwiki/pmwiki.php/Main/B">b</a>'
+        '<a class="urllink" href="http://example.com/">c</a>'
+        '<a class="twikilink">d</a></p><div><a class="twikilink" '
+        'href="/pmwiki/pmwiki.php/Main/E">e</a></div></div>'
+        '<a class="twikilink" href="/pmwiki/pmwiki.php/Main/F">f</a>'
+    )
+    for chunk_size in 7, 16384:
+        page = parse_page(text + '<p>x</p>' * 1000, chunk_size=chunk_size)
+        assert page.title == 'Film: Iron Man'
+        assert page.hrefs == ['/pmwiki/pmwiki.php/Main/B',
+                              '/pmwiki/pmwiki.php/Main/E']
+    assert parse_page('<div id="wikitext"></div>').title is None
+    assert parse_page('') == (None, [])
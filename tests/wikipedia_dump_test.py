@@ -0,0 +1,64 @@
+import bz2
+import gzip
+import os.path
+
+from pytest import mark
+
+from cliche.services.wikipedia.dump import import_dump, parse_triple
+from cliche.services.wikipedia.work import Artist, Book, Entity, Film, Relation
+
+
+DUMP_PATH = os.path.join(os.path.dirname(__file__), 'dbpedia_dump.nt')
+
+
+def test_parse_triple():
+    assert parse_triple(
+        '<http://a> <http://b> <http://c> .\n'
+    ) == ('http://a', 'http://b', 'http://c', None)
+    assert parse_triple(
+        r'<http://a> <http://b> "x \"y\" é\\"@en-US .'
+    ) == ('http://a', 'http://b', 'x "y" é\\', 'en-US')
+    assert parse_triple(
+        '<http://a> <http://b> "1"^^<http://www.w3.org/2001/'
+        'XMLSchema#integer> .'
+    ) == ('http://a', 'http://b', '1', None)
+    assert parse_triple('# comment') is None
+    assert parse_triple('@prefix dbr: <http://dbpedia.org/resource/> .') \
+        is None
+
+
+@mark.parametrize(('suffix', 'compress'), [
+    ('', None),
+    ('.bz2', bz2.open),
+    ('.gz', gzip.open),
+])
+def test_import_dump(suffix, compress, fx_tmpdir, fx_session,
+                     fx_celery_app):
+    path = DUMP_PATH
+    if compress is not None:
+        path = str(fx_tmpdir / ('dump.nt' + suffix))
+        with open(DUMP_PATH, 'rb') as src, compress(path, 'wb') as dst:
+            dst.write(src.read())
+    assert import_dump(fx_session, [path], batch_size=2) == (5, 11)
+    film = fx_session.query(Film).one()
+    assert film.name == 'http://dbpedia.org/resource/Iron_Man_(2008_film)'
+    assert film.label == 'Iron Man (2008 film)'
+    assert film.revision == 604152386
+    assert film.country == 'united states'
+    assert film.director == 'http://dbpedia.org/resource/Jon_Favreau'
+    book = fx_session.query(Book).one()
+    assert book.label == 'Slaves of "Sleep"'
+    assert book.number_of_pages == 202
+    artist = fx_session.query(Artist).one()
+    assert artist.notable_work == 'http://dbpedia.org/resource/Dianetics'
+    assert fx_session.query(Entity).count() == 3
+    relation = fx_session.query(Relation).one()
+    assert relation.work == book.name
+    assert relation.work_label == 'Slaves of "Sleep"'
+    assert relation.author == artist.name
+    assert relation.author_label == 'L. Ron Hubbard'
+    assert relation.revision == 598776135
+    # importing again is idempotent
+    assert import_dump(fx_session, [path]) == (5, 11)
+    assert fx_session.query(Entity).count() == 3
+    assert fx_session.query(Relation).count() == 1
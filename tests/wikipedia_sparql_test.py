@@ -0,0 +1,144 @@
+import threading
+import time
+
+from pytest import raises
+from requests import ConnectionError, HTTPError, Response
+
+from cliche.metrics import HTTP_BYTES, HTTP_REQUESTS
+
+from cliche.services.wikipedia.sparql import (DEFAULT_CONCURRENCY,
+                                              SparqlClient, get_sparql_client,
+                                              iter_bindings)
+
+RESULT = '''{ "head": { "link": [], "vars": ["bindings", "label"] },
+  "results": { "distinct": false, "ordered": true, "bindings": [
+    { "bindings": { "type": "uri", "value": "http://dbpedia.org/a" },
+      "label": { "type": "literal", "xml:lang": "en", "value": "A, [a]" } },
+    { "bindings": { "type": "uri", "value": "http://dbpedia.org/b" } } ] } }
+'''
+ROWS = [{'bindings': 'http://dbpedia.org/a', 'label': 'A, [a]'},
+        {'bindings': 'http://dbpedia.org/b'}]
+
+
+def make_response(status_code, content):
+    response = Response()
+    response.status_code = status_code
+    response._content = content
+    response._content_consumed = True
+    return response
+
+
+def test_sparql_client_query(monkeypatch, fx_celery_app):
+    client = SparqlClient('http://dbpedia.org/sparql', concurrency=2)
+    requests = []
+
+    def post(url, data, timeout):
+        requests.append((url, data))
+        return make_response(200, b'{"results": {"bindings": '
+                                  b'[{"a": {"type": "uri", "value": "b"}}]}}')
+
+    monkeypatch.setattr(client.http, 'post', post)
+    assert client.query('SELECT ?a WHERE { ?a ?b ?c }') == [
+        {'a': {'type': 'uri', 'value': 'b'}}
+    ]
+    assert requests == [('http://dbpedia.org/sparql',
+                         {'query': 'SELECT ?a WHERE { ?a ?b ?c }'})]
+    assert client.http.headers['Accept'] == 'application/sparql-results+json'
+    monkeypatch.setattr(client.http, 'post',
+                        lambda url, data, timeout: make_response(503, b''))
+    with raises(HTTPError):
+        client.query('SELECT ?a WHERE { ?a ?b ?c }')
+    client.close()
+
+
+def test_sparql_client_metrics(monkeypatch, fx_celery_app):
+    client = SparqlClient('http://dbpedia.org/sparql')
+    requests = {status: HTTP_REQUESTS.get(service='wikipedia', status=status)
+                for status in (200, 503, 'error')}
+    received = HTTP_BYTES.get(service='wikipedia')
+    monkeypatch.setattr(client.http, 'post',
+                        lambda url, data, timeout, stream=False:
+                        make_response(200, RESULT.encode('utf-8')))
+    client.query('SELECT ?a WHERE { ?a ?b ?c }')
+    list(client.stream('SELECT ?a WHERE { ?a ?b ?c }'))
+    monkeypatch.setattr(client.http, 'post',
+                        lambda url, data, timeout:
+                        make_response(503, b'Service Unavailable'))
+    with raises(HTTPError):
+        client.query('SELECT ?a WHERE { ?a ?b ?c }')
+
+    def post(url, data, timeout):
+        raise ConnectionError()
+
+    monkeypatch.setattr(client.http, 'post', post)
+    with raises(ConnectionError):
+        client.query('SELECT ?a WHERE { ?a ?b ?c }')
+    assert {
+        status: HTTP_REQUESTS.get(service='wikipedia', status=status) - count
+        for status, count in requests.items()
+    } == {200: 2, 503: 1, 'error': 1}
+    assert HTTP_BYTES.get(service='wikipedia') - received == \
+        2 * len(RESULT.encode('utf-8')) + len(b'Service Unavailable')
+    client.close()
+
+
+def test_sparql_client_map(fx_celery_app):
+    client = SparqlClient('http://dbpedia.org/sparql', concurrency=3)
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def work(i):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+        return i * 2
+
+    assert client.map(work, range(9)) == [i * 2 for i in range(9)]
+    assert 1 < running[1] <= 3
+    client.close()
+
+
+def test_get_sparql_client(monkeypatch, fx_celery_app):
+    monkeypatch.setitem(fx_celery_app.conf, 'WIKIPEDIA_SPARQL_CLIENT', None)
+    monkeypatch.setitem(fx_celery_app.conf, 'WIKIPEDIA_CONCURRENCY', 5)
+    client = get_sparql_client('http://dbpedia.org/sparql')
+    assert client.concurrency == 5
+    assert get_sparql_client('http://dbpedia.org/sparql') is client
+    assert get_sparql_client('http://live.dbpedia.org/sparql') is not client
+
+
+def test_sparql_client_concurrency(fx_celery_app):
+    client = SparqlClient('http://dbpedia.org/sparql')
+    assert client.concurrency == DEFAULT_CONCURRENCY
+
+
+def test_iter_bindings():
+    assert list(iter_bindings([RESULT])) == ROWS
+    # split at every character
+    assert list(iter_bindings(RESULT)) == ROWS
+    rows = iter_bindings(RESULT[:RESULT.index('"http://dbpedia.org/b"')])
+    assert next(rows) == ROWS[0]
+    with raises(ValueError):
+        next(rows)
+    with raises(ValueError):
+        list(iter_bindings(['{"head": {"vars": ["bindings"]}}']))
+    assert list(iter_bindings(['{"results": {"bindings": [ ]}}'])) == []
+
+
+def test_sparql_client_stream(monkeypatch, fx_celery_app):
+    client = SparqlClient('http://dbpedia.org/sparql')
+    requests = []
+
+    def post(url, data, timeout, stream):
+        requests.append(stream)
+        return make_response(200, RESULT.encode('utf-8'))
+
+    monkeypatch.setattr(client.http, 'post', post)
+    rows = client.stream('SELECT ?a WHERE { ?a ?b ?c }', chunk_size=16)
+    assert requests == []
+    assert list(rows) == ROWS
+    assert requests == [True]
+    client.close()